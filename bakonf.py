@@ -27,21 +27,52 @@ included in the generated archive.
 
 """
 
+# bakonf is installed and distributed as a single script (see the
+# install and dist targets, and the spec file), so all of it lives in
+# this module, which is thus larger than the usual limit.
+# pylint: disable=too-many-lines
+
 import sys
 import stat
 import os
 import glob
 import re
 import time
+import shlex
+import shutil
 import subprocess
 import tarfile
 import logging
 import argparse
+import queue
+import threading
 import collections
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import cProfile
+import errno
+import heapq
+import fcntl
+import functools
+import io
 from io import BytesIO
 import hashlib
-
-from typing import List, Tuple, Dict, Optional, Any, AnyStr, BinaryIO
+import json
+import mmap
+import platform
+import socket
+import struct
+import zlib
+import bz2
+import gzip
+import pwd
+import grp
+
+from typing import List, Tuple, Dict, Set, Optional, Any, AnyStr, \
+    BinaryIO, IO, Iterable, Iterator, Pattern, TextIO, TypeVar, Union, cast
 
 import yaml
 import bsddb3
@@ -62,13 +93,23 @@ ENCODING = "utf-8"
 DEFAULT_VPATH = "/var/lib/bakonf/statefile.db"
 DEFAULT_ODIR = "/var/lib/bakonf/archives"
 CMD_PREFIX = "commands"
+FS_PREFIX = "filesystem"
+DELETED_LIST = "deleted_files.lst"
+UNCHANGED_CMDS_LIST = "commands_unchanged.lst"
 ROOT_TAG = "bakonf"
 DBKEY_VERSION = "bakonf:db_version"
 DBKEY_DATE = "bakonf:db_date"
+DBKEY_SCANNED = "bakonf:scanned"
+DBKEY_CHECKPOINT = "bakonf:checkpoint"
+DBKEY_COMPRESSION = "bakonf:compression"
+# Level 0 backups write the new state database under this suffix, and
+# rename it over the old one only once the backup is complete
+STATE_NEW_SUFFIX = ".new"
 COMP_NONE = ""
 COMP_GZ = "gz"
 COMP_BZ2 = "bz2"
 COMP_XZ = "xz"
+COMP_AUTO = "auto"
 
 FORMATS = {
     "ustar": tarfile.USTAR_FORMAT,
@@ -76,15 +117,1336 @@ FORMATS = {
     "pax": tarfile.PAX_FORMAT,
 }
 
-HAVE_LZMA = sys.hexversion >= 0x03030000
+try:
+    import lzma
+    HAVE_LZMA = True
+except ImportError:  # pragma: no cover
+    HAVE_LZMA = False
+
+# Size of the buffer used when copying file contents into the archive
+COPY_BUFSIZE = 1024 * 1024
+
+HAVE_COPY_FILE_RANGE = hasattr(os, "copy_file_range")
+HAVE_SENDFILE = hasattr(os, "sendfile")
+
+# Uncompressed size after which a new independently decodable
+# compressed block is started, for indexed archives
+INDEX_BLOCKSIZE = 1024 * 1024
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+# Compression levels tried by the automatic compression, from the
+# fastest to the best compressing one, and the level used for the
+# contents of already compressed files
+AUTO_LEVELS = {COMP_GZ: (1, 6, 9), COMP_BZ2: (1, 9), COMP_XZ: (0, 3, 6)}
+AUTO_STORE_LEVELS = {COMP_GZ: 0, COMP_BZ2: 1, COMP_XZ: 0}
+# Uncompressed size of the blocks after which the automatic compression
+# reconsiders the level, how much of the start of the archive is used
+# for measuring the other codecs, and the minimum size of a measurement
+AUTO_BLOCKSIZE = 1024 * 1024
+AUTO_SAMPLE = 512 * 1024
+AUTO_MIN_SAMPLE = 64 * 1024
+# Files with these extensions are considered already compressed (or
+# encrypted), and not worth compressing again
+COMPRESSED_SUFFIXES = frozenset([
+    ".gz", ".tgz", ".bz2", ".xz", ".txz", ".lz", ".lzma", ".lz4",
+    ".zst", ".z", ".zip", ".jar", ".war", ".7z", ".rar", ".deb", ".rpm",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv",
+    ".ogg", ".jks", ".keystore", ".p12", ".pfx", ".gpg", ".kdbx",
+])
+
+# Archives split into volumes: the suffix of the volumes while they
+# are waiting to be compressed, and the version of the manifest file
+VOLUME_TMP_SUFFIX = ".tmp"
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_VERSION = 1
+
+# Default number of parallel workers for restores
+RESTORE_JOBS = 4
+
+# How many selected paths can be queued between the scanner and the
+# archiver
+PIPELINE_DEPTH = 1024
+
+# Kinds of the per-path timings recorded when profiling, and how many
+# of the slowest paths, directories and commands are reported
+PROF_STAT = 0
+PROF_CHECKSUM = 1
+PROF_ARCHIVE = 2
+PROF_LIST = 3
+PROF_KINDS = ("stat", "checksum", "archive", "list")
+PROFILE_TOP = 10
+
+# Interval (in seconds) between the checkpoints of level 0 backups, by
+# default only done for archives which are uncompressed or written in
+# blocks anyway (see BackupManager._startcheckpoints)
+CHECKPOINT_INTERVAL = 60.0
+
+# Interval (in seconds) between the progress records, and the phases
+# they report
+STATUS_INTERVAL = 5.0
+# How long (in seconds) sending a record to the status socket may
+# take, so that a stuck reader can't block the backup
+STATUS_TIMEOUT = 10.0
+PHASE_FILES = "files"
+PHASE_COMMANDS = "commands"
+PHASE_FINISHING = "finishing"
+PHASE_DONE = "done"
+
+# How many directories the parallel scanner can read ahead of the
+# examination of their files
+SCAN_WINDOW = 256
+
+# Default number of roots backed up in parallel, in batch mode
+ROOT_JOBS = 2
+
+# Size of the buffer used when checksumming files
+HASH_BUFSIZE = 256 * 1024
+
+# Minimum size of the files which are checksummed via mmap, when
+# preserving the page cache
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# How many checksummed files are kept in the page cache until they are
+# archived, when preserving the page cache; this covers the files
+# queued between the scan and the archiving
+DEFERRED_DROPS = 4096
+
+HAVE_FADVISE = hasattr(os, "posix_fadvise")
+HAVE_POSIX_SPAWN = hasattr(os, "posix_spawnp")
+
+# Size of the chunks for which separate checksums are recorded, for
+# files above the configured chunk_threshold
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# I/O scheduling classes (see ioprio_set(2)), and the ioprio_set
+# system call numbers for the common architectures
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30,
+    "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282,
+    "riscv64": 30,
+}
+# Set once the niceness has been changed, as os.nice() adds to the
+# current value and shouldn't be applied again by later backups
+_NICE_APPLIED = threading.Event()
+
+# Read orders for file contents: as found by the directory walk, or
+# sorted by inode number or by physical location on disk
+READ_ORDER_WALK = "walk"
+READ_ORDER_INODE = "inode"
+READ_ORDER_EXTENT = "extent"
+READ_ORDERS = (READ_ORDER_WALK, READ_ORDER_INODE, READ_ORDER_EXTENT)
+
+# How many files are examined together when reading in disk order
+IOSCHED_WINDOW = 1024
+
+# ioctl for getting the physical extents of a file, see
+# linux/fiemap.h; the request structure is followed by one extent
+FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_REQ = struct.Struct("=QQLLLL")
+_FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+# Errors which signal that a kernel-side copy is not possible between
+# the given files, and that we should fall back to a normal copy
+_ZEROCOPY_ERRORS = frozenset([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                              errno.EOPNOTSUPP, errno.EBADF, errno.EPERM,
+                              errno.ETXTBSY])
+
+
+IndexEntry = collections.namedtuple(
+    "IndexEntry", "name offset block_offset block_start size digest")
+
+
+class BlockCompressor:
+    """Writes compressed data as a sequence of independent blocks.
+
+    Each block is a complete gzip/bzip2/xz stream; since all the
+    decompressors handle concatenated streams, the result is still a
+    normal compressed file, but decompression can also start at the
+    beginning of any block. The current block is ended (on request)
+    once it holds more than blocksize bytes of uncompressed data; if
+    blocksize is 0, blocks are only ended explicitly (endblock()).
+
+    """
+    def __init__(self, name: str, compression: str,
+                 blocksize: int = INDEX_BLOCKSIZE) -> None:
+        self.name = name
+        self.compression = compression
+        self.blocksize = blocksize
+        self.raw = open(name, "wb")
+        self.pos = 0
+        self.cpos = 0
+        self.block_start = 0
+        self.block_offset = 0
+        self._comp: Optional[Any] = None
+
+    @staticmethod
+    def newcompressor(compression: str, level: Optional[int] = None) -> Any:
+        """Returns a new compressor object.
+
+        By default, the highest level is used for gzip and bzip2, and
+        the default preset for xz.
+
+        """
+        if compression == COMP_GZ:
+            return zlib.compressobj(9 if level is None else level,
+                                    zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if compression == COMP_BZ2:
+            return bz2.BZ2Compressor(9 if level is None else level)
+        if compression == COMP_XZ:
+            if not HAVE_LZMA:
+                raise Error("Your Python version doesn't support LZMA"
+                            " compression")
+            return lzma.LZMACompressor(preset=level)
+        raise Error("Unexpected compression mode '%s'" % compression)
+
+    def _newblock(self) -> Any:
+        """Returns the compressor for a new block."""
+        return self.newcompressor(self.compression)
+
+    def _out(self, data: bytes) -> None:
+        """Writes compressed data to the underlying file."""
+        self.raw.write(data)
+        self.cpos += len(data)
+
+    def write(self, data: bytes) -> int:
+        """Compresses and writes data."""
+        if self._comp is None:
+            self._comp = self._newblock()
+        self._out(self._comp.compress(data))
+        self.pos += len(data)
+        return len(data)
+
+    def endblock(self) -> None:
+        """Ends the current block, if any data was written to it."""
+        if self._comp is not None:
+            self._out(self._comp.flush())
+            self._comp = None
+        self.block_start = self.pos
+        self.block_offset = self.cpos
+
+    def checkpoint(self) -> None:
+        """Ends the current block if it's over the size threshold."""
+        if 0 < self.blocksize <= self.pos - self.block_start:
+            self.endblock()
+
+    def tell(self) -> int:
+        """Returns the uncompressed position."""
+        return self.pos
+
+    def flush(self) -> None:
+        """Flushes the underlying file."""
+        self.raw.flush()
+
+    def close(self) -> None:
+        """Ends the last block and closes the underlying file."""
+        try:
+            self.endblock()
+        finally:
+            self.raw.close()
+
+
+class AdaptiveCompressor(BlockCompressor):
+    """Block compressor which adapts the compression level.
+
+    The time spent compressing each block is measured; if the rest of
+    the expected data couldn't be compressed within the rest of the
+    budget at the current level, the next block uses a faster one,
+    and if it could easily, a better compressing one. The contents of
+    already compressed files are stored in separate blocks, with the
+    fastest level (see bypass()). The start of the data is also used
+    as a sample for measuring the codecs and levels not yet in the
+    history (the rates, see choosecompression).
+
+    """
+    def __init__(self, name: str, compression: str, level: int,
+                 budget: Optional[float] = None,
+                 expected: Optional[int] = None,
+                 rates: Optional[Dict[str, List[float]]] = None,
+                 blocksize: int = AUTO_BLOCKSIZE) -> None:
+        super().__init__(name, compression, blocksize)
+        self.levels = AUTO_LEVELS[compression]
+        self.level = level
+        self.budget = budget
+        self.expected = expected
+        self.rates: Dict[str, List[float]] = dict(rates or {})
+        self.spent = 0.0
+        self._bypass = False
+        self._elapsed = 0.0
+        self._sample: Optional[bytearray] = bytearray()
+
+    def _newblock(self) -> Any:
+        if self._bypass:
+            return self.newcompressor(self.compression,
+                                      AUTO_STORE_LEVELS[self.compression])
+        return self.newcompressor(self.compression, self.level)
+
+    def write(self, data: bytes) -> int:
+        """Compresses and writes data, measuring the time spent."""
+        start = time.perf_counter()
+        size = super().write(data)
+        self._elapsed += time.perf_counter() - start
+        sample = self._sample
+        if sample is not None and not self._bypass and \
+           len(sample) < AUTO_SAMPLE:
+            sample += data[:AUTO_SAMPLE - len(sample)]
+        return size
+
+    def _measure(self, compression: str, level: int, size: int,
+                 elapsed: float, csize: int) -> None:
+        """Records a measurement, averaged with the previous ones."""
+        rate = size / max(elapsed, 1e-6)
+        ratio = csize / size
+        key = autokey(compression, level)
+        old = self.rates.get(key, None)
+        if old is not None:
+            rate = (rate + old[0]) / 2
+            ratio = (ratio + old[1]) / 2
+        self.rates[key] = [rate, ratio]
+
+    def _benchmark(self) -> None:
+        """Measures the codecs and levels not yet in the history."""
+        sample = bytes(self._sample or b"")
+        self._sample = None
+        if len(sample) < AUTO_MIN_SAMPLE:
+            return
+        for codec in autocodecs():
+            for level in AUTO_LEVELS[codec]:
+                if autokey(codec, level) in self.rates:
+                    continue
+                start = time.perf_counter()
+                comp = self.newcompressor(codec, level)
+                csize = len(comp.compress(sample)) + len(comp.flush())
+                self._measure(codec, level, len(sample),
+                              time.perf_counter() - start, csize)
+
+    def _adjust(self) -> None:
+        """Chooses the level of the next block."""
+        if self.budget is None or self.expected is None:
+            return
+        left = self.budget - self.spent
+        todo = max(self.expected - self.pos, self.blocksize)
+        needed = todo / left if left > 0 else float("inf")
+        idx = self.levels.index(self.level)
+        current = self.rates.get(autokey(self.compression, self.level), None)
+        if current is None:
+            return
+        rate = current[0]
+        if rate < needed:
+            if idx > 0:
+                self.level = self.levels[idx - 1]
+        elif rate > 2 * needed and idx + 1 < len(self.levels):
+            better = self.rates.get(autokey(self.compression,
+                                            self.levels[idx + 1]), None)
+            if better is None or better[0] >= needed:
+                self.level = self.levels[idx + 1]
+
+    def endblock(self) -> None:
+        """Ends the current block, and adapts the level."""
+        size = self.pos - self.block_start
+        coffset = self.block_offset
+        start = time.perf_counter()
+        super().endblock()
+        elapsed = self._elapsed + time.perf_counter() - start
+        self._elapsed = 0.0
+        if size == 0:
+            return
+        self.spent += elapsed
+        if not self._bypass and size >= AUTO_MIN_SAMPLE:
+            self._measure(self.compression, self.level, size, elapsed,
+                          self.cpos - coffset)
+        if self._sample is not None and len(self._sample) >= AUTO_SAMPLE:
+            self._benchmark()
+        if not self._bypass:
+            self._adjust()
+
+    def bypass(self, enabled: bool) -> None:
+        """Starts or ends the contents of an already compressed file.
+
+        These are compressed in their own blocks, so that they don't
+        slow down (or spoil the measurements of) the rest.
+
+        """
+        if enabled != self._bypass:
+            self.endblock()
+            self._bypass = enabled
+
+    def close(self) -> None:
+        """Ends the last block, and measures the codecs if not done."""
+        try:
+            self.endblock()
+            if self._sample is not None:
+                self._benchmark()
+        finally:
+            self.raw.close()
+
+
+class VolumeWriter:
+    """Writes an archive as a sequence of standalone volumes.
+
+    A new volume is started (on request, before a member) once the
+    current one holds at least size bytes; the finished volume gets
+    the end of archive marker, so that each volume is a complete tar
+    archive. For compressed archives, the volumes are written
+    uncompressed to a temporary file, and compressed in a thread pool
+    while the next volumes are being written.
+
+    """
+    def __init__(self, name: str, compression: str, size: int,
+                 workers: int) -> None:
+        self.name = name
+        self.compression = compression
+        self.size = size
+        self.volumes: List[str] = []
+        # the member names, and the index of the volume holding them
+        self.manifest: List[Tuple[str, int]] = []
+        self.pos = 0
+        self.total = 0
+        self._pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if compression != COMP_NONE:
+            self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._workers = workers
+        self._pending: List['concurrent.futures.Future[None]'] = []
+        self._raw = self._open()
+
+    def _open(self) -> IO[bytes]:
+        """Starts a new volume."""
+        path = tagname(self.name, "vol%d" % (len(self.volumes) + 1))
+        self.volumes.append(path)
+        self.pos = 0
+        if self._pool is not None:
+            path += VOLUME_TMP_SUFFIX
+        return open(path, "wb")
+
+    @property
+    def volume(self) -> int:
+        """Returns the index of the current volume."""
+        return len(self.volumes) - 1
+
+    def write(self, data: bytes) -> int:
+        """Writes data to the current volume."""
+        self._raw.write(data)
+        self.pos += len(data)
+        self.total += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        """Returns the uncompressed position in the whole archive."""
+        return self.total
+
+    def flush(self) -> None:
+        """Flushes the current volume."""
+        self._raw.flush()
+
+    def _finish(self) -> None:
+        """Closes the current volume, and queues its compression."""
+        self._raw.close()
+        path = self.volumes[-1]
+        if self._pool is None:
+            logging.info("Volume '%s' complete.", path)
+            return
+        self._pending.append(self._pool.submit(
+            compressvolume, path + VOLUME_TMP_SUFFIX, path,
+            self.compression))
+        # don't let the uncompressed volumes pile up
+        running = [f for f in self._pending if not f.done()]
+        while len(running) > 2 * self._workers:
+            concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            running = [f for f in running if not f.done()]
+
+    def checkpoint(self) -> bool:
+        """Starts a new volume, if the current one is full.
+
+        Returns whether a new volume was started.
+
+        """
+        if self.pos < self.size:
+            return False
+        self.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        self._finish()
+        self._raw = self._open()
+        return True
+
+    def close(self) -> None:
+        """Closes the last volume, and waits for their compression."""
+        try:
+            self._finish()
+            for future in self._pending:
+                future.result()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+
+
+def compressvolume(src: str, dest: str, compression: str) -> None:
+    """Compresses a finished volume, removing the uncompressed one."""
+    comp = BlockCompressor.newcompressor(compression)
+    try:
+        with open(src, "rb") as fin, open(dest, "wb") as fout:
+            while True:
+                data = fin.read(COPY_BUFSIZE)
+                if not data:
+                    break
+                fout.write(comp.compress(data))
+            fout.write(comp.flush())
+        os.unlink(src)
+    except EnvironmentError as err:
+        raise ArchiveWriteError("can't compress volume '%s': %s" %
+                                (dest, err)) from err
+    logging.info("Volume '%s' complete.", dest)
+
+
+def manifestname(path: str) -> str:
+    """Returns the name of the manifest of an archive split in volumes."""
+    idx = path.rfind(".tar")
+    if idx >= 0:
+        path = path[:idx]
+    return path + MANIFEST_SUFFIX
+
+
+def autokey(compression: str, level: int) -> str:
+    """Returns the name of a codec and level in the history."""
+    return "%s:%d" % (compression, level)
+
+
+def autocodecs() -> List[str]:
+    """Returns the codecs usable by the automatic compression."""
+    return [codec for codec in AUTO_LEVELS
+            if codec != COMP_XZ or HAVE_LZMA]
+
+
+def choosecompression(rates: Dict[str, List[float]],
+                      budget: Optional[float], expected: Optional[int],
+                      codecs: List[str]) -> Tuple[str, int]:
+    """Chooses the codec and level for the automatic compression.
+
+    The rates map each codec and level (see autokey) to the measured
+    throughput (uncompressed bytes per second) and compression ratio.
+    The best compressing level which is fast enough for compressing
+    the expected amount of data within the budget is chosen; if none
+    is, the fastest one. Without measurements, the middle gzip level
+    (or the first codec's) is used.
+
+    """
+    needed = 0.0
+    if budget is not None and expected is not None:
+        needed = expected / budget
+    known = [(rates[autokey(codec, level)], codec, level)
+             for codec in codecs for level in AUTO_LEVELS[codec]
+             if autokey(codec, level) in rates]
+    if not known:
+        codec = COMP_GZ if COMP_GZ in codecs else codecs[0]
+        levels = AUTO_LEVELS[codec]
+        return (codec, levels[len(levels) // 2])
+    fast = [(ratio, codec, level) for ((rate, ratio), codec, level) in known
+            if rate >= needed]
+    if fast:
+        (_, codec, level) = min(fast)
+    else:
+        (_, codec, level) = max(known)
+    return (codec, level)
+
+
+def precompressed(path: str) -> bool:
+    """Checks whether a file looks already compressed, by its name."""
+    return os.path.splitext(path)[1].lower() in COMPRESSED_SUFFIXES
+
+
+def tagname(path: str, tag: str) -> str:
+    """Inserts a tag in an archive name, before the extension."""
+    idx = path.rfind(".tar")
+    if idx < 0:
+        return "%s.%s" % (path, tag)
+    return "%s.%s%s" % (path[:idx], tag, path[idx:])
+
+
+def partname(path: str, part: int) -> str:
+    """Returns the name of a continuation archive."""
+    return tagname(path, "part%d" % part)
+
+
+def finishpartial(path: str, offset: int, compression: str) -> None:
+    """Terminates an interrupted archive at a checkpoint.
+
+    The data after the checkpoint offset is removed, and the end of
+    archive marker written instead (as a separate compressed stream,
+    for compressed archives).
+
+    """
+    trailer = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    if compression != COMP_NONE:
+        comp = BlockCompressor.newcompressor(compression)
+        trailer = comp.compress(trailer) + comp.flush()
+    try:
+        with open(path, "r+b") as fh:
+            fh.truncate(offset)
+            fh.seek(offset)
+            fh.write(trailer)
+    except EnvironmentError as err:
+        raise Error("Can't finish the interrupted archive '%s': %s" %
+                    (path, err)) from err
+
+
+def write_index(path: str, compression: str,
+                entries: List[IndexEntry]) -> None:
+    """Writes an archive index (sidecar) file.
+
+    The index is a JSON-lines file: the first line is a header
+    object, followed by one array per archive member, with the fields
+    of IndexEntry in order.
+
+    """
+    header = {"version": INDEX_VERSION, "compression": compression,
+              "fields": list(IndexEntry._fields)}
+    with open(path, "w", encoding=ENCODING) as fh:
+        fh.write(json.dumps(header) + "\n")
+        for entry in entries:
+            fh.write(json.dumps(list(entry)) + "\n")
+
+
+def write_manifest(path: str, volumes: List[str],
+                   members: List[Tuple[str, int]]) -> None:
+    """Writes the manifest of an archive split in volumes.
+
+    Like the index, this is a JSON-lines file: the header object
+    lists the (base names of the) volumes, and is followed by one
+    array per archive member, with its name and the index of the
+    volume holding it.
+
+    """
+    header = {"version": MANIFEST_VERSION,
+              "volumes": [os.path.basename(v) for v in volumes]}
+    with open(path, "w", encoding=ENCODING) as fh:
+        fh.write(json.dumps(header) + "\n")
+        for (name, volume) in members:
+            fh.write(json.dumps([name.rstrip("/"), volume]) + "\n")
+
+
+def read_index(path: str) -> Tuple[str, List[IndexEntry]]:
+    """Reads an archive index file.
+
+    Returns the compression of the archive and the list of entries.
+
+    """
+    with open(path, encoding=ENCODING) as fh:
+        try:
+            header = json.loads(fh.readline())
+            if header.get("version", None) != INDEX_VERSION:
+                raise ConfigurationError(path, "Unknown index version")
+            entries = [IndexEntry(*json.loads(line)) for line in fh]
+        except (ValueError, TypeError, AttributeError) as err:
+            raise ConfigurationError(path, "Invalid index file") from err
+    return (header["compression"], entries)
+
+
+class TokenBucket:
+    """Rate limiter based on the token bucket algorithm.
+
+    Up to rate tokens are added each second, with at most one
+    second's worth accumulated. Consuming more tokens than available
+    sleeps until they have been replenished; the total time spent
+    sleeping is kept in the stalled attribute.
+
+    """
+    def __init__(self, rate: float) -> None:
+        """Constructor for TokenBucket."""
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.stalled = 0.0
+        self.lock = threading.Lock()
+
+    def consume(self, amount: float) -> None:
+        """Consumes the given amount of tokens, waiting if needed."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # the tokens can go negative, in which case the next
+            # consumer will wait for them to be replenished as well
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.stalled += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Throttle:
+    """Enforces the read budget, and accounts the work done.
+
+    The read bandwidth and the number of files opened per second can
+    be limited; if not, only the amounts are recorded.
+
+    """
+    def __init__(self, max_bytes: Optional[float] = None,
+                 max_files: Optional[float] = None) -> None:
+        """Constructor for Throttle."""
+        self.bytes = TokenBucket(max_bytes) if max_bytes else None
+        self.files = TokenBucket(max_files) if max_files else None
+        self.nbytes = 0
+        self.nfiles = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def limited(self) -> bool:
+        """Whether the read bandwidth is limited."""
+        return self.bytes is not None
+
+    @property
+    def stalled(self) -> float:
+        """Total time spent waiting for the budget."""
+        return sum(b.stalled for b in (self.bytes, self.files)
+                   if b is not None)
+
+    def file(self) -> None:
+        """Accounts for one file being opened."""
+        with self.lock:
+            self.nfiles += 1
+        if self.files is not None:
+            self.files.consume(1)
+
+    def data(self, size: int) -> None:
+        """Accounts for an amount of data being read."""
+        with self.lock:
+            self.nbytes += size
+        if self.bytes is not None:
+            self.bytes.consume(size)
+
+    def summary(self) -> str:
+        """Returns a summary of the work done."""
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return ("read %d bytes, opened %d files or commands, %.2f MiB/s,"
+                " %.1f files/s, throttled for %.2f seconds" %
+                (self.nbytes, self.nfiles,
+                 self.nbytes / elapsed / 1048576, self.nfiles / elapsed,
+                 self.stalled))
+
+
+class Profiler:
+    """Records the time spent on each path and command.
+
+    The time spent stat'ing, checksumming and archiving each path (and
+    listing each directory) is summed per path and per parent
+    directory; the report lists the
+    slowest of each, and the slowest commands. Recording is thread
+    safe, as the scan and the archiving run in different threads.
+
+    """
+    def __init__(self) -> None:
+        """Constructor for Profiler."""
+        self.paths: Dict[str, List[float]] = {}
+        self.dirs: Dict[str, float] = collections.defaultdict(float)
+        self.commands: List[Tuple[float, str]] = []
+        self.lock = threading.Lock()
+
+    def add(self, kind: int, path: str, start: float) -> None:
+        """Records an operation on a path, started at the given time."""
+        elapsed = time.monotonic() - start
+        with self.lock:
+            times = self.paths.get(path, None)
+            if times is None:
+                times = self.paths[path] = [0.0] * len(PROF_KINDS)
+            times[kind] += elapsed
+            self.dirs[os.path.dirname(path)] += elapsed
+
+    def command(self, command: str, start: float) -> None:
+        """Records the execution of a command."""
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.commands.append((elapsed, command))
+
+    def report(self, out: TextIO, top: int = PROFILE_TOP) -> None:
+        """Writes the report of the slowest paths and commands."""
+        out.write("Slowest paths:\n")
+        for (path, times) in heapq.nlargest(top, self.paths.items(),
+                                            key=lambda v: sum(v[1])):
+            details = ", ".join("%s %.3fs" % (name, val) for (name, val)
+                                in zip(PROF_KINDS, times) if val)
+            out.write("  %9.3fs  %s (%s)\n" % (sum(times), path, details))
+        out.write("Slowest directories (time spent on their entries):\n")
+        for (path, total) in heapq.nlargest(top, self.dirs.items(),
+                                            key=lambda v: v[1]):
+            out.write("  %9.3fs  %s\n" % (total, path))
+        out.write("Slowest commands:\n")
+        for (elapsed, command) in heapq.nlargest(top, self.commands):
+            out.write("  %9.3fs  %s\n" % (elapsed, command))
+
+
+def set_ioprio(ioclass: str, level: int) -> None:
+    """Sets the I/O scheduling class and level of the process."""
+    nr = _IOPRIO_SET_SYSCALLS.get(platform.machine(), None)
+    if nr is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not known on %s" %
+                      platform.machine())
+    libc = ctypes.CDLL(None, use_errno=True)
+    prio = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, prio) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+# Checksums (and chunk checksums) of the files read, by their device,
+# inode, size and mtime
+InodeKey = Tuple[int, int, int, float]
+DigestCache = Dict[InodeKey, Tuple[str, Optional[Tuple[int, List[str]]]]]
+
+
+class FileReader:
+    """Reads the contents of files, for checksumming and archiving.
+
+    By default files are read normally. If preserve_cache is set,
+    files are opened with O_NOATIME (where permitted), the kernel is
+    advised that they will be read sequentially, and after reading
+    they are dropped from the page cache, unless they were already
+    (partially) cached before; large files are checksummed via mmap.
+    This avoids evicting the working set of other programs and
+    updating the access times. The files which are checksummed are
+    only dropped once read again for archiving (or released, if not
+    selected), so that they are read from disk only once.
+
+    All reads are accounted, and possibly limited, by the throttle.
+    If a profiler is given, the users of the reader record their
+    timings in it.
+
+    """
+    _libc: Optional[ctypes.CDLL] = None
+
+    def __init__(self, preserve_cache: bool = False,
+                 throttle: Optional[Throttle] = None,
+                 chunk_threshold: int = 0,
+                 profiler: Optional[Profiler] = None,
+                 digests: Optional[DigestCache] = None) -> None:
+        """Constructor for FileReader.
+
+        If chunk_threshold is positive, files of at least this size
+        get per-chunk checksums as well (see chunked()). If a digest
+        cache is given, the checksums are remembered per inode, so
+        that a file seen under several paths (e.g. through the roots
+        of a batch run) is only read once.
+
+        """
+        self.profiler = profiler
+        self.digests = digests
+        self.preserve_cache = preserve_cache
+        self.chunk_threshold = chunk_threshold
+        self.throttle = throttle if throttle is not None else Throttle()
+        self._noatime = getattr(os, "O_NOATIME", 0)
+        self.deferred: 'collections.OrderedDict[str, None]' = \
+            collections.OrderedDict()
+        self.inodelocks: Dict[InodeKey, List[Any]] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def inodelock(self, key: InodeKey) -> Iterator[None]:
+        """Serialises the checksumming of an inode (see digests).
+
+        The locks are counted, and only kept while in use, so that
+        they don't accumulate for all the inodes seen.
+
+        """
+        with self.lock:
+            entry = self.inodelocks.get(key, None)
+            if entry is None:
+                entry = self.inodelocks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.inodelocks[key]
+
+    def _opener(self, path: str, flags: int) -> int:
+        """Opens a file, without updating its access time if possible."""
+        if self._noatime:
+            try:
+                return os.open(path, flags | self._noatime)
+            except PermissionError:
+                # O_NOATIME is only allowed for the file's owner
+                pass
+        return os.open(path, flags)
+
+    @classmethod
+    def _getlibc(cls) -> Optional[ctypes.CDLL]:
+        """Returns the C library, if it can be used for mincore."""
+        if cls._libc is None:
+            name = ctypes.util.find_library("c")
+            if name is None:  # pragma: no cover
+                return None
+            libc = ctypes.CDLL(name, use_errno=True)
+            libc.mmap.restype = ctypes.c_void_p
+            libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                  ctypes.c_int, ctypes.c_int,
+                                  ctypes.c_int, ctypes.c_long]
+            libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                     ctypes.c_void_p]
+            cls._libc = libc
+        return cls._libc
+
+    @classmethod
+    def cached(cls, fd: int, size: int) -> bool:
+        """Checks whether any part of a file is in the page cache."""
+        libc = cls._getlibc()
+        if libc is None or size == 0:  # pragma: no cover
+            return False
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            return False
+        try:
+            pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            vec = (ctypes.c_ubyte * pages)()
+            if libc.mincore(addr, size, vec) != 0:  # pragma: no cover
+                return False
+            return any(bytes(vec))
+        finally:
+            libc.munmap(addr, size)
+
+    @contextlib.contextmanager
+    def open(self, path: str, keep: bool = False) -> Iterator[BinaryIO]:
+        """Opens a file for reading its contents.
+
+        If keep is set, dropping the file from the page cache (see
+        preserve_cache) is deferred until it is opened again, or
+        released.
+
+        """
+        self.throttle.file()
+        if not self.preserve_cache:
+            with open(path, "rb") as fh:
+                yield cast(BinaryIO, fh)
+            return
+        with open(path, "rb", opener=self._opener) as fh:
+            fd = fh.fileno()
+            with self.lock:
+                deferred = path in self.deferred
+                self.deferred.pop(path, None)
+            # a deferred file is cached by our own previous read
+            drop = deferred or not self.cached(fd, os.fstat(fd).st_size)
+            if HAVE_FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            try:
+                yield cast(BinaryIO, fh)
+            finally:
+                if drop and HAVE_FADVISE:
+                    if keep:
+                        self._defer(path)
+                    else:
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _defer(self, path: str) -> None:
+        """Defers dropping a file from the page cache.
+
+        At most DEFERRED_DROPS files are kept; beyond that, the oldest
+        ones are dropped right away.
+
+        """
+        with self.lock:
+            self.deferred[path] = None
+            expired = [self.deferred.popitem(last=False)[0]
+                       for _ in range(len(self.deferred) - DEFERRED_DROPS)]
+        for old in expired:
+            self._drop(old)
+
+    @staticmethod
+    def _drop(path: str) -> None:
+        """Drops a file from the page cache."""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def release(self, path: str) -> None:
+        """Drops a file from the page cache, if this was deferred.
+
+        This is for the files which were checksummed, but which won't
+        be read again.
+
+        """
+        with self.lock:
+            if path not in self.deferred:
+                return
+            del self.deferred[path]
+        self._drop(path)
+
+    def chunked(self, path: str, chunksize: int,
+                expected: Optional[List[str]] = None
+                ) -> Tuple[Optional[str], List[str]]:
+        """Computes the checksums of a file and of each of its chunks.
+
+        Returns the checksum of the whole file and the list of chunk
+        checksums. If the expected chunk checksums are given, reading
+        stops at the first chunk which doesn't match them, in which
+        case the whole file checksum is returned as None.
+
+        """
+        checksum = hashlib.sha512()
+        chunks: List[str] = []
+        buf = bytearray(min(HASH_BUFSIZE, chunksize))
+        view = memoryview(buf)
+        with self.open(path, keep=True) as fh:
+            while True:
+                chunk = hashlib.sha512()
+                left = chunksize
+                while left > 0:
+                    cnt = fh.readinto(view[:left])  # type: ignore
+                    if not cnt:
+                        break
+                    self.throttle.data(cnt)
+                    checksum.update(view[:cnt])
+                    chunk.update(view[:cnt])
+                    left -= cnt
+                if left == chunksize:
+                    break
+                chunks.append(chunk.hexdigest())
+                if expected is not None and \
+                   (len(chunks) > len(expected) or
+                        chunks[-1] != expected[len(chunks) - 1]):
+                    return (None, chunks)
+                if left > 0:
+                    break
+        if expected is not None and len(chunks) != len(expected):
+            return (None, chunks)
+        return (checksum.hexdigest(), chunks)
+
+    def checksum(self, path: str, size: int) -> str:
+        """Computes the checksum of a file's contents."""
+        checksum = hashlib.sha512()
+        with self.open(path, keep=True) as fh:
+            if self.preserve_cache and size >= MMAP_THRESHOLD and \
+               not self.throttle.limited:
+                try:
+                    with mmap.mmap(fh.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as mm:
+                        checksum.update(mm)
+                        self.throttle.data(len(mm))
+                    return checksum.hexdigest()
+                except ValueError:
+                    # the file is now empty
+                    pass
+            buf = bytearray(HASH_BUFSIZE)
+            view = memoryview(buf)
+            while True:
+                cnt = fh.readinto(buf)  # type: ignore
+                if not cnt:
+                    break
+                self.throttle.data(cnt)
+                checksum.update(view[:cnt])
+        return checksum.hexdigest()
+
+
+DEFAULT_READER = FileReader()
+
+
+class TarArchive(tarfile.TarFile):
+    """Tar archive writer optimised for bakonf's needs.
+
+    Compared to the plain tarfile.TarFile.add(), members are built
+    from the stat information already gathered during the scan, the
+    owner and group names are resolved only once per id, and the
+    file contents are copied in large chunks.
+
+    If the archive is written uncompressed to a regular file, the
+    contents of the members are copied by the kernel (via
+    copy_file_range or sendfile) without passing through Python.
+
+    If the index attribute is set to a list, the position of each
+    member is recorded in it, for later random access. The files are
+    read via the reader attribute.
+
+    """
+    index: Optional[List[IndexEntry]] = None
+    reader: FileReader = DEFAULT_READER
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._unames: Dict[int, str] = {}
+        self._gnames: Dict[int, str] = {}
+        self._links: Dict[Tuple[int, int], str] = {}
+        self._use_cfr = HAVE_COPY_FILE_RANGE
+        self._use_sendfile = HAVE_SENDFILE
+        self._zerocopy = self._canzerocopy()
+
+    def _canzerocopy(self) -> bool:
+        """Checks whether the archive is a plain, regular file."""
+        if not isinstance(self.fileobj, io.BufferedWriter):
+            return False
+        if not (self._use_cfr or self._use_sendfile):
+            return False
+        try:
+            st = os.fstat(self.fileobj.fileno())
+        except (OSError, io.UnsupportedOperation):
+            return False
+        return stat.S_ISREG(st.st_mode)
+
+    def _uname(self, uid: int) -> str:
+        """Returns the (cached) user name for an uid."""
+        name = self._unames.get(uid, None)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = ""
+            self._unames[uid] = name
+        return name
+
+    def _gname(self, gid: int) -> str:
+        """Returns the (cached) group name for a gid."""
+        name = self._gnames.get(gid, None)
+        if name is None:
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except KeyError:
+                name = ""
+            self._gnames[gid] = name
+        return name
+
+    def buildinfo(self, arcname: str,
+                  si: 'StatInfo') -> Optional[tarfile.TarInfo]:
+        """Builds a TarInfo object from a StatInfo.
+
+        This is the equivalent of tarfile.TarFile.gettarinfo(), but
+        without any file system access. Returns None for file types
+        which can't be archived (e.g. sockets).
+
+        """
+        mode = si.mode
+        linkname = ""
+        size = 0
+        if stat.S_ISREG(mode):
+            inode = (si.ino, si.dev)
+            if si.nlink > 1 and inode in self._links and \
+               arcname != self._links[inode]:
+                ftype = tarfile.LNKTYPE
+                linkname = self._links[inode]
+            else:
+                ftype = tarfile.REGTYPE
+                size = si.size
+        elif stat.S_ISDIR(mode):
+            ftype = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            ftype = tarfile.SYMTYPE
+            linkname = si.lnkdest
+        elif stat.S_ISFIFO(mode):
+            ftype = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(mode):
+            ftype = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            ftype = tarfile.BLKTYPE
+        else:
+            return None
+        ti = self.tarinfo(arcname.lstrip("/"))
+        ti.mode = mode
+        ti.uid = si.user
+        ti.gid = si.group
+        ti.uname = self._uname(si.user)
+        ti.gname = self._gname(si.group)
+        ti.size = size
+        ti.mtime = si.mtime
+        ti.type = ftype
+        ti.linkname = linkname
+        if ftype in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            ti.devmajor = os.major(si.rdev)
+            ti.devminor = os.minor(si.rdev)
+        return ti
+
+    def _kernelcopy(self, src: int, dst: int, pos: int, size: int) -> int:
+        """Copies data between two file descriptors inside the kernel.
+
+        The data is read from offset zero of src and written at
+        offset pos of dst. Returns the amount of data copied, which
+        can be less than size in case the file has shrunk or if the
+        kernel refuses to do the copy; in the latter case, the
+        respective method is disabled for the rest of the archive.
+
+        """
+        throttle = self.reader.throttle
+        # when limited, copy in chunks so that the budget is enforced
+        step = COPY_BUFSIZE if throttle.limited else size
+        done = 0
+        while done < size and self._use_cfr:
+            try:
+                cnt = os.copy_file_range(
+                    src, dst, min(size - done, step),
+                    offset_src=done, offset_dst=pos + done)
+            except OSError as err:
+                if err.errno not in _ZEROCOPY_ERRORS:
+                    raise
+                logging.debug("copy_file_range failed (%s), falling back",
+                              err)
+                self._use_cfr = False
+                break
+            if not cnt:
+                return done
+            throttle.data(cnt)
+            done += cnt
+        if done < size and self._use_sendfile:
+            os.lseek(dst, pos + done, os.SEEK_SET)
+        while done < size and self._use_sendfile:
+            try:
+                cnt = os.sendfile(dst, src, done, min(size - done, step))
+            except OSError as err:
+                if err.errno not in _ZEROCOPY_ERRORS:
+                    raise
+                logging.debug("sendfile failed (%s), falling back", err)
+                self._use_sendfile = False
+                break
+            if not cnt:
+                return done
+            throttle.data(cnt)
+            done += cnt
+        return done
+
+    def _copydata(self, fh: BinaryIO, size: int) -> None:
+        """Copies exactly size bytes from a file into the archive.
+
+        If the file has shrunk since it was examined, the missing data
+        is replaced by zeros so that the archive stays consistent.
+        In-memory contents (the generated lists and the command outputs,
+        which are accounted when captured) don't use the read budget.
+
+        """
+        left = size
+        inmemory = isinstance(fh, BytesIO)
+        if self._zerocopy and (self._use_cfr or self._use_sendfile) and \
+           not inmemory:
+            out = cast(io.BufferedWriter, self.fileobj)
+            out.flush()
+            pos = out.tell()
+            done = self._kernelcopy(fh.fileno(), out.fileno(), pos, size)
+            out.seek(pos + done)
+            fh.seek(done)
+            left -= done
+        while left > 0:
+            data = fh.read(min(left, COPY_BUFSIZE))
+            if not data:
+                logging.warning("File '%s' shrunk while being archived,"
+                                " padding with zeros",
+                                getattr(fh, "name", "?"))
+                self._write(tarfile.NUL * left)
+                break
+            if not inmemory:
+                self.reader.throttle.data(len(data))
+            self._write(data)
+            left -= len(data)
+
+    def _write(self, data: bytes) -> None:
+        """Writes data to the archive.
+
+        Errors are converted to ArchiveWriteError, so that they can be
+        distinguished from errors while reading the archived files.
+
+        """
+        try:
+            self.fileobj.write(data)
+        except EnvironmentError as err:
+            raise ArchiveWriteError(str(err)) from err
+
+    def writemember(self, tarinfo: tarfile.TarInfo,
+                    fh: Optional[BinaryIO] = None) -> None:
+        """Writes a member header and its data (if any) to the archive."""
+        fobj: Any = self.fileobj
+        if isinstance(fobj, VolumeWriter):
+            fobj.checkpoint()
+            fobj.manifest.append((tarinfo.name, fobj.volume))
+        if isinstance(fobj, BlockCompressor):
+            fobj.checkpoint()
+        if self.index is not None:
+            if isinstance(fobj, BlockCompressor):
+                block_offset, block_start = fobj.block_offset, fobj.block_start
+            else:
+                block_offset = block_start = self.offset
+            # names are stored as they will be read back by tarfile
+            self.index.append(IndexEntry(tarinfo.name.rstrip("/"),
+                                         self.offset,
+                                         block_offset, block_start,
+                                         tarinfo.size, ""))
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self._write(buf)
+        self.offset += len(buf)
+        if fh is not None and tarinfo.size > 0:
+            self._copydata(fh, tarinfo.size)
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                self._write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            self.offset += blocks * tarfile.BLOCKSIZE
+
+    def addfile(self, tarinfo: tarfile.TarInfo,
+                fileobj: Optional[Any] = None) -> None:
+        """Adds a TarInfo object (and its data) to the archive."""
+        self.writemember(tarinfo, fileobj)
+
+    def addpath(self, path: str, arcname: str,
+                si: Optional['StatInfo'] = None) -> None:
+        """Adds a single (non-recursive) file system path to the archive.
+
+        If the stat information is not given, the path will be
+        examined now. Errors while reading the file are raised as
+        EnvironmentError, before anything is written to the archive.
+
+        """
+        if self.name is not None and os.path.abspath(path) == self.name:
+            logging.debug("Skipping the archive itself")
+            return
+        if si is None:
+            si = StatInfo.FromFile(path)
+        if isinstance(self.fileobj, VolumeWriter) and \
+           self.fileobj.checkpoint():
+            # hard links can only refer to members of the same volume
+            self._links.clear()
+        ti = self.buildinfo(arcname, si)
+        if ti is None:
+            logging.debug("Skipping unsupported file type for '%s'", path)
+            return
+        if ti.isreg():
+            fobj: Any = self.fileobj
+            bypass = isinstance(fobj, AdaptiveCompressor) and \
+                ti.size >= AUTO_MIN_SAMPLE and precompressed(path)
+            with self.reader.open(path) as fh:
+                if bypass:
+                    fobj.bypass(True)
+                try:
+                    self.writemember(ti, fh)
+                finally:
+                    if bypass:
+                        fobj.bypass(False)
+            if si.nlink > 1:
+                self._links[(si.ino, si.dev)] = ti.name
+        else:
+            self.writemember(ti)
+
 
 # Type alias
-Archive = tarfile.TarFile
+Archive = TarArchive
 
 
 Stats = collections.namedtuple(
     "Stats", "filename file_count file_errors cmd_count cmd_errors")
 
+# Why a path was selected for backup: it's not in the state database
+# (or there is none, for level 0 backups), it changed since the level
+# 0 backup, or it's the parent directory of a selected path
+SELECT_NEW = "new"
+SELECT_CHANGED = "changed"
+SELECT_PARENT = "parent"
+
+Selection = collections.namedtuple(
+    "Selection", "path statinfo digest reason")
+
 
 def ensure_text(val: AnyStr) -> str:
     """Ensure a string/bytes/unicode object is a 'text' object."""
@@ -125,6 +1487,58 @@ def storefakefile(archive: Archive, contents: AnyStr, name: str) -> None:
     archive.addfile(ff, sio)
 
 
+T = TypeVar("T")
+
+
+def prefetch(source: Iterable[T], depth: int) -> Iterator[T]:
+    """Iterates over source in a background thread.
+
+    The items produced by the source are passed via a bounded queue of
+    the given depth, so that the work done by the source (e.g. the
+    file system scan) overlaps with the work done by the consumer
+    (e.g. the archiving). Exceptions raised by the source are
+    re-raised in the consumer. If the consumer stops early, the
+    background thread is stopped as well.
+
+    """
+    items: 'queue.Queue[Tuple[bool, Any]]' = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(entry: Tuple[bool, Any]) -> None:
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def producer() -> None:
+        try:
+            for item in source:
+                put((True, item))
+                if stop.is_set():
+                    return
+            put((False, None))
+        except BaseException as err:  # pylint: disable=broad-except
+            put((False, err))
+
+    thread = threading.Thread(target=producer, name="bakonf-prefetch",
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            (valid, item) = items.get()
+            if valid:
+                yield item
+            elif item is None:
+                break
+            else:
+                raise item
+    finally:
+        stop.set()
+        thread.join()
+
+
 class Error(Exception):
     """Basic exception type."""
     def __init__(self, error: str) -> None:
@@ -135,6 +1549,12 @@ class Error(Exception):
         return str(self.error)
 
 
+class ArchiveWriteError(Error):
+    """Exception for errors while writing the archive itself."""
+    def __str__(self) -> str:
+        return "Error writing the archive: %s" % self.error
+
+
 class ConfigurationError(Error):
     """Exception for invalid configuration files."""
     def __init__(self, filename: str, error: str) -> None:
@@ -148,13 +1568,21 @@ class ConfigurationError(Error):
 class StatInfo:
     """Holds stat-related attributes for an inode."""
     def __init__(self, mode: int, user: int, group: int,
-                 size: int, mtime: float, lnkdest: str) -> None:
+                 size: int, mtime: float, lnkdest: str,
+                 dev: int = 0, ino: int = 0, nlink: int = 1,
+                 rdev: int = 0) -> None:
         self.mode = mode
         self.user = user
         self.group = group
         self.size = size
         self.mtime = mtime
         self.lnkdest = lnkdest
+        # The following are not serialised, and as such are only
+        # valid for physical files.
+        self.dev = dev
+        self.ino = ino
+        self.nlink = nlink
+        self.rdev = rdev
 
     @staticmethod
     def FromFile(path: str) -> 'StatInfo':
@@ -166,7 +1594,9 @@ class StatInfo:
             lnkdest = ""
         return StatInfo(st.st_mode, st.st_uid,
                         st.st_gid, st.st_size,
-                        st.st_mtime, lnkdest)
+                        st.st_mtime, lnkdest,
+                        st.st_dev, st.st_ino,
+                        st.st_nlink, st.st_rdev)
 
 
 class FileState:
@@ -180,23 +1610,30 @@ class FileState:
     compare.
 
     """
-    __slots__ = ('name', 'statinfo', 'virtual', '_checksum')
+    __slots__ = ('name', 'statinfo', 'virtual', '_checksum', 'reader',
+                 '_chunks')
 
     statinfo: Optional[StatInfo]
     _checksum: Optional[str]
 
     def __init__(self,
                  filename: Optional[str] = None,
-                 serialdata: Optional[str] = None) -> None:
+                 serialdata: Optional[str] = None,
+                 reader: FileReader = DEFAULT_READER,
+                 statinfo: Optional[StatInfo] = None) -> None:
         """Initialize the members of this instance.
 
         Either the filename or the serialdata must be given, as
         keyword arguments. If the filename is given, create a
-        FileState representing a physical file. If the serialdata is
-        given, create a virtual file with values unserialized from the
-        given data.
+        FileState representing a physical file, whose contents will
+        be read via the given reader; its stat information can be
+        passed in, if already known. If the serialdata is given,
+        create a virtual file with values unserialized from the given
+        data.
 
         """
+        self.reader = reader
+        self._chunks: Optional[Tuple[int, List[str]]] = None
         if filename is not None and serialdata is not None:
             raise ValueError("Invalid invocation of constructor "
                              "- give either filename or serialdata")
@@ -204,29 +1641,35 @@ class FileState:
         if filename is not None:
             # This means a physical file
             self.name = filename
-            self._readdisk()
+            self._readdisk(statinfo)
         elif serialdata is not None:
             self.unserialize(serialdata)
         else:
             raise ValueError("Invalid invocation of constructor "
                              "- give either filename or serialdata")
 
-    def _readdisk(self) -> None:
+    def _readdisk(self, statinfo: Optional[StatInfo] = None) -> None:
         """Read the state from disk.
 
-        Updates the members with values from disk (os.lstat).  For all
-        types, read mode, uid, gid, size, mtime.  For symbolic links,
-        also read the link target.
+        Updates the members with values from disk (os.lstat), unless
+        given.  For all types, read mode, uid, gid, size, mtime.  For
+        symbolic links, also read the link target.
 
         """
         self.virtual = False
         self._checksum = None
+        if statinfo is not None:
+            self.statinfo = statinfo
+            return
+        start = time.monotonic()
         try:
             self.statinfo = StatInfo.FromFile(self.name)
         except (OSError, IOError) as err:
             logging.error("Cannot stat '%s', will force backup: %s",
                           self.name, err)
             self.statinfo = None
+        if self.reader.profiler is not None:
+            self.reader.profiler.add(PROF_STAT, self.name, start)
 
     def _readchecksum(self) -> None:
         """Compute the checksum of the file's contents."""
@@ -235,16 +1678,38 @@ class FileState:
            not stat.S_ISREG(self.statinfo.mode):
             self._checksum = ""
         else:
-            try:
-                checksum = hashlib.sha512()
-                with open(self.name, "rb") as fh:
-                    data = fh.read(65535)
-                    while data:
-                        checksum.update(data)
-                        data = fh.read(65535)
-                self._checksum = checksum.hexdigest()
-            except IOError:
-                self._checksum = ""
+            cache = self.reader.digests
+            sinfo = self.statinfo
+            if cache is None or not sinfo.ino:
+                self._computechecksum(sinfo.size)
+                return
+            key = (sinfo.dev, sinfo.ino, sinfo.size, sinfo.mtime)
+            # the cache is shared by concurrent scans, which wait for
+            # each other so that an inode is only read once
+            with self.reader.inodelock(key):
+                if key in cache:
+                    (self._checksum, self._chunks) = cache[key]
+                    return
+                self._computechecksum(sinfo.size)
+                if self._checksum:
+                    cache[key] = (self._checksum, self._chunks)
+
+    def _computechecksum(self, size: int) -> None:
+        """Reads the file, computing its checksum (and chunks')."""
+        start = time.monotonic()
+        try:
+            threshold = self.reader.chunk_threshold
+            if 0 < threshold <= size:
+                (checksum, chunks) = self.reader.chunked(self.name,
+                                                         CHUNK_SIZE)
+                self._checksum = checksum
+                self._chunks = (CHUNK_SIZE, chunks)
+            else:
+                self._checksum = self.reader.checksum(self.name, size)
+        except IOError:
+            self._checksum = ""
+        if self.reader.profiler is not None:
+            self.reader.profiler.add(PROF_CHECKSUM, self.name, start)
 
     def __eq__(self, other: Any) -> Any:
         """Compare this entry with another one, usually for the same file.
@@ -276,11 +1741,60 @@ class FileState:
             return a.lnkdest == b.lnkdest
         elif stat.S_ISREG(a.mode) and stat.S_ISREG(a.mode):
             # Both files are regular files
-            return a.size == b.size and \
-                self.checksum == other.checksum
+            return a.size == b.size and self._samecontents(other)
         else:
             return False
 
+    def share(self, other: 'FileState') -> None:
+        """Reuses the checksums of another link to the same inode."""
+        # pylint: disable=W0212
+        self._checksum = other.checksum
+        self._chunks = other._chunks
+
+    def _samecontents(self, other: 'FileState') -> bool:
+        """Compares the contents of a physical and a virtual file.
+
+        If the virtual file has per-chunk checksums, the physical file
+        is read chunk by chunk, stopping at the first mismatch.
+
+        """
+        # pylint: disable=W0212
+        (virt, phys) = (self, other) if self.virtual else (other, self)
+        if virt._chunks is not None and phys._checksum is None:
+            (chunksize, expected) = virt._chunks
+            start = time.monotonic()
+            try:
+                (checksum, chunks) = phys.reader.chunked(phys.name,
+                                                         chunksize,
+                                                         expected)
+            except IOError:
+                phys._checksum = ""
+                return False
+            finally:
+                if phys.reader.profiler is not None:
+                    phys.reader.profiler.add(PROF_CHECKSUM, phys.name, start)
+            if checksum is None:
+                logging.debug("File '%s' differs in chunk %d", phys.name,
+                              len(chunks) - 1)
+                return False
+            phys._checksum = checksum
+            phys._chunks = (chunksize, chunks)
+        return self.checksum == other.checksum
+
+    def samestat(self, other: 'FileState') -> bool:
+        """Checks whether two files have the same stat information.
+
+        This compares the type, permissions, owner, size, modification
+        time and link target, but not the contents.
+
+        """
+        a = self.statinfo
+        b = other.statinfo
+        if a is None or b is None:
+            return False
+        return (a.mode, a.user, a.group, a.size, a.mtime, a.lnkdest) == \
+            (b.mode, b.user, b.group, b.size, b.mtime, b.lnkdest)
+
     def __ne__(self, other: Any) -> bool:
         """Reflexive function for __eq__."""
         return not self == other
@@ -327,14 +1841,21 @@ class FileState:
         out += "%s\0" % mtime
         out += "%s\0" % lnkdest
         out += "%s" % self.checksum
+        if self._chunks is not None:
+            out += "\0%d:%s" % (self._chunks[0], ",".join(self._chunks[1]))
 
         return out
 
     def unserialize(self, text: str) -> None:
         """Decode the file state from a string"""
         # If the following raises ValueError, the parent must! catch it
+        fields = text.split('\0')
+        if len(fields) == 9:
+            # per-chunk checksums are present
+            (s_chunksize, s_chunks) = fields.pop().split(":", 1)
+            self._chunks = (int(s_chunksize), s_chunks.split(","))
         (name, s_mode, user, group, s_size, s_mtime, lnkdest, checksum) \
-            = text.split('\0')
+            = fields
         mode = int(s_mode)
         size = int(s_size)
         mtime = float(s_mtime)
@@ -356,17 +1877,24 @@ class SubjectFile:
     physical: FileState
     virtual: Optional[FileState]
 
-    def __init__(self, name: str, virtualdata: Optional[str] = None) -> None:
+    def __init__(self, name: str, virtualdata: Optional[str] = None,
+                 physical: Optional[FileState] = None,
+                 reader: FileReader = DEFAULT_READER,
+                 quick: bool = False) -> None:
         """Constructor for the SubjectFile.
 
-        Creates a physical member based on the given filename. If
-        virtualdata is also given, create a virtual member based on
-        that data; otherwise, the file will always be selected for
-        backup.
+        Creates a physical member based on the given filename (unless
+        already given). If virtualdata is also given, create a virtual
+        member based on that data; otherwise, the file will always be
+        selected for backup. If quick is set, files with unchanged
+        stat information are assumed to be unchanged, without reading
+        their contents.
 
         """
         self.name = name
-        self.physical = FileState(filename=name)
+        if physical is None:
+            physical = FileState(filename=name, reader=reader)
+        self.physical = physical
         if virtualdata is not None:
             try:
                 self.virtual = FileState(serialdata=virtualdata)
@@ -376,7 +1904,9 @@ class SubjectFile:
                 self._backup = True
                 self.virtual = None
             else:
-                self._backup = self.virtual != self.physical
+                self._backup = not (quick and
+                                    self.virtual.samestat(physical)) and \
+                    self.virtual != self.physical
         else:
             self._backup = True
             self.virtual = None
@@ -397,110 +1927,439 @@ class SubjectFile:
         return self.physical.serialize()
 
 
-class FileManager:
-    """Class which deals with overall issues of selecting files
-    for backup.
-
-    An instance is created by giving it the desired options (see the
-    constructor). Afterwards, the checksources() method will create
-    the filelist.
+class IOScheduler:
+    """Reads the contents of files in disk order.
 
-    Other data members are subjects, which holds associations between
-    filenames and the SubjectFile instances, useful for later updating
-    the database, and errorlist, which contains tuples (filename,
-    error string) with files which could not be backed up. The list
-    scanned is a list which contains already-processed names, so that
-    we don't double-add to the archive.
+    The given files are grouped by device, and each device's files are
+    checksummed by a separate worker, sorted by inode number or by the
+    physical location of their first extent (if the file system
+    supports FIEMAP). This avoids most seeks on rotating disks with a
+    cold cache; the contents are then (usually) still in the page
+    cache when the files are archived.
 
     """
-    __slots__ = ('scanlist', 'excludelist', 'errorlist', 'statedb',
-                 'backuplevel', 'subjects', 'scanned',
-                 'filelist', 'memberlist', 'maxsize')
-
-    def __init__(self,
-                 scanlist: List[str],
-                 excludelist: List[str],
-                 statefile: str,
-                 backuplevel: int,
-                 maxsize: int) -> None:
-        """Constructor for class FileManager."""
-        self.scanlist = scanlist
-        self.excludelist = [re.compile(i) for i in excludelist]
-        statefile = os.path.abspath(statefile)
-        self.excludelist.append(re.compile("^%s$" % statefile))
-        self.maxsize = maxsize
-        self.errorlist: List[Tuple[str, str]] = []
-        self.filelist: List[str] = []
-        self.subjects: Dict[str, SubjectFile] = {}
-        self.scanned: List[str] = []
-        if backuplevel == 0:
-            mode = "n"
-        elif backuplevel == 1:
-            mode = "r"
-        else:
-            raise ValueError("Unknown backup level %u" % backuplevel)
-        self.backuplevel = backuplevel
-        self.statedb = bsddb3.hashopen(statefile, mode)
-        if backuplevel == 0:
-            self._dbput(DBKEY_VERSION, DB_VERSION)
-            self._dbput(DBKEY_DATE, str(time.time()))
-        else:
-            for check in (DBKEY_VERSION, DBKEY_DATE):
-                if not self._dbhas(check):
-                    raise ConfigurationError(statefile,
-                                             "Invalid database contents!")
-            currvers = self._dbget(DBKEY_VERSION)
-            if currvers != DB_VERSION:
-                raise ConfigurationError(statefile,
-                                         "Invalid database version '%s'" %
-                                         currvers)
-            dbtime_val = self._dbget(DBKEY_DATE)
-            if dbtime_val is not None:
-                dbtime = float(dbtime_val)
-                if time.time() - dbtime > 8 * 86400:
-                    logging.warning("Database is more than 8 days old!")
-            else:
-                logging.warning("Database missing timestamp,"
-                                " might be very old!")
+    def __init__(self, order: str) -> None:
+        """Constructor for IOScheduler."""
+        self.order = order
+        # the files queued by the FileManager, with their stat
+        # information (if already read)
+        self.pending: List[Tuple[str, Optional[StatInfo]]] = []
 
-    def _dbput(self, key: str, value: str) -> None:
-        """Add/replace an entry in the virtuals database.
+    @staticmethod
+    def extent(path: str) -> Optional[int]:
+        """Returns the physical offset of a file's first extent.
 
-        This is just small wrapper that abstracts this operations, so
-        in case we need to change the implementation there is only one
-        point of change.
+        Returns None if this cannot be determined.
 
         """
-        bkey = key.encode(ENCODING)
-        self.statedb[bkey] = value.encode(ENCODING)
+        buf = bytearray(_FIEMAP_REQ.size + _FIEMAP_EXTENT.size)
+        _FIEMAP_REQ.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+        mapped = _FIEMAP_REQ.unpack_from(buf, 0)[3]
+        if mapped == 0:
+            return None
+        physical: int = _FIEMAP_EXTENT.unpack_from(buf, _FIEMAP_REQ.size)[1]
+        return physical
+
+    def _key(self, fstate: FileState) -> Tuple[int, int]:
+        """Returns the read order key of a file."""
+        si = fstate.statinfo
+        assert si is not None
+        if self.order == READ_ORDER_EXTENT:
+            physical = self.extent(fstate.name)
+            if physical is not None:
+                return (0, physical)
+        return (1, si.ino)
+
+    def _worker(self, states: List[FileState]) -> None:
+        """Reads the checksums of one device's files."""
+        for fstate in sorted(states, key=self._key):
+            _ = fstate.checksum
+
+    def run(self, states: Iterable[FileState]) -> None:
+        """Computes the checksums of the given files."""
+        bydev: Dict[int, List[FileState]] = {}
+        for fstate in states:
+            si = fstate.statinfo
+            if si is not None and stat.S_ISREG(si.mode):
+                bydev.setdefault(si.dev, []).append(fstate)
+        if len(bydev) <= 1:
+            for group in bydev.values():
+                self._worker(group)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(bydev)) as pool:
+            for _ in pool.map(self._worker, bydev.values()):
+                pass
 
-    def _dbget(self, key: str) -> Optional[str]:
-        """Get and entry from the virtuals database.
 
-        This is just small wrapper that abstracts this operations, so
-        in case we need to change the implementation there is only one
-        point of change.
+class StateDB:
+    """Wrapper over the state database.
 
-        """
-        bkey = key.encode(ENCODING)
-        if bkey in self.statedb:
-            value: Optional[str] = self.statedb[bkey].decode(ENCODING)
-        else:
-            value = None
-        return value
+    This abstracts the operations on the database (a Berkeley DB hash
+    file, with string keys and values), so that in case we need to
+    change the implementation there is only one point of change.
 
-    def _dbhas(self, key: str) -> bool:
-        """Check if we have an entry in the virtuals database.
+    """
+    def __init__(self, path: str, mode: str) -> None:
+        """Opens the database at path, with the given bsddb3 mode.
 
-        This is just small wrapper that abstracts this operations, so
-        in case we need to change the implementation there is only one
-        point of change.
+        The database can be used from multiple threads, as the
+        accesses are serialised.
 
         """
+        self.path = path
+        self.db = bsddb3.hashopen(path, mode)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def filekey(path: str) -> str:
+        """Returns the key holding the state of a file."""
+        return "file:/%s" % (path,)
+
+    @staticmethod
+    def cmdkey(command: str, destination: str) -> str:
+        """Returns the key holding the output checksum of a command."""
+        return "cmd:/%s\0%s" % (destination, command)
+
+    def put(self, key: str, value: str) -> None:
+        """Add/replace an entry in the database."""
+        with self.lock:
+            self.db[key.encode(ENCODING)] = value.encode(ENCODING)
+
+    def get(self, key: str) -> Optional[str]:
+        """Get an entry from the database, or None if not found."""
         bkey = key.encode(ENCODING)
-        return bkey in self.statedb
+        with self.lock:
+            if bkey in self.db:
+                value: Optional[str] = self.db[bkey].decode(ENCODING)
+            else:
+                value = None
+        return value
+
+    def has(self, key: str) -> bool:
+        """Check if we have an entry in the database."""
+        with self.lock:
+            return key.encode(ENCODING) in self.db
+
+    def delete(self, key: str) -> None:
+        """Removes an entry from the database, if present."""
+        bkey = key.encode(ENCODING)
+        with self.lock:
+            if bkey in self.db:
+                del self.db[bkey]
+
+    def sync(self) -> None:
+        """Writes the changes made so far to disc."""
+        with self.lock:
+            self.db.sync()
+
+    def initialize(self) -> None:
+        """Writes the metadata of a new database."""
+        self.put(DBKEY_VERSION, DB_VERSION)
+        self.put(DBKEY_DATE, str(time.time()))
+
+    def validate(self) -> None:
+        """Checks that an existing database is usable."""
+        for check in (DBKEY_VERSION, DBKEY_DATE):
+            if not self.has(check):
+                raise ConfigurationError(self.path,
+                                         "Invalid database contents!")
+        currvers = self.get(DBKEY_VERSION)
+        if currvers != DB_VERSION:
+            raise ConfigurationError(self.path,
+                                     "Invalid database version '%s'" %
+                                     currvers)
+
+    def filekeys(self) -> List[bytes]:
+        """Returns the (raw) keys of all file entries, sorted."""
+        prefix = StateDB.filekey("").encode(ENCODING)
+        return sorted(k for k in self.db.keys() if k.startswith(prefix))
+
+    def getraw(self, key: bytes) -> bytes:
+        """Returns the raw value for a raw key."""
+        value: bytes = self.db[key]
+        return value
+
+    def close(self) -> None:
+        """Ensure database has been written to disc."""
+        self.db.close()
+        self.closed = True
+
+
+# A directory listing made by the ParallelWalker: the listing error
+# (if any), the subdirectory names, the names of the symbolic links
+# among them, the other entries' names, and the stat information (or
+# the stat error) of the non-excluded other entries
+DirListing = Tuple[Optional[OSError], List[str], Set[str], List[str],
+                   Dict[str, Any]]
+
+
+class ParallelWalker:
+    """Walks directory trees using a pool of threads.
+
+    Directories are listed, and their (non-directory) entries stat'ed,
+    by the worker threads, which also queue the subdirectories they
+    find, so that on high latency file systems many directories are
+    read at the same time. At most SCAN_WINDOW directories are read
+    ahead of the consumer; the listings are nevertheless returned in
+    the same order as a top-down os.walk would.
+
+    """
+    def __init__(self, workers: int, isexcluded: Any,
+                 profiler: Optional[Profiler] = None,
+                 pool: Optional[concurrent.futures.Executor] = None) -> None:
+        """Constructor for ParallelWalker.
+
+        The isexcluded callable is used to skip reading excluded
+        subdirectories and stat'ing excluded files; it must be thread
+        safe. The listing and stat times are recorded in the profiler,
+        if given.
+        If a pool is given, the directories are read by its workers
+        (e.g. shared between several walkers) and it's left running
+        by close().
+
+        """
+        self.profiler = profiler
+        self.shared = pool is not None
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.pool = pool
+        self.isexcluded = isexcluded
+        self.lock = threading.Lock()
+        self.budget = SCAN_WINDOW
+        self.queued: Dict[str, 'concurrent.futures.Future[DirListing]'] = {}
+
+    def __enter__(self) -> 'ParallelWalker':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stops the workers, discarding the unused listings."""
+        with self.lock:
+            self.budget = 0
+            for future in self.queued.values():
+                future.cancel()
+            self.queued.clear()
+        if not self.shared:
+            self.pool.shutdown(wait=True)
+
+    def prefetch(self, path: str) -> None:
+        """Queues the reading of a directory, if within the budget."""
+        with self.lock:
+            if self.budget <= 0 or path in self.queued:
+                return
+            self.budget -= 1
+            self.queued[path] = self.pool.submit(self._list, path)
+
+    def _get(self, path: str) -> DirListing:
+        """Returns the listing of a directory, reading it if needed."""
+        with self.lock:
+            future = self.queued.pop(path, None)
+            if future is not None:
+                self.budget += 1
+        if future is None:
+            future = self.pool.submit(self._list, path)
+        listing: DirListing = future.result()
+        return listing
+
+    def _list(self, path: str) -> DirListing:
+        """Reads a directory, queueing its subdirectories."""
+        start = time.monotonic()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as err:
+            return (err, [], set(), [], {})
+        finally:
+            if self.profiler is not None:
+                self.profiler.add(PROF_LIST, path, start)
+        dirs: List[str] = []
+        links: Set[str] = set()
+        files: List[str] = []
+        stats: Dict[str, Any] = {}
+        for entry in entries:
+            fullpath = os.path.join(path, entry.name)
+            # like os.walk, list symbolic links to directories as
+            # directories, but don't descend into them
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                dirs.append(entry.name)
+                try:
+                    islink = entry.is_symlink()
+                except OSError:
+                    islink = False
+                if islink:
+                    links.add(entry.name)
+                elif not self.isexcluded(fullpath):
+                    self.prefetch(fullpath)
+                continue
+            files.append(entry.name)
+            if self.isexcluded(fullpath):
+                continue
+            start = time.monotonic()
+            try:
+                stats[entry.name] = StatInfo.FromFile(fullpath)
+            except OSError as err:
+                stats[entry.name] = err
+            if self.profiler is not None:
+                self.profiler.add(PROF_STAT, fullpath, start)
+        return (None, dirs, links, files, stats)
+
+    def walk(self, top: str, onerror: Any = None) \
+            -> Iterator[Tuple[str, List[str], List[str], Dict[str, Any]]]:
+        """Walks a directory tree, top-down.
+
+        This yields, similar to os.walk, the directory path, the
+        subdirectory names (which can be modified to prune the walk),
+        the other entries' names and, additionally, a dictionary with
+        their stat information, or the OSError raised when stat'ing
+        them.
+
+        """
+        stack = [top]
+        while stack:
+            dpath = stack.pop()
+            (err, dirs, links, files, stats) = self._get(dpath)
+            if err is not None:
+                if onerror is not None:
+                    onerror(err)
+                continue
+            yield (dpath, dirs, files, stats)
+            stack.extend(os.path.join(dpath, name)
+                         for name in reversed(dirs) if name not in links)
+
+
+# How the file system is scanned (see FileManager): the reader of the
+# files' contents (None for the default one), the read order, the
+# number of scan workers and the thread pool they use (None for a
+# private one), the root the exclusions are relative to, and whether
+# an interrupted level 0 backup is resumed or the state database is
+# updated.
+ScanOptions = collections.namedtuple(
+    "ScanOptions", "reader readorder workers pool root resuming updating")
+
+DEFAULT_SCAN = ScanOptions(None, READ_ORDER_WALK, 0, None, None, False, False)
+
+
+class FileManager:
+    """Class which deals with overall issues of selecting files
+    for backup.
+
+    An instance is created by giving it the desired options (see the
+    constructor). Afterwards, the checksources() method will create
+    the filelist.
+
+    Other data members are subjects, which holds associations between
+    filenames and the SubjectFile instances, useful for later updating
+    the database, and errorlist, which contains tuples (filename,
+    error string) with files which could not be backed up. The set
+    scanned contains already-processed names, so that we don't
+    double-add to the archive.
+
+    The selection can also be consumed incrementally, via the
+    iterselected() generator, which yields the paths to be archived
+    (in archive order) as soon as they have been decided. If more
+    than one scan worker is requested, the directories are read in
+    parallel, but the selection order doesn't change. The scan is
+    tuned via the ScanOptions given to the constructor.
+
+    """
+    __slots__ = ('scanlist', 'excludelist', 'errorlist', 'statedb',
+                 'backuplevel', 'subjects', 'scanned',
+                 'filelist', 'listed', 'maxsize', 'scheduler',
+                 'inodes', 'current', 'statefile', 'options')
+
+    def __init__(self,
+                 scanlist: List[str],
+                 excludelist: Iterable[Union[str, Pattern[str]]],
+                 statefile: str,
+                 backuplevel: int,
+                 maxsize: int,
+                 options: ScanOptions = DEFAULT_SCAN) -> None:
+        """Constructor for class FileManager.
+
+        Level 0 backups write the new state database next to the
+        existing one (see commit()); if resuming, a previously
+        interrupted level 0 backup is continued, and the files already
+        recorded in its database are only archived again if their stat
+        information changed. If updating, the new database starts as
+        a copy of the existing one, and only the entries of the
+        scanned paths are updated; the files are selected as for
+        level 1 backups.
+
+        The exclusions are either regular expressions or compiled
+        patterns, which are used as they are (so that they can be
+        shared between instances). If a root is given, they are
+        matched against the paths relative to it (see the roots
+        configuration key).
+
+        """
+        if options.reader is None:
+            options = options._replace(reader=DEFAULT_READER)
+        self.options = options
+        self.scanlist = scanlist
+        self.current: Optional[str] = None
+        self.inodes: Dict[Tuple[int, int], FileState] = {}
+        self.scheduler: Optional[IOScheduler] = None
+        if options.readorder != READ_ORDER_WALK:
+            self.scheduler = IOScheduler(options.readorder)
+        self.excludelist = [re.compile(i) for i in excludelist]
+        statefile = os.path.abspath(statefile)
+        self.statefile = statefile
+        self.maxsize = maxsize
+        self.errorlist: List[Tuple[str, str]] = []
+        self.filelist: List[str] = []
+        self.listed: Set[str] = set()
+        self.subjects: Dict[str, SubjectFile] = {}
+        self.scanned: Set[str] = set()
+        if backuplevel == 0:
+            mode = "w" if options.resuming or options.updating else "n"
+            statefile += STATE_NEW_SUFFIX
+            if options.updating:
+                try:
+                    shutil.copyfile(self.statefile, statefile)
+                except EnvironmentError as err:
+                    raise Error("Can't copy the state database: %s" %
+                                err) from err
+        elif backuplevel == 1:
+            mode = "r"
+        else:
+            raise ValueError("Unknown backup level %u" % backuplevel)
+        self.backuplevel = backuplevel
+        self.statedb = StateDB(statefile, mode)
+        if backuplevel == 0 and not (options.resuming or options.updating):
+            self.statedb.initialize()
+        elif backuplevel == 0:
+            self.statedb.validate()
+        else:
+            self.statedb.validate()
+            dbtime_val = self.statedb.get(DBKEY_DATE)
+            if dbtime_val is not None:
+                dbtime = float(dbtime_val)
+                if time.time() - dbtime > 8 * 86400:
+                    logging.warning("Database is more than 8 days old!")
+            else:  # pragma: no cover
+                logging.warning("Database missing timestamp,"
+                                " might be very old!")
 
-    def _findfile(self, name: str) -> SubjectFile:
+    def _findfile(self, name: str,
+                  physical: Optional[FileState] = None) -> SubjectFile:
         """Locate a file's entry in the virtuals database.
 
         Locate the file's entry and returns a SubjectFile with these
@@ -509,9 +2368,29 @@ class FileManager:
 
         """
 
-        key = "file:/%s" % (name,)
-        virtualdata = self._dbget(key)
-        return SubjectFile(name, virtualdata)
+        if physical is None:
+            physical = FileState(filename=name, reader=self.options.reader)
+        first = self._firstlink(physical)
+        if first is not None:
+            logging.debug("Reusing checksum of '%s' for '%s'",
+                          first.name, name)
+            physical.share(first)
+        virtualdata = self.statedb.get(StateDB.filekey(name))
+        return SubjectFile(name, virtualdata, physical, self.options.reader,
+                           self.options.resuming)
+
+    def _firstlink(self, fstate: FileState) -> Optional[FileState]:
+        """Returns the state of an already seen link to the same file.
+
+        Regular files with multiple hard links are tracked by device
+        and inode number, so that their contents are read only once.
+
+        """
+        si = fstate.statinfo
+        if si is None or si.nlink < 2 or not stat.S_ISREG(si.mode):
+            return None
+        first = self.inodes.setdefault((si.dev, si.ino), fstate)
+        return first if first is not fstate else None
 
     def _ehandler(self, err: IOError) -> None:
         """Error handler for directory walk.
@@ -521,37 +2400,89 @@ class FileManager:
         logging.error("Not archiving '%s', cannot stat: '%s'.",
                       err.filename, err.strerror)
 
-    def _helper(self, dirname: str, names: List[str]) -> None:
+    def _helper(self, dirname: str, names: List[str],
+                stats: Optional[Dict[str, Any]] = None) -> Iterator[str]:
         """Helper for the scandir method.
 
         This function scans a directory's entries and processes the
-        non-dir elements found in it.
+        non-dir elements found in it. The entries' stat information
+        (or stat errors) can be given, if already read.
 
         """
-        self.scanned.append(dirname)
+        self.scanned.add(dirname)
         for basename in names:
             fullpath = os.path.join(dirname, basename)
             if self._isexcluded(fullpath):
                 logging.debug("Skipping excluded path '%s'", fullpath)
                 continue
+            statinfo: Optional[StatInfo] = None
             try:
-                statres = os.lstat(fullpath)
+                if stats is None:
+                    start = time.monotonic()
+                    try:
+                        statres = os.lstat(fullpath)
+                    finally:
+                        profiler = self.options.reader.profiler
+                        if profiler is not None:
+                            profiler.add(PROF_STAT, fullpath, start)
+                    mode = statres.st_mode
+                else:
+                    statinfo = stats[basename]
+                    if isinstance(statinfo, OSError):
+                        raise statinfo
+                    mode = statinfo.mode
             except OSError as err:
                 self._ehandler(err)
             else:
-                if stat.S_ISDIR(statres.st_mode):  # pragma: no cover
+                if stat.S_ISDIR(mode):  # pragma: no cover
                     logging.error("Directory passed to _helper")
+                elif self.scheduler is not None:
+                    self.scheduler.pending.append((fullpath, statinfo))
+                    if len(self.scheduler.pending) >= IOSCHED_WINDOW:
+                        yield from self._flushpending()
+                elif statinfo is not None:
+                    physical = FileState(filename=fullpath,
+                                         reader=self.options.reader,
+                                         statinfo=statinfo)
+                    yield from self._scanfile(fullpath, physical)
                 else:
-                    self._scanfile(fullpath)
+                    yield from self._scanfile(fullpath)
 
-    def _scandir(self, path: str) -> None:
+    def _flushpending(self) -> Iterator[str]:
+        """Examines the queued files, reading them in disk order.
+
+        The files' contents are read by the I/O scheduler, after which
+        they are examined in the original (walk) order.
+
+        """
+        assert self.scheduler is not None
+        pending, self.scheduler.pending = self.scheduler.pending, []
+        paths = [path for (path, _) in pending]
+        states = [FileState(filename=path, reader=self.options.reader,
+                            statinfo=statinfo)
+                  for (path, statinfo) in pending]
+        self.scheduler.run(
+            fs for fs in states if fs.statinfo is not None and
+            (self.maxsize <= 0 or fs.statinfo.size <= self.maxsize) and
+            self._firstlink(fs) is None)
+        for (path, fstate) in zip(paths, states):
+            yield from self._scanfile(path, fstate)
+
+    def _scandir(self, path: str,
+                 walker: Optional[ParallelWalker] = None) -> Iterator[str]:
         """Gather the files needing backup under a directory.
 
         Arguments:
         path - the directory which should be recusrively descended.
+        walker - the parallel walker to use, if any.
 
         """
-        for dpath, dnames, fnames in os.walk(path, onerror=self._ehandler):
+        if walker is None:
+            walk: Iterator[Tuple[str, List[str], List[str], Any]] = \
+                self._walk(path)
+        else:
+            walk = walker.walk(path, onerror=self._ehandler)
+        for dpath, dnames, fnames, stats in walk:
             for subdir in list(dnames):
                 fullpath = os.path.join(dpath, subdir)
                 if self._isexcluded(fullpath):
@@ -559,10 +2490,38 @@ class FileManager:
                                   "excluded directory '%s'",
                                   fullpath)
                     dnames.remove(subdir)
-            self._helper(dpath, fnames)
+            yield from self._helper(dpath, fnames, stats)
+
+    def _walk(self, path: str) \
+            -> Iterator[Tuple[str, List[str], List[str], Any]]:
+        """Walks a directory tree using os.walk.
+
+        The results are in the format of ParallelWalker.walk, without
+        the stat information. Each directory is listed while os.walk
+        is advanced to it, which is the time recorded in the profiler.
+
+        """
+        profiler = self.options.reader.profiler
+        walk = os.walk(path, onerror=self._ehandler)
+        while True:
+            start = time.monotonic()
+            try:
+                (dpath, dnames, fnames) = next(walk)
+            except StopIteration:
+                return
+            if profiler is not None:
+                profiler.add(PROF_LIST, dpath, start)
+            yield (dpath, dnames, fnames, None)
+
+    def _scanfile(self, path: str,
+                  physical: Optional[FileState] = None) -> List[str]:
+        """Examine a file for inclusion in the backup.
+
+        Returns the list of paths newly added to the file list, which
+        includes any parent directories not yet listed. The physical
+        state of the file can be given, if already read.
 
-    def _scanfile(self, path: str) -> List[str]:
-        """Examine a file for inclusion in the backup."""
+        """
         if path in self.scanned:  # pragma: no cover
             logging.error("Already scanned path passed to _scanfile: %s",
                           path)
@@ -570,34 +2529,69 @@ class FileManager:
         if self._isexcluded(path):  # pragma: no cover
             logging.error("Excluded path passed to _scanfile: %s", path)
             return []
-        self.scanned.append(path)
+        self.scanned.add(path)
+        self.current = path
         logging.debug("Examining path %s", path)
-        sf = self._findfile(path)
+        sf = self._findfile(path, physical)
         phy_size = (sf.physical.statinfo.size
                     if sf.physical.statinfo is not None else 0)
         if (self.maxsize > 0 and phy_size and
                 phy_size > self.maxsize):
             logging.warning("Skipping path %s due to size limit (%s > %s)",
                             path, phy_size, self.maxsize)
+            self.options.reader.release(path)
             return []
         elif sf.needsbackup:
             logging.debug("Selecting path %s", path)
             self.subjects[sf.name] = sf
-            FileManager.addparents(path, self.filelist)
-            return [sf.name]
+            start = len(self.filelist)
+            FileManager.addparents(path, self.filelist, self.listed)
+            return self.filelist[start:]
         else:
             logging.debug("No backup needed for %s", path)
+            self.options.reader.release(path)
             return []
 
     def _isexcluded(self, path: str) -> bool:
-        """Check to see if a path must be excluded."""
+        """Check to see if a path must be excluded.
+
+        The state database (and the one being written) is always
+        excluded.
+
+        """
+        if path in (self.statefile, self.statefile + STATE_NEW_SUFFIX):
+            return True
+        root = self.options.root
+        if root is not None and isunder(path, root):
+            path = path[len(root):] or "/"
         for mo in self.excludelist:
             if mo.match(path) is not None:
                 return True
         return False
 
-    def checksources(self) -> None:
-        """Examine the list of sources and process them."""
+    def iterselected(self) -> Iterator[str]:
+        """Examine the list of sources, yielding the selected paths.
+
+        The paths are yielded in the same order as they are added to
+        the filelist, i.e. parents before their children.
+
+        """
+        opts = self.options
+        if opts.workers <= 1:
+            yield from self._iterselected(None)
+            return
+        with ParallelWalker(opts.workers, self._isexcluded,
+                            opts.reader.profiler, opts.pool) as walker:
+            # start reading all the top-level directories right away
+            for item in self.scanlist:
+                if not self._isexcluded(item) and os.path.isdir(item) and \
+                   not os.path.islink(item):
+                    walker.prefetch(item)
+            yield from self._iterselected(walker)
+
+    def _iterselected(self,
+                      walker: Optional[ParallelWalker]) -> Iterator[str]:
+        """Implementation of iterselected, with an optional walker."""
         for item in self.scanlist:
             if self._isexcluded(item) or item in self.scanned:
                 logging.debug("Ignoring excluded or duplicated "
@@ -605,27 +2599,111 @@ class FileManager:
                 continue
             st = os.lstat(item)
             if stat.S_ISDIR(st.st_mode):
-                self._scandir(item)
+                yield from self._scandir(item, walker)
+                if self.scheduler is not None and self.scheduler.pending:
+                    yield from self._flushpending()
             else:
-                self._scanfile(item)
+                yield from self._scanfile(item)
+
+    def selections(self) -> Iterator[Selection]:
+        """Examine the list of sources, yielding the selection decisions.
+
+        This is the same as iterselected(), but it yields a Selection
+        for each path, with its stat information (None if it can't be
+        read), the checksum of its contents (None except for regular
+        files) and the reason (one of the SELECT_* constants). The
+        checksums are computed here, i.e. in the consumer's thread.
+
+        """
+        for path in self.iterselected():
+            subject = self.subjects.get(path, None)
+            if subject is None:
+                try:
+                    statinfo: Optional[StatInfo] = StatInfo.FromFile(path)
+                except OSError:
+                    statinfo = None
+                yield Selection(path, statinfo, None, SELECT_PARENT)
+                continue
+            phy = subject.physical
+            digest = None
+            if phy.statinfo is not None and stat.S_ISREG(phy.statinfo.mode):
+                digest = phy.checksum
+            reason = SELECT_NEW if subject.virtual is None else SELECT_CHANGED
+            yield Selection(path, phy.statinfo, digest, reason)
+
+    def checksources(self) -> None:
+        """Examine the list of sources and process them."""
+        for _ in self.iterselected():
+            pass
 
     @staticmethod
-    def addparents(item: str, item_lst: List[str]) -> None:
+    def addparents(item: str, item_lst: List[str],
+                   seen: Optional[Set[str]] = None) -> None:
         """Smartly insert a filename into a list.
 
         This function extracts the parents of an item and puts them in
         proper order in the given list, so that tar gets the file list
-        sorted properly. Then it adds the given filename.
+        sorted properly. Then it adds the given filename. If given,
+        the seen set is used (and updated) for fast membership tests.
 
         """
+        if seen is None:
+            seen = set(item_lst)
         base = os.path.dirname(item)
         if base == "/":
             return
-        FileManager.addparents(base, item_lst)
-        if base not in item_lst:
+        FileManager.addparents(base, item_lst, seen)
+        if base not in seen:
             item_lst.append(base)
-        if item not in item_lst:
+            seen.add(base)
+        if item not in seen:
             item_lst.append(item)
+            seen.add(item)
+
+    def deleted(self) -> List[str]:
+        """Returns the files in the database which no longer exist.
+
+        This must be called after the scan has completed. Both the
+        scanned paths and the database keys are sorted and then merged
+        in a single pass, so no additional file system access is
+        needed. Database entries which were not seen by the scan are
+        reported, unless they are outside the scanned paths, excluded,
+        or under a path which couldn't be read.
+
+        """
+        if self.backuplevel == 0 and not self.options.updating:
+            return []
+        walked = sorted(StateDB.filekey(p).encode(ENCODING)
+                        for p in self.scanned)
+        plen = len(StateDB.filekey(""))
+        errors = set(name for (name, _) in self.errorlist)
+        result = []
+        pos = 0
+        for key in self.statedb.filekeys():
+            while pos < len(walked) and walked[pos] < key:
+                pos += 1
+            if pos < len(walked) and walked[pos] == key:
+                continue
+            path = key[plen:].decode(ENCODING)
+            if self._isgone(path, errors):
+                result.append(path)
+        return result
+
+    def _isgone(self, path: str, errors: Set[str]) -> bool:
+        """Checks whether a path not seen by the scan was deleted."""
+        if not any(isunder(path, item) for item in self.scanlist):
+            return False
+        parent = path
+        while parent not in ("/", ""):
+            if parent in errors or self._isexcluded(parent):
+                return False
+            parent = os.path.dirname(parent)
+        return True
+
+    def forget(self, path: str) -> None:
+        """Removes a (deleted) file from the new state database."""
+        if self.backuplevel == 0:
+            self.statedb.delete(StateDB.filekey(path))
 
     def notifywritten(self, path: str) -> None:
         """Notify that a file has been archived.
@@ -639,67 +2717,375 @@ class FileManager:
         # If a file hasn't been found (as it is with directories), the
         # worst case is that we ignore that we backed up that file.
         if self.backuplevel == 0 and path in self.subjects:
-            self._dbput("file:/%s" % (path,), self.subjects[path].serialize())
+            self.statedb.put(StateDB.filekey(path),
+                             self.subjects[path].serialize())
+
+    def commit(self) -> None:
+        """Ensure database has been written to disc.
+
+        For level 0 backups, the new database then replaces the old
+        one; this must only be done once all the stored paths have
+        been passed to notifywritten().
+
+        """
+        if self.backuplevel == 0:
+            self.statedb.delete(DBKEY_CHECKPOINT)
+        self.statedb.close()
+        if self.backuplevel == 0:
+            os.replace(self.statedb.path, self.statefile)
 
     def close(self) -> None:
-        """Ensure database has been written to disc."""
+        """Closes the database, if not already done by commit().
+
+        For level 0 backups, the new database is then discarded, and
+        the old one kept unchanged.
 
+        """
+        if self.statedb.closed:
+            return
         self.statedb.close()
+        if self.backuplevel == 0:
+            try:
+                os.unlink(self.statedb.path)
+            except FileNotFoundError:
+                pass
+
+
+def isunder(path: str, root: str) -> bool:
+    """Checks whether a path is (or is under) the given root path."""
+    root = root.rstrip("/")
+    return path == root or path.startswith(root + "/")
+
+
+def sanitize_name(path: str) -> str:
+    """Makes sure path can be used as a plain filename.
+
+    This just replaces slashes with underscores.
+
+    """
+    path = path.replace(os.path.sep, "_")
+    if os.path.altsep is not None:  # pragma: no cover
+        path = path.replace(os.path.altsep, "_")
+    return path
+
+
+def exitstatus(status: int) -> int:
+    """Converts a wait status into a subprocess-style return code."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def spawn(argv: List[str],
+          cwd: Optional[str] = None) -> Tuple[bytes, int, float]:
+    """Runs a command, returning its output, status and launch time.
+
+    The standard input of the command is /dev/null, and its standard
+    output and error are captured together. The command is started
+    via posix_spawn if available, so that the cost of starting it
+    doesn't depend on our (possibly large) memory size. Since
+    posix_spawn can't change the child's directory, if cwd is given
+    the command is executed by a shell which changes to it first; our
+    own current directory is never changed (the shell's own messages,
+    e.g. if our directory was removed, are discarded).
+
+    """
+    if not HAVE_POSIX_SPAWN:
+        start = time.monotonic()
+        proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, cwd=cwd)
+        latency = time.monotonic() - start
+        (output, _) = proc.communicate()
+        return (output, proc.returncode, latency)
+    if cwd is not None:
+        # the command is looked up here, so that a missing one fails
+        # like with posix_spawnp, instead of making the shell fail
+        path = shutil.which(argv[0])
+        if path is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    argv[0])
+        argv = ["/bin/sh", "-c", 'cd "$0" && exec "$@" 2>&1', cwd,
+                path] + argv[1:]
+    (rfd, wfd) = os.pipe()
+    pid: Optional[int] = None
+    status = 0
+    try:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            actions = [(os.POSIX_SPAWN_DUP2, devnull, 0),
+                       (os.POSIX_SPAWN_DUP2, wfd, 1),
+                       (os.POSIX_SPAWN_DUP2,
+                        wfd if cwd is None else devnull, 2)]
+            start = time.monotonic()
+            pid = os.posix_spawnp(argv[0], argv, os.environ,
+                                  file_actions=actions)
+            latency = time.monotonic() - start
+        finally:
+            os.close(devnull)
+            os.close(wfd)
+        chunks = []
+        while True:
+            data = os.read(rfd, COPY_BUFSIZE)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        os.close(rfd)
+        # the child is reaped even if reading its output failed
+        if pid is not None:
+            (_, status) = os.waitpid(pid, 0)
+    return (b"".join(chunks), exitstatus(status), latency)
 
 
 class CmdOutput:
     """Denotes a command result to be stored in an archive.
 
     This class represents the element storeoutput in the configuration
-    file. It will store the output of a command in the archive.
+    file. It will store the output of a command in the archive. The
+    command is either a shell command line, or an argument list which
+    is executed directly.
 
     """
-    __slots__ = ('command', 'destination')
+    __slots__ = ('command', 'destination', 'argv', 'latency')
 
-    def __init__(self, command: str, destination: str) -> None:
-        """Constructor for the CmdOutput class."""
+    def __init__(self, command: str, destination: Optional[str],
+                 argv: Optional[List[str]] = None) -> None:
+        """Constructor for the CmdOutput class.
+
+        If argv is given, the command is only used for display.
+
+        """
         self.command = command
+        if argv is None:
+            argv = ["/bin/sh", "-c", command]
+        self.argv = argv
         if destination is None:
-            destination = self._sanitize_name(command)
+            destination = sanitize_name(command)
         self.destination = destination.lstrip("/")
+        self.latency: Optional[float] = None
 
-    @staticmethod
-    def _sanitize_name(path: str) -> str:
-        """Makes sure path can be used as a plain filename.
+    @classmethod
+    def FromArgv(cls, argv: List[str],
+                 destination: Optional[str]) -> 'CmdOutput':
+        """Builds a command which is executed without a shell."""
+        return cls(" ".join(shlex.quote(arg) for arg in argv),
+                   destination, argv)
 
-        This just replaces slashes with underscores.
+    def capture(self) -> Tuple[bytes, Optional[str]]:
+        """Executes my command and returns its output.
 
-        """
-        path = path.replace(os.path.sep, "_")
-        if os.path.altsep is not None:  # pragma: no cover
-            path = path.replace(os.path.altsep, "_")
-        return path
+        Returns the output and, if the command failed, the error.
 
-    def store(self, archive: Archive) -> Optional[str]:
-        """Store the output of my command in the archive."""
-        logging.debug("Executing command %s, storing output as %s",
-                      self.command, self.destination)
+        """
+        logging.debug("Executing command %s", self.command)
         err: Optional[str] = None
-        # pylint: disable=W1510
-        # because we do the error code handling ourselves.
-        child = subprocess.run(self.command, shell=True,
-                               stdin=subprocess.DEVNULL,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               cwd="/")
-        output = child.stdout
-        status = child.returncode
+        try:
+            (output, status, self.latency) = spawn(self.argv, "/")
+        except OSError as exc:
+            err = "could not be executed: %s" % exc.strerror
+            logging.warning("'%s' %s.", self.command, err)
+            return (b"", err)
         if status != 0:
             if status > 0:
                 err = "exited with status %i" % status
             else:
                 err = "was killed with signal %i" % (-status, )
             logging.warning("'%s' %s.", self.command, err)
+        return (output, err)
+
+    def storeoutput(self, archive: Archive, output: bytes) -> None:
+        """Stores the (already captured) output in the archive."""
+        logging.debug("Storing output of %s as %s", self.command,
+                      self.destination)
         name = os.path.join(CMD_PREFIX, self.destination)
         storefakefile(archive, output, name)
+
+    def store(self, archive: Archive) -> Optional[str]:
+        """Store the output of my command in the archive."""
+        (output, err) = self.capture()
+        self.storeoutput(archive, output)
         return err
 
 
+class FileCapture(CmdOutput):
+    """Denotes a pseudo-file to be stored in an archive.
+
+    This class represents an element of the pseudofiles list in the
+    configuration file: the file (usually under /proc or /sys) is read
+    directly, instead of via a command, and stored like a command
+    output. The contents are read until end-of-file, since such files
+    usually report a size of zero.
+
+    """
+    __slots__ = ()
+
+    def capture(self) -> Tuple[bytes, Optional[str]]:
+        """Reads my file and returns its contents.
+
+        Returns the contents and, if the file couldn't be (completely)
+        read, the error; in this case, the data read up to the error
+        is returned.
+
+        """
+        logging.debug("Reading pseudo-file %s", self.command)
+        chunks = []
+        err: Optional[str] = None
+        try:
+            with open(self.command, "rb", buffering=0) as fh:
+                while True:
+                    data = fh.read(COPY_BUFSIZE)
+                    if not data:
+                        break
+                    chunks.append(data)
+        except OSError as exc:
+            err = "cannot be read: %s" % exc.strerror
+            logging.warning("'%s' %s.", self.command, err)
+        return (b"".join(chunks), err)
+
+
+class Progress:
+    """Periodically writes progress records.
+
+    A separate thread samples the counters which the backup maintains
+    anyway (the throttle's and the file manager's), and writes them
+    as one JSON object per line; the backup itself only updates the
+    phase. The estimated time left is based on the number of paths
+    scanned by the previous level 0 backup, if known. Records which
+    can't be written right away (the destination is expected to be
+    non-blocking) are dropped; if writing fails (e.g. the reader went
+    away), reporting stops, but the backup continues.
+
+    """
+    def __init__(self, send: Any, interval: float, throttle: Throttle,
+                 expected: Optional[int] = None) -> None:
+        """Constructor for Progress.
+
+        The send callable is given each record, as bytes.
+
+        """
+        self.send = send
+        self.interval = interval
+        self.throttle = throttle
+        self.expected = expected
+        self.phase = PHASE_FILES
+        self.fm: Optional[FileManager] = None
+        self.donelist: List[str] = []
+        self.start = time.monotonic()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self) -> Dict[str, Any]:
+        """Builds a progress record from the current counters."""
+        elapsed = time.monotonic() - self.start
+        fm = self.fm
+        scanned = len(fm.scanned) if fm is not None else 0
+        eta: Optional[float] = None
+        if self.phase == PHASE_FILES and self.expected and scanned:
+            eta = max(elapsed * (self.expected - scanned) / scanned, 0.0)
+        elif self.phase == PHASE_DONE:
+            eta = 0.0
+        return {
+            "time": time.time(),
+            "phase": self.phase,
+            "elapsed": round(elapsed, 3),
+            "scanned": scanned,
+            "selected": len(fm.subjects) if fm is not None else 0,
+            "archived": len(self.donelist),
+            "bytes": self.throttle.nbytes,
+            "path": fm.current if fm is not None else None,
+            "rate": round(self.throttle.nbytes / max(elapsed, 1e-6)),
+            "eta": round(eta, 1) if eta is not None else None,
+        }
+
+    def _write(self) -> bool:
+        """Writes a record, returning whether it succeeded."""
+        line = json.dumps(self.record(), sort_keys=True) + "\n"
+        try:
+            self.send(line.encode(ENCODING))
+        except BlockingIOError:
+            logging.debug("Progress reader not keeping up, record dropped")
+        except OSError as err:
+            logging.warning("Cannot write progress, stopping: %s", err)
+            return False
+        return True
+
+    def _loop(self) -> None:
+        """Body of the reporting thread."""
+        while not self._stop.wait(self.interval):
+            if not self._write():
+                return
+
+    def begin(self) -> None:
+        """Starts the periodic reporting."""
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def end(self) -> None:
+        """Stops the reporting, writing a final record."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.phase = PHASE_DONE
+        self._write()
+
+
+def archiveselections(archive: Archive, selections: Iterable[Selection],
+                      donelist: List[str]) -> List[Tuple[str, str]]:
+    """Adds the selected paths to an archive.
+
+    This is the default consumer of FileManager.selections(). The
+    archived paths are appended to donelist; the paths which couldn't
+    be read are returned, together with the error message.
+
+    """
+    errors: List[Tuple[str, str]] = []
+    profiler = archive.reader.profiler
+    for sel in selections:
+        arcx = os.path.join(FS_PREFIX, sel.path.lstrip("/"))
+        start = time.monotonic()
+        try:
+            archive.addpath(sel.path, arcx, sel.statinfo)
+        except IOError as err:
+            errors.append((sel.path, err.strerror))
+            logging.error("Cannot read '%s': '%s'. Not archived.",
+                          sel.path, err.strerror)
+        else:  # Successful archiving of the member
+            donelist.append(sel.path)
+        if profiler is not None:
+            profiler.add(PROF_ARCHIVE, sel.path, start)
+    return errors
+
+
+class Budget:
+    """The resource budget and tuning settings of a backup.
+
+    These are read from the configuration file: the limits on the I/O
+    and on the compression time, the priorities, the size from which
+    files are read in chunks, and the number of roots backed up in
+    parallel.
+
+    """
+    __slots__ = ('max_read_bytes', 'max_files', 'compression_budget',
+                 'nice', 'ionice_class', 'ionice_level', 'chunk_threshold',
+                 'root_jobs')
+
+    def __init__(self) -> None:
+        """Constructor for Budget, with the default settings."""
+        self.max_read_bytes: Optional[int] = None
+        self.max_files: Optional[float] = None
+        self.compression_budget: Optional[float] = None
+        self.nice: Optional[int] = None
+        self.ionice_class: Optional[str] = None
+        self.ionice_level = 4
+        self.chunk_threshold = 0
+        self.root_jobs = ROOT_JOBS
+
+    def throttle(self) -> Throttle:
+        """Builds the throttle enforcing the I/O limits."""
+        return Throttle(self.max_read_bytes, self.max_files)
+
+
 class BackupManager:
     """Main class for this program.
 
@@ -711,15 +3097,77 @@ class BackupManager:
     fs_statefile: str
 
     def __init__(self, options: argparse.Namespace) -> None:
-        """Constructor for BackupManager."""
+        """Constructor for BackupManager.
+
+        The scan settings (see ScanOptions) hold as well the shared
+        reader and scan pool of the roots, if any.
+
+        """
         self.options = options
+        self.roots: List[Tuple[str, str]] = []
+        self.scan = DEFAULT_SCAN
+        self.budget = Budget()
+        self.fs_patterns: List[str] = []
         self.fs_include: List[str] = []
-        self.fs_exclude: List[str] = []
+        self.fs_exclude: List[Pattern[str]] = []
         self.fs_maxsize: int = -1
+        self.throttle = Throttle()
         self.cmd_outputs: List[CmdOutput] = []
-        self.fs_donelist: List[str] = []
+        self.reset()
         self._parseconf(options.configfile)
 
+    def reset(self) -> None:
+        """Resets the state of the run, e.g. to create another archive."""
+        self.root_stats: Dict[str, Stats] = {}
+        self.ckinfo: Optional[Dict[str, Any]] = None
+        self.fs_donelist: List[str] = []
+        self.archive_files: List[str] = []
+
+    @classmethod
+    def FromConfig(cls, configfile: str, **kwargs: Any) -> 'BackupManager':
+        """Builds a BackupManager without parsing a command line.
+
+        The options not given as keyword arguments (named as the
+        attributes set by build_options, e.g. level or statefile) get
+        their command line defaults.
+
+        """
+        options = build_options().parse_args([])
+        for (name, value) in kwargs.items():
+            if not hasattr(options, name):
+                raise Error("Unknown option '%s'" % name)
+            setattr(options, name, value)
+        options.configfile = configfile
+        return cls(options)
+
+    def forroot(self, name: str, path: str) -> 'BackupManager':
+        """Builds the manager backing up the files of one root.
+
+        The configuration is not parsed again: the include paths are
+        expanded under the root, and the (compiled) exclusions are
+        shared, being matched against the paths relative to the root.
+        The archive and the state database are tagged with the name
+        of the root.
+
+        """
+        opts = argparse.Namespace(**vars(self.options))
+        opts.archive_id = "%s-%s" % (opts.archive_id, name)
+        (base, ext) = os.path.splitext(self.fs_statefile)
+        opts.statefile = "%s.%s%s" % (base, name, ext)
+        opts.file = None
+        opts.stdout = False
+        opts.do_commands = False
+        opts.profile = False
+        child = copy.copy(self)
+        child.options = opts
+        child.scan = self.scan._replace(root=path)
+        child.roots = []
+        child.fs_statefile = opts.statefile
+        child.fs_include = [i for pattern in self.fs_patterns
+                            for i in self._expand(pattern, path)]
+        child.reset()
+        return child
+
     @staticmethod
     def _check_val(src: str, val: Optional[Any], msg: str) -> None:
         """Checks that a given value is well-formed.
@@ -730,6 +3178,74 @@ class BackupManager:
         if val is None:
             raise ConfigurationError(src, "%s: %r" % (msg, val))
 
+    @staticmethod
+    def _getnumber(src: str, config: Any, key: str, conv: Any) -> Any:
+        """Returns a numeric configuration value, or None if unset."""
+        val = config.get(key, None)
+        if val is None:
+            return None
+        try:
+            return conv(val)
+        except (ValueError, TypeError) as err:
+            raise ConfigurationError(src, "Invalid %s value" % key) from err
+
+    def _parsebudget(self, filename: str, config: Any) -> None:
+        """Parses the resource budget and tuning settings."""
+        budget = self.budget
+        budget.max_read_bytes = self._getnumber(filename, config,
+                                                "max_read_bytes_per_sec", int)
+        budget.max_files = self._getnumber(filename, config,
+                                           "max_files_per_sec", float)
+        budget.compression_budget = self._getnumber(filename, config,
+                                                    "compression_budget",
+                                                    float)
+        for val in (budget.max_read_bytes, budget.max_files,
+                    budget.compression_budget):
+            if val is not None and val <= 0:
+                raise ConfigurationError(filename, "Invalid budget value"
+                                         " %r, must be positive" % val)
+        budget.nice = self._getnumber(filename, config, "nice", int)
+        budget.ionice_class = config.get("ionice_class", None)
+        if budget.ionice_class is not None and \
+           budget.ionice_class not in IOPRIO_CLASSES:
+            raise ConfigurationError(filename, "Invalid ionice_class value"
+                                     " '%s'" % budget.ionice_class)
+        level = self._getnumber(filename, config, "ionice_level", int)
+        if level is not None:
+            if not 0 <= level <= 7:
+                raise ConfigurationError(filename, "Invalid ionice_level"
+                                         " value %d" % level)
+            budget.ionice_level = level
+        threshold = self._getnumber(filename, config, "chunk_threshold", int)
+        if threshold is not None:
+            budget.chunk_threshold = threshold
+        workers = self._getnumber(filename, config, "scan_workers", int)
+        if workers is not None:
+            if workers < 0:
+                raise ConfigurationError(filename, "Invalid scan_workers"
+                                         " value %d" % workers)
+            self.scan = self.scan._replace(workers=workers)
+
+    def _setpriority(self) -> None:
+        """Lowers the CPU and I/O priority, if so configured.
+
+        The priorities are inherited by the executed commands. The
+        niceness is only changed once per process.
+
+        """
+        if self.budget.nice is not None and not _NICE_APPLIED.is_set():
+            _NICE_APPLIED.set()
+            try:
+                os.nice(self.budget.nice)
+            except OSError as err:
+                logging.warning("Can't change the CPU priority: %s", err)
+        if self.budget.ionice_class is not None:
+            try:
+                set_ioprio(self.budget.ionice_class,
+                           self.budget.ionice_level)
+            except OSError as err:
+                logging.warning("Can't change the I/O priority: %s", err)
+
     def _get_extra_sources(self,
                            mainfile: str,
                            maincfg: Any) -> List[Tuple[str, Any]]:
@@ -772,13 +3288,11 @@ class BackupManager:
         else:
             self.fs_statefile = self.options.statefile
 
-        msize = config.get("maxsize", None)
+        msize = self._getnumber(filename, config, "maxsize", int)
         if msize is not None:
-            try:
-                self.fs_maxsize = int(msize)
-            except (ValueError, TypeError) as err:
-                raise ConfigurationError(filename, "Invalid maxsize"
-                                         " value") from err
+            self.fs_maxsize = msize
+        self._parsebudget(filename, config)
+        self._parseroots(filename, config)
         tlist = self._get_extra_sources(filename, config)
 
         # process scanning targets
@@ -787,64 +3301,305 @@ class BackupManager:
             # process file system include paths
             for scan_path in conft.get("include", []):
                 self._check_val(cfile, scan_path, "Invalid include entry")
-                paths = [os.path.abspath(i) for i in glob.glob(scan_path)]
-                self.fs_include += [ensure_text(i) for i in paths]
+                scan_path = ensure_text(scan_path)
+                self.fs_patterns.append(scan_path)
+                self.fs_include += self._expand(scan_path, None)
 
             # process file system exclude paths
             for noscan_path in conft.get("exclude", []):
                 self._check_val(cfile, noscan_path, "Invalid exclude entry")
-                self.fs_exclude.append(ensure_text(noscan_path))
+                noscan_path = ensure_text(noscan_path)
+                try:
+                    self.fs_exclude.append(re.compile(noscan_path))
+                except re.error as err:
+                    raise ConfigurationError(cfile, "Invalid exclude entry"
+                                             " '%s': %s" %
+                                             (noscan_path, err)) from err
 
             # command output
-            commands = conft.get("commands", [])
-            for entry in commands:
-                cmd_line = ensure_text(entry.get("cmd", None))
-                cmd_dest = ensure_text(entry.get("dest", None))
-                self._check_val(cfile, cmd_line, "Invalid 'cmd' key")
-                self.cmd_outputs.append(CmdOutput(cmd_line, cmd_dest))
-
-    def _addfilesys(self, archive: Archive) -> Tuple[FileManager, int, int]:
+            for entry in conft.get("commands", []):
+                self._addcommand(cfile, entry)
+
+            # pseudo-files, stored like command outputs
+            for entry in conft.get("pseudofiles", []):
+                self._addpseudofiles(cfile, entry)
+
+    def _parseroots(self, filename: str, config: Any) -> None:
+        """Parses the roots backed up in batch mode.
+
+        An entry is either the absolute path of the root, or a
+        mapping with the path and name keys; by default the name is
+        derived from the path. The name tags the archive and the
+        state database of the root.
+
+        """
+        jobs = self._getnumber(filename, config, "root_jobs", int)
+        if jobs is not None:
+            if jobs < 1:
+                raise ConfigurationError(filename, "Invalid root_jobs"
+                                         " value %d" % jobs)
+            self.budget.root_jobs = jobs
+        names: Set[str] = set()
+        for entry in config.get("roots", None) or []:
+            if isinstance(entry, dict):
+                path = entry.get("path", None)
+                name = entry.get("name", None)
+            else:
+                path = entry
+                name = None
+            if not isinstance(path, str) or not os.path.isabs(path) or \
+               path.rstrip("/") == "":
+                raise ConfigurationError(filename, "Invalid roots entry:"
+                                         " %r" % entry)
+            path = os.path.normpath(path)
+            if name is None:
+                name = sanitize_name(path.strip("/"))
+            name = str(name)
+            if not name or os.path.sep in name or name in names:
+                raise ConfigurationError(filename, "Invalid or duplicate"
+                                         " root name '%s'" % name)
+            names.add(name)
+            self.roots.append((name, path))
+
+    @staticmethod
+    def _expand(pattern: str, root: Optional[str]) -> List[str]:
+        """Returns the paths matching an include pattern.
+
+        If a root is given, the pattern is taken as relative to it.
+
+        """
+        if root is not None:
+            pattern = os.path.join(root, pattern.lstrip("/"))
+        return [os.path.abspath(i) for i in glob.glob(pattern)]
+
+    def _addcommand(self, cfile: str, entry: Any) -> None:
+        """Processes an entry of the commands list.
+
+        The command is either a string, executed via the shell, or an
+        argument list, executed directly.
+
+        """
+        cmd_line = entry.get("cmd", None)
+        cmd_dest = entry.get("dest", None)
+        self._check_val(cfile, cmd_line, "Invalid 'cmd' key")
+        if cmd_dest is not None:
+            cmd_dest = ensure_text(cmd_dest)
+        if isinstance(cmd_line, list):
+            # argument list, executed without a shell
+            if not cmd_line or None in cmd_line:
+                raise ConfigurationError(cfile, "Invalid 'cmd' key:"
+                                         " %r" % cmd_line)
+            argv = [ensure_text(arg) if isinstance(arg, bytes)
+                    else str(arg) for arg in cmd_line]
+            self.cmd_outputs.append(CmdOutput.FromArgv(argv, cmd_dest))
+        else:
+            self.cmd_outputs.append(
+                CmdOutput(ensure_text(cmd_line), cmd_dest))
+
+    def _addpseudofiles(self, cfile: str, entry: Any) -> None:
+        """Processes an entry of the pseudofiles list.
+
+        An entry is either a path (or shell pattern), stored under the
+        same name, or a mapping with the path and dest keys; if the
+        path is a pattern, dest is a directory under which the
+        matching files are stored.
+
+        """
+        pattern: Any
+        if isinstance(entry, dict):
+            pattern = entry.get("path", None)
+            dest = entry.get("dest", None)
+        else:
+            pattern = entry
+            dest = None
+        self._check_val(cfile, pattern, "Invalid pseudofiles entry")
+        pattern = ensure_text(pattern)
+        is_pattern = glob.has_magic(pattern)
+        paths = sorted(glob.glob(pattern)) if is_pattern else [pattern]
+        for path in paths:
+            if os.path.isdir(path):
+                logging.debug("Skipping pseudo-file directory '%s'", path)
+                continue
+            if dest is None:
+                pdest = path
+            elif is_pattern:
+                pdest = os.path.join(ensure_text(dest),
+                                     os.path.basename(path))
+            else:
+                pdest = ensure_text(dest)
+            self.cmd_outputs.append(FileCapture(path, pdest))
+
+    def filemanager(self,
+                    reader: FileReader = DEFAULT_READER) -> FileManager:
+        """Builds a FileManager for the configured file system scan.
+
+        This is the entry point for using the selection without
+        writing a bakonf archive: the caller consumes the selections()
+        generator, calls notifywritten() for the paths it has stored,
+        then commit() on success, and finally close() (which, without
+        a commit(), discards the new state of a level 0 scan).
+
+        """
+        opts = self.options
+        scanlist = self._onlyroots(opts.only) if opts.only else \
+            self.fs_include
+        scan = self.scan._replace(reader=reader, readorder=opts.read_order,
+                                  resuming=opts.resume,
+                                  updating=bool(opts.only))
+        return FileManager(scanlist, self.fs_exclude, self.fs_statefile,
+                           opts.level, self.fs_maxsize, scan)
+
+    def _onlyroots(self, only: List[str]) -> List[str]:
+        """Restricts the include paths to the given subtrees.
+
+        Each given path is kept if it's under an include path, and
+        replaced by the include paths under it otherwise.
+
+        """
+        roots: List[str] = []
+        for path in only:
+            path = os.path.abspath(path)
+            found = False
+            for inc in self.fs_include:
+                if isunder(path, inc):
+                    root = path
+                elif isunder(inc, path):
+                    root = inc
+                else:
+                    continue
+                found = True
+                if root not in roots:
+                    roots.append(root)
+            if not found:
+                logging.warning("Path '%s' is not included in the backup,"
+                                " ignoring it.", path)
+        if not roots:
+            raise Error("None of the paths given to --only is included"
+                        " in the backup")
+        return roots
+
+    def _addfilesys(self, archive: Archive,
+                    progress: Optional[Progress]) -> Tuple[FileManager, int,
+                                                           int]:
         """Add the selected files to the archive.
 
         This function adds the files which need to be backed up to the
         archive. If any file cannot be opened, it will be listed in
-        /unarchived_files.lst.
+        /unarchived_files.lst. For level 1 backups (and partial level 0
+        ones, see --only), the files deleted since the level 0 backup
+        are listed in /deleted_files.lst.
 
         """
         stime = time.time()
-        logging.info("Scanning files...")
-        fm = FileManager(self.fs_include, self.fs_exclude,
-                         self.fs_statefile,
-                         self.options.level, self.fs_maxsize)
-        fm.checksources()
-        errorlist = list(fm.errorlist)
-        fs_list = fm.filelist
+        logging.info("Scanning and archiving files...")
+        fm = self.filemanager(archive.reader)
+        if progress is not None:
+            progress.fm = fm
+        archive.addpath("/", FS_PREFIX + "/")
+        # The scan runs in a separate thread, so that reading and
+        # checksumming overlaps with the archiving of the already
+        # selected paths.
+        selections: Iterable[Selection] = prefetch(fm.selections(),
+                                                   PIPELINE_DEPTH)
+        if self.ckinfo is not None:
+            selections = self._checkpoints(selections, archive, fm)
+        archive_errors = archiveselections(archive, selections,
+                                           self.fs_donelist)
+        errorlist = fm.errorlist + archive_errors
         ntime = time.time()
-        logging.info("Done scanning, %.4f seconds, %d files",
-                     ntime - stime, len(fs_list))
-        logging.info("Archiving files...")
-        donelist = self.fs_donelist
-        archive.add(name="/", arcname="filesystem/", recursive=False)
-        for path in fs_list:
-            arcx = os.path.join("filesystem", path.lstrip("/"))
-            try:
-                archive.add(name=path,
-                            arcname=arcx,
-                            recursive=False)
-            except IOError as err:
-                errorlist.append((path, err.strerror))
-                logging.error("Cannot read '%s': '%s'. Not archived.",
-                              path, err.strerror)
-            else:  # Successful archiving of the member
-                donelist.append(path)
-        ptime = time.time()
-        logging.info("Done archiving files, %.4f seconds.", ptime - ntime)
+        logging.info("Done scanning and archiving files, %.4f seconds,"
+                     " %d files selected.", ntime - stime, len(fm.filelist))
 
         contents = ["'%s'\t'%s'" % v for v in errorlist]
         storefakefile(archive, "\n".join(contents), "unarchived_files.lst")
-        return (fm, len(donelist), len(errorlist))
+        if self.options.level == 1 or self.options.only:
+            deleted = fm.deleted()
+            logging.info("%d files deleted since the level 0 backup.",
+                         len(deleted))
+            storefakefile(archive, "\n".join(deleted), DELETED_LIST)
+            # only affects the new database, which is discarded if the
+            # archive isn't completely written
+            for path in deleted:
+                fm.forget(path)
+        return (fm, len(self.fs_donelist), len(errorlist))
+
+    def _checkpoints(self, selections: Iterable[Selection],
+                     archive: Archive,
+                     fm: FileManager) -> Iterator[Selection]:
+        """Passes through the selections, checkpointing periodically.
+
+        Since the next selection is only requested once the previous
+        one has been archived, the checkpoint covers all the paths
+        archived so far.
+
+        """
+        assert self.ckinfo is not None
+        interval = self.ckinfo["interval"]
+        last = time.monotonic()
+        for sel in selections:
+            yield sel
+            if time.monotonic() - last >= interval:
+                self._checkpoint(archive, fm)
+                last = time.monotonic()
+
+    def _checkpoint(self, archive: Archive, fm: FileManager) -> None:
+        """Records the archived paths in the new state database.
+
+        The archive data written so far is synced to disc first, and
+        then the state of the archived paths, together with the
+        archive offset at which a resumed backup can cut the archive.
 
-    def _addcommands(self, archive: Archive) -> Tuple[int, int]:
+        """
+        assert self.ckinfo is not None
+        fobj: Any = archive.fileobj
+        if isinstance(fobj, BlockCompressor):
+            fobj.endblock()
+            fobj.flush()
+            (fd, offset) = (fobj.raw.fileno(), fobj.cpos)
+        else:
+            fobj.flush()
+            (fd, offset) = (fobj.fileno(), archive.offset)
+        try:
+            os.fsync(fd)
+        except OSError as err:
+            raise ArchiveWriteError(str(err)) from err
+        # the files recorded by the previous checkpoint are skipped
+        done = self.fs_donelist
+        for path in done[self.ckinfo["files"]:]:
+            fm.notifywritten(path)
+        self.ckinfo.update(offset=offset, files=len(done))
+        fm.statedb.put(DBKEY_CHECKPOINT, json.dumps(self.ckinfo))
+        fm.statedb.sync()
+        logging.debug("Checkpoint after %d files, at offset %d",
+                      len(done), offset)
+
+    def _resumepoint(self, to_stdout: bool) -> Dict[str, Any]:
+        """Returns the last checkpoint of an interrupted backup."""
+        if self.options.level != 0 or to_stdout or \
+           not self.options.do_files:
+            raise Error("Only level 0 backups of the file system, written"
+                        " to a file, can be resumed")
+        side = os.path.abspath(self.fs_statefile) + STATE_NEW_SUFFIX
+        if not os.path.exists(side):
+            raise Error("No interrupted level 0 backup to resume"
+                        " ('%s' not found)" % side)
+        try:
+            statedb = StateDB(side, "r")
+        except bsddb3.db.DBError as err:
+            raise ConfigurationError(side, "Can't open the database: %s"
+                                     % err) from err
+        try:
+            value = statedb.get(DBKEY_CHECKPOINT)
+        finally:
+            statedb.close()
+        if value is None:
+            raise Error("The interrupted backup didn't reach a checkpoint,"
+                        " it can't be resumed")
+        info: Dict[str, Any] = json.loads(value)
+        return info
+
+    def _addcommands(self, archive: Archive,
+                     statedb: Optional[StateDB]) -> Tuple[int, int]:
         """Add the command outputs to the archive.
 
         This functions adds the configured command outputs to the
@@ -853,17 +3608,64 @@ class BackupManager:
         archive, but the command and its status will be listed in
         /commands_with_error.lst file.
 
+        If the state database is available, the checksums of the
+        outputs are recorded in it (at level 0, in the new database,
+        which is only committed once the archive has been written),
+        and level 1 backups store only the outputs which differ,
+        listing the other commands in /commands_unchanged.lst.
+        Partial backups (--only) leave the recorded checksums alone.
+
+        The commands are run from the root directory, and the time
+        needed to launch each of them is recorded in its latency.
+
         """
         errorlist = []
+        unchanged = []
+        incremental = self.options.level == 1 and statedb is not None
         for cmd in self.cmd_outputs:
-            err = cmd.store(archive)
+            self.throttle.file()
+            start = time.monotonic()
+            (output, err) = cmd.capture()
+            self.throttle.data(len(output))
+            if archive.reader.profiler is not None:
+                archive.reader.profiler.command(cmd.command, start)
+            key = StateDB.cmdkey(cmd.command, cmd.destination)
+            digest = hashlib.sha512(output).hexdigest()
             if err is not None:
                 errorlist.append((cmd.command, err))
+            elif incremental:
+                assert statedb is not None
+                if statedb.get(key) == digest:
+                    logging.debug("Output of %s is unchanged",
+                                  cmd.command)
+                    unchanged.append(cmd.destination)
+                    continue
+            elif statedb is not None and not self.options.only:
+                statedb.put(key, digest)
+            cmd.storeoutput(archive, output)
+        self._loglatencies()
 
         contents = ["'%s'\t'%s'\n" % v for v in errorlist]
         storefakefile(archive, "\n".join(contents), "commands_with_errors.lst")
+        if incremental:
+            logging.info("%d command outputs unchanged since the level 0"
+                         " backup.", len(unchanged))
+            storefakefile(archive, "\n".join(unchanged), UNCHANGED_CMDS_LIST)
         return (len(self.cmd_outputs), len(errorlist))
 
+    def _loglatencies(self) -> None:
+        """Logs a summary of the command launch times."""
+        latencies = [(cmd.command, cmd.latency) for cmd in self.cmd_outputs
+                     if cmd.latency is not None]
+        if not latencies:
+            return
+        total = sum(lat for (_, lat) in latencies)
+        (slowest, highest) = max(latencies, key=lambda v: v[1])
+        logging.info("Launched %d commands, average launch time %.2fms,"
+                     " slowest %.2fms ('%s').", len(latencies),
+                     total * 1000 / len(latencies),
+                     highest * 1000, slowest)
+
     def _addsignature(self, archive: Archive) -> None:
         """Add a signature to the archive.
 
@@ -893,11 +3695,289 @@ class BackupManager:
         storefakefile(archive, my_hostname, "host")
         storefakefile(archive, PKG_VERSION, "version")
 
+    def _writeindex(self, path: str, entries: List[IndexEntry],
+                    fs_manager: Optional[FileManager],
+                    compression: str) -> None:
+        """Writes the index of the archive, including file checksums."""
+        prefix = FS_PREFIX + "/"
+        for (idx, entry) in enumerate(entries):
+            if fs_manager is None or not entry.name.startswith(prefix):
+                continue
+            subject = fs_manager.subjects.get("/" + entry.name[len(prefix):])
+            if subject is not None and entry.size > 0:
+                entries[idx] = entry._replace(
+                    digest=subject.physical.checksum)
+        try:
+            write_index(path, compression, entries)
+        except EnvironmentError as err:
+            raise Error("Can't write archive index '%s': %s" %
+                        (path, err)) from err
+        logging.info("Archive index written to '%s'.", path)
+
     def run(self) -> Stats:
         """Create the archive.
 
         This method creates the archive with the given options from
-        the command line and the configuration file.
+        the command line and the configuration file. If requested,
+        the run is profiled (only the main thread, see cProfile), and
+        its progress reported.
+
+        """
+        opts = self.options
+        prof: Optional[cProfile.Profile] = None
+        if opts.profile_dump:
+            prof = cProfile.Profile()
+            prof.enable()
+        self._setpriority()
+        self.throttle = self.budget.throttle()
+        (send, closestatus) = self._openstatus()
+        progress: Optional[Progress] = None
+        try:
+            if send is not None:
+                progress = Progress(send, opts.status_interval,
+                                    self.throttle, self._lastscanned())
+                progress.donelist = self.fs_donelist
+                progress.begin()
+            stats = self.backup(progress)
+            if self.roots:
+                self._runroots()
+            return stats
+        finally:
+            if progress is not None:
+                progress.end()
+            if closestatus is not None:
+                closestatus()
+            if prof is not None:
+                prof.disable()
+                prof.dump_stats(opts.profile_dump)
+                logging.info("Profile written to '%s'.", opts.profile_dump)
+
+    def _runroots(self) -> None:
+        """Backs up the configured roots, after the main backup.
+
+        The roots are backed up in parallel (only their files, the
+        commands are run once, for the main backup). They share the
+        I/O budget, the scan workers and a digest cache, so that the
+        files shared between roots (e.g. hard links to a common image)
+        are only read once. A failed root doesn't stop the others (its
+        partial archive is removed), but fails the run at the end.
+
+        """
+        opts = self.options
+        if not opts.do_files or opts.only or opts.resume:
+            logging.info("Skipping the backup of the roots.")
+            return
+        reader = FileReader(opts.preserve_cache, self.throttle,
+                            self.budget.chunk_threshold, None, {})
+        scanpool: Optional[concurrent.futures.Executor] = None
+        if self.scan.workers > 1:
+            scanpool = concurrent.futures.ThreadPoolExecutor(
+                self.scan.workers)
+
+        def backup(name: str, path: str) -> Stats:
+            if not os.path.isdir(path):
+                raise Error("Root '%s' is not a directory" % path)
+            bm = self.forroot(name, path)
+            bm.scan = bm.scan._replace(reader=reader, pool=scanpool)
+            try:
+                return bm.backup()
+            except Exception:
+                for fname in bm.archive_files:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(fname)
+                raise
+
+        logging.info("Backing up %d roots...", len(self.roots))
+        failed = []
+        pool = concurrent.futures.ThreadPoolExecutor(self.budget.root_jobs)
+        try:
+            futures = [(name, pool.submit(backup, name, path))
+                       for (name, path) in self.roots]
+            for (name, future) in futures:
+                try:
+                    self.root_stats[name] = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.error("Backup of root '%s' failed: %s",
+                                  name, err)
+                    failed.append(name)
+        finally:
+            pool.shutdown(wait=True)
+            if scanpool is not None:
+                scanpool.shutdown(wait=True)
+        logging.info("I/O summary, including the roots: %s.",
+                     self.throttle.summary())
+        if failed:
+            raise Error("The backup of %d root(s) failed: %s" %
+                        (len(failed), ", ".join(failed)))
+
+    def _openstatus(self) -> Tuple[Any, Any]:
+        """Opens the destination of the progress records, if any.
+
+        Returns the function writing to it, and the one to be called
+        at the end. The file descriptor is made non-blocking for the
+        duration of the backup (the records are small enough to be
+        written atomically to a pipe), while the socket gets a send
+        timeout, as a partially sent record can't be dropped.
+
+        """
+        opts = self.options
+        if opts.status_fd is not None:
+            try:
+                blocking = os.get_blocking(opts.status_fd)
+                os.set_blocking(opts.status_fd, False)
+            except OSError as err:
+                raise Error("Invalid status file descriptor %d: %s" %
+                            (opts.status_fd, err)) from err
+            return (functools.partial(os.write, opts.status_fd),
+                    functools.partial(os.set_blocking, opts.status_fd,
+                                      blocking))
+        if opts.status_socket is None:
+            return (None, None)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(opts.status_socket)
+        except OSError as err:
+            sock.close()
+            raise Error("Cannot connect to the status socket '%s': %s" %
+                        (opts.status_socket, err)) from err
+        sock.settimeout(STATUS_TIMEOUT)
+        return (sock.sendall, sock.close)
+
+    def _statevalue(self, key: str) -> Optional[str]:
+        """Reads a value from the state database, if it exists."""
+        if not self.options.do_files or \
+           not os.path.exists(self.fs_statefile):
+            return None
+        try:
+            statedb = StateDB(self.fs_statefile, "r")
+        except bsddb3.db.DBError:
+            return None
+        try:
+            return statedb.get(key)
+        finally:
+            statedb.close()
+
+    def _autocompression(self) -> Tuple[str, int, Dict[str, Any]]:
+        """Chooses the codec and level for the automatic compression.
+
+        This is based on the history of the previous runs (see
+        choosecompression), read from the state database. Resumed
+        backups keep the codec of the interrupted one.
+
+        """
+        history: Any = {}
+        value = self._statevalue(DBKEY_COMPRESSION)
+        if value is not None:
+            try:
+                history = json.loads(value)
+            except ValueError:
+                history = None
+            if not isinstance(history, dict):
+                logging.warning("Ignoring the invalid compression history")
+                history = {}
+        codecs = autocodecs()
+        if self.options.resume:
+            interrupted = self._resumepoint(False)["compression"]
+            if interrupted not in codecs:
+                raise Error("The interrupted backup can't be continued with"
+                            " automatic compression")
+            codecs = [interrupted]
+        (codec, level) = choosecompression(history.get("rates", {}),
+                                           self.budget.compression_budget,
+                                           history.get("payload", None),
+                                           codecs)
+        logging.info("Compressing with %s, starting at level %d.",
+                     codec, level)
+        return (codec, level, history)
+
+    def _autohistory(self, blockc: AdaptiveCompressor) -> str:
+        """Returns the updated compression history, for the next runs."""
+        logging.info("Spent %.2f seconds compressing, the last level"
+                     " used was %d.", blockc.spent, blockc.level)
+        history = {"rates": blockc.rates, "payload": blockc.pos}
+        if self.options.resume:
+            # only the rest of the interrupted backup has been written
+            history["payload"] = blockc.expected
+        return json.dumps(history)
+
+    def _lastscanned(self) -> Optional[int]:
+        """Returns the number of paths scanned by the last level 0 run.
+
+        This is read from the state database, if it exists and is
+        recent enough to have it.
+
+        """
+        value = self._statevalue(DBKEY_SCANNED)
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def backup(self, progress: Optional[Progress] = None) -> Stats:
+        """Creates the archive, without backing up the roots.
+
+        This is the core of run(), without the settings which apply to
+        the whole process (priorities, progress reporting and
+        profiling); it's also used for each of the roots. The
+        progress is reported via the given Progress, if any.
+
+        """
+        opts = self.options
+        to_stdout = opts.stdout or opts.file == "-"
+        (final_tar, compr, auto) = self._archivename(to_stdout)
+        final_tar = self._startcheckpoints(final_tar, compr,
+                                           auto is not None, to_stdout)
+        tarh = self._openarchive(final_tar, compr, auto, to_stdout)
+        if self.scan.reader is not None:
+            tarh.reader = self.scan.reader
+        else:
+            tarh.reader = FileReader(opts.preserve_cache, self.throttle,
+                                     self.budget.chunk_threshold,
+                                     Profiler() if opts.profile else None)
+
+        # Archiving files
+        fs_manager: Optional[FileManager] = None
+        f_stored = f_skipped = 0
+        if opts.do_files:
+            (fs_manager, f_stored, f_skipped) = self._addfilesys(tarh,
+                                                                 progress)
+
+        # Add command output
+        if progress is not None:
+            progress.phase = PHASE_COMMANDS
+        c_stored = c_skipped = 0
+        if opts.do_commands:
+            (c_stored, c_skipped) = self._addcommands(
+                tarh, fs_manager.statedb if fs_manager is not None else None)
+
+        # Add readme stuff
+        self._addsignature(tarh)
+        if progress is not None:
+            progress.phase = PHASE_FINISHING
+
+        # Done with the archive; note that the state database is only
+        # updated once the archive has been completely written out.
+        final_tar = self._finisharchive(tarh, final_tar, to_stdout)
+        if self.scan.root is None:
+            logging.info("I/O summary: %s.", self.throttle.summary())
+        if tarh.reader.profiler is not None:
+            tarh.reader.profiler.report(sys.stderr, opts.profile_top)
+
+        if tarh.index is not None:
+            self.archive_files.append(final_tar + INDEX_SUFFIX)
+            self._writeindex(final_tar + INDEX_SUFFIX, tarh.index,
+                             fs_manager, compr)
+
+        if fs_manager is not None:
+            self._updatestate(fs_manager, tarh.fileobj)
+        return Stats(final_tar, f_stored, f_skipped, c_stored, c_skipped)
+
+    def _archivename(self, to_stdout: bool) -> Tuple[str, str, Any]:
+        """Checks the archive options, and returns the archive name.
+
+        Also returns the compression to use, and for automatic
+        compression its starting level and the compression history
+        (see _autocompression).
 
         """
         opts = self.options
@@ -907,68 +3987,775 @@ class BackupManager:
         if compr == COMP_XZ and not HAVE_LZMA:
             raise Error("Your Python version doesn't support LZMA compression")
 
-        if compr == COMP_NONE:
-            tarmode = "w"
-        elif compr in [COMP_GZ, COMP_BZ2, COMP_XZ]:
-            tarmode = "w:" + compr
+        if opts.volume_size is not None and \
+           (to_stdout or opts.index or opts.resume or compr == COMP_AUTO):
+            raise Error("Archives split into volumes can't be written to"
+                        " the standard output, indexed, resumed or"
+                        " compressed automatically")
+        auto: Optional[Tuple[int, Dict[str, Any]]] = None
+        if compr == COMP_AUTO:
+            if to_stdout:
+                raise Error("Automatic compression can't be used when"
+                            " writing to the standard output")
+            (compr, level, history) = self._autocompression()
+            auto = (level, history)
+        if compr in [COMP_GZ, COMP_BZ2, COMP_XZ]:
             final_tar += "." + compr
-        else:
+        elif compr != COMP_NONE:
             raise Error("Unexpected compression mode found, "
                         "please report this!")
-        if opts.file is not None:
+        if to_stdout:
+            final_tar = "-"
+        elif opts.file is not None:
             # overrides the entire path, including any extension added above
             final_tar = os.path.abspath(opts.file)
-        final_dir = os.path.dirname(final_tar)
-        if not os.path.exists(final_dir):
-            raise Error("Output directory '%s' does not exist" % final_dir)
-        if not os.path.isdir(final_dir):
-            raise Error("Output directory '%s' is not a directory" % final_dir)
+        if not to_stdout:
+            final_dir = os.path.dirname(final_tar)
+            if not os.path.exists(final_dir):
+                raise Error("Output directory '%s' does not exist" %
+                            final_dir)
+            if not os.path.isdir(final_dir):
+                raise Error("Output directory '%s' is not a directory" %
+                            final_dir)
+
+        if opts.index and to_stdout:
+            raise Error("An archive index can't be generated when writing"
+                        " to the standard output")
+
+        if opts.only:
+            if opts.level != 0 or opts.resume:
+                raise Error("Partial backups (--only) are done as level 0"
+                            " and can't be resumed")
+            if opts.file is None and not to_stdout:
+                final_tar = tagname(final_tar,
+                                    time.strftime("only-%H%M%S"))
+        return (final_tar, compr, auto)
+
+    def _startcheckpoints(self, final_tar: str, compr: str, auto: bool,
+                          to_stdout: bool) -> str:
+        """Sets up the checkpoints, resuming an interrupted backup.
+
+        Level 0 backups are checkpointed, so that they can be resumed.
+        Since each checkpoint ends a compressed stream, compressed
+        archives are by default only checkpointed if they are written
+        in blocks anyway (indexed, or automatically compressed).
+        Returns the name of the archive, which for resumed backups is
+        the next part of the interrupted one.
 
+        """
+        opts = self.options
+        interval = opts.checkpoint_interval
+        if interval is None:
+            blocks = compr == COMP_NONE or opts.index or auto
+            interval = CHECKPOINT_INTERVAL if blocks else 0
+        checkpoints = opts.level == 0 and opts.do_files and \
+            not to_stdout and not opts.only and \
+            opts.volume_size is None and interval > 0
+        part = 0
+        if opts.resume:
+            resume = self._resumepoint(to_stdout)
+            part = resume["part"] + 1
+            final_tar = partname(final_tar, part)
+            finishpartial(resume["archive"], resume["offset"],
+                          resume["compression"])
+            logging.info("Resuming the backup interrupted after %d files"
+                         " in '%s', continuing in '%s'.", resume["files"],
+                         resume["archive"], final_tar)
+        if checkpoints:
+            self.ckinfo = {"archive": final_tar, "compression": compr,
+                           "part": part, "files": 0, "interval": interval}
+        return final_tar
+
+    def _openarchive(self, final_tar: str, compr: str, auto: Any,
+                     to_stdout: bool) -> TarArchive:
+        """Opens the archive for writing."""
+        opts = self.options
         if opts.format:
             if opts.format not in FORMATS:
                 raise Error("Unexpected format '{}'?!".format(opts.format))
             tar_format = FORMATS[opts.format]
         else:
             tar_format = tarfile.DEFAULT_FORMAT
+        # streaming modes don't need a seekable output
+        if compr == COMP_NONE:
+            tarmode = "w|" if to_stdout else "w"
+        else:
+            tarmode = "w" + ("|" if to_stdout else ":") + compr
+        fobj: BlockCompressor
+        tarh: TarArchive
+        if not to_stdout:
+            # the files written so far, removed if a root fails
+            self.archive_files = [final_tar]
         try:
-            tarh = tarfile.open(name=final_tar, mode=tarmode,
-                                format=tar_format)
+            if to_stdout:
+                tarh = TarArchive.open(fileobj=sys.stdout.buffer,
+                                       mode=tarmode, format=tar_format)
+            elif opts.volume_size is not None:
+                volw = VolumeWriter(final_tar, compr, opts.volume_size,
+                                    os.cpu_count() or 1)
+                self.archive_files = volw.volumes
+                tarh = TarArchive.open(fileobj=volw, mode="w",
+                                       format=tar_format)
+            elif auto is not None:
+                (level, history) = auto
+                fobj = AdaptiveCompressor(final_tar, compr, level,
+                                          self.budget.compression_budget,
+                                          history.get("payload", None),
+                                          history.get("rates", None))
+                tarh = TarArchive.open(fileobj=fobj, mode="w",
+                                       format=tar_format)
+            elif (opts.index or self.ckinfo is not None) and \
+                    compr != COMP_NONE:
+                # indexed archives are compressed in independent blocks,
+                # so that members can be accessed directly; checkpoints
+                # end the current block, so that the archive can be cut
+                # there (otherwise, the blocks are only ended by them)
+                if compr not in tarfile.TarFile.OPEN_METH:
+                    raise tarfile.CompressionError("unknown compression"
+                                                   " type %r" % compr)
+                fobj = BlockCompressor(final_tar, compr,
+                                       INDEX_BLOCKSIZE if opts.index else 0)
+                tarh = TarArchive.open(fileobj=fobj, mode="w",
+                                       format=tar_format)
+            else:
+                tarh = TarArchive.open(name=final_tar, mode=tarmode,
+                                       format=tar_format)
         except EnvironmentError as err:
             raise Error("Can't create archive '%s'" % final_tar) from err
         except tarfile.CompressionError as err:
             raise Error("Unexpected compression error") from err
+        if opts.index:
+            tarh.index = []
+        return tarh
 
-        # Archiving files
-        fs_manager: Optional[FileManager]
-        if opts.do_files:
-            (fs_manager, f_stored, f_skipped) = self._addfilesys(tarh)
+    def _finisharchive(self, tarh: TarArchive, final_tar: str,
+                       to_stdout: bool) -> str:
+        """Finishes writing the archive.
+
+        Returns the name of the archive, which for archives split into
+        volumes is their manifest.
+
+        """
+        fobj = tarh.fileobj
+        try:
+            tarh.close()
+            if isinstance(fobj, (BlockCompressor, VolumeWriter)):
+                # not closed by the tar archive, which didn't open it
+                fobj.close()
+            if to_stdout:
+                sys.stdout.buffer.flush()
+        except EnvironmentError as err:
+            raise ArchiveWriteError(str(err)) from err
+
+        if to_stdout:
+            logging.info("Archive written to standard output, %i bytes"
+                         " before compression.", tarh.offset)
+        elif isinstance(fobj, VolumeWriter):
+            final_tar = manifestname(final_tar)
+            self.archive_files = fobj.volumes + [final_tar]
+            try:
+                write_manifest(final_tar, fobj.volumes, fobj.manifest)
+            except EnvironmentError as err:
+                raise Error("Can't write the manifest '%s': %s" %
+                            (final_tar, err)) from err
+            logging.info("Archive generated in %d volumes, manifest at"
+                         " '%s'.", len(fobj.volumes), final_tar)
         else:
-            fs_manager = None
-            f_stored = f_skipped = 0
+            statres = os.stat(final_tar)
+            logging.info("Archive generated at '%s', size %i.",
+                         final_tar, statres.st_size)
+        return final_tar
 
-        # Add command output
-        if opts.do_commands:
-            (c_stored, c_skipped) = self._addcommands(tarh)
+    def _updatestate(self, fs_manager: FileManager, writer: Any) -> None:
+        """Updates the state database with the archived files.
+
+        The writer is the file object the archive was written to, which
+        for automatic compression holds the history for the next runs.
+
+        """
+        opts = self.options
+        # the files recorded by the last checkpoint are skipped
+        start = self.ckinfo["files"] if self.ckinfo is not None else 0
+        for path in self.fs_donelist[start:]:
+            fs_manager.notifywritten(path)
+        if opts.level == 0 and not opts.only:
+            fs_manager.statedb.put(DBKEY_SCANNED,
+                                   str(len(fs_manager.scanned)))
+            if isinstance(writer, AdaptiveCompressor):
+                fs_manager.statedb.put(DBKEY_COMPRESSION,
+                                       self._autohistory(writer))
+        fs_manager.commit()
+
+
+class ArchiveReader:
+    """Provides access to the members of a bakonf archive.
+
+    If an index file is found next to the archive, members are read
+    directly from their (compressed block) offset. Uncompressed
+    archives can also be accessed directly, based on the offsets read
+    from the tar headers. Other archives can only be read
+    sequentially.
+
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index: Optional[Dict[str, IndexEntry]] = None
+        self.tarinfos: Optional[Dict[str, tarfile.TarInfo]] = None
+        self.deleted: List[str] = []
+        self.compression = COMP_NONE
+        idxpath = path + INDEX_SUFFIX
+        if os.path.exists(idxpath):
+            (self.compression, entries) = read_index(idxpath)
+            self.index = dict((e.name, e) for e in entries)
+            logging.debug("Using index file '%s'", idxpath)
+
+    @property
+    def seekable(self) -> bool:
+        """Whether members can be read in any order."""
+        return self.index is not None or self.tarinfos is not None
+
+    def names(self) -> List[str]:
+        """Returns the names of all members of the archive.
+
+        This also reads the list of files recorded as deleted (for
+        level 1 archives) into the deleted attribute.
+
+        """
+        if self.index is not None:
+            names = list(self.index)
         else:
-            c_stored = c_skipped = 0
+            try:
+                with tarfile.open(self.path, mode="r:") as tar:
+                    self.tarinfos = dict((t.name, t) for t in tar)
+                names = list(self.tarinfos)
+            except tarfile.ReadError:
+                # compressed, can only be read sequentially; not in
+                # stream mode, which doesn't handle the archives made of
+                # several compressed blocks
+                names = []
+                with tarfile.open(self.path, mode="r:*") as tar:
+                    for tinfo in tar:
+                        names.append(tinfo.name)
+                        if tinfo.name == DELETED_LIST:
+                            self.deleted = self._readlist(
+                                tar.extractfile(tinfo))
+                return names
+        if DELETED_LIST in names:
+            with self.member(DELETED_LIST) as (_, data):
+                self.deleted = self._readlist(data)
+        return names
 
-        # Add readme stuff
-        self._addsignature(tarh)
+    @staticmethod
+    def _readlist(data: Optional[IO[bytes]]) -> List[str]:
+        """Reads a list of paths stored in the archive."""
+        if data is None:  # pragma: no cover
+            return []
+        return [p for p in data.read().decode(ENCODING).split("\n") if p]
+
+    def _openat(self, entry: IndexEntry) -> BinaryIO:
+        """Returns a stream positioned at the header of a member."""
+        raw = open(self.path, "rb")
+        raw.seek(entry.block_offset)
+        stream: BinaryIO
+        if self.compression == COMP_NONE:
+            stream = raw
+        elif self.compression == COMP_GZ:
+            stream = cast(BinaryIO, gzip.GzipFile(fileobj=raw, mode="rb"))
+        elif self.compression == COMP_BZ2:
+            stream = cast(BinaryIO, bz2.BZ2File(raw))
+        elif self.compression == COMP_XZ:
+            stream = cast(BinaryIO, lzma.LZMAFile(raw))
+        else:
+            raise Error("Unexpected compression '%s' in index" %
+                        self.compression)
+        skip = entry.offset - entry.block_start
+        while skip > 0:
+            data = stream.read(min(skip, COPY_BUFSIZE))
+            if not data:
+                raise Error("Archive '%s' is shorter than its index" %
+                            self.path)
+            skip -= len(data)
+        return stream
+
+    @contextlib.contextmanager
+    def member(self, name: str) -> Iterator[Tuple[tarfile.TarInfo,
+                                                  Optional[IO[bytes]]]]:
+        """Opens a single member, for seekable archives.
+
+        Yields the member's TarInfo and a file object for its data
+        (for regular files only).
 
-        # Done with the archive
-        tarh.close()
+        """
+        if self.index is not None:
+            with self._openat(self.index[name]) as stream:
+                with tarfile.open(fileobj=stream, mode="r|") as tar:
+                    tinfo = tar.next()
+                    if tinfo is None or tinfo.name != name:
+                        raise Error("Index of archive '%s' doesn't"
+                                    " match its contents" % self.path)
+                    yield (tinfo, tar.extractfile(tinfo)
+                           if tinfo.isreg() else None)
+        elif self.tarinfos is not None:
+            tinfo = self.tarinfos[name]
+            with tarfile.open(self.path, mode="r:") as tar:
+                yield (tinfo, tar.extractfile(tinfo)
+                       if tinfo.isreg() else None)
+        else:  # pragma: no cover
+            raise Error("Archive '%s' doesn't support random access" %
+                        self.path)
+
+    def iterate(self, wanted: Set[str]) -> Iterator[
+            Tuple[tarfile.TarInfo, Optional[IO[bytes]]]]:
+        """Sequentially reads the wanted members of the archive."""
+        with tarfile.open(self.path, mode="r:*") as tar:
+            for tinfo in tar:
+                if tinfo.name in wanted:
+                    yield (tinfo, tar.extractfile(tinfo)
+                           if tinfo.isreg() else None)
+
+
+def fsmember(path: str) -> str:
+    """Returns the archive member name for a file system path."""
+    return os.path.normpath(FS_PREFIX + "/" + path.lstrip("/"))
+
+
+RestoreStats = collections.namedtuple(
+    "RestoreStats", "restored errors mismatches")
+
+
+def checkrestore(stats: RestoreStats) -> None:
+    """Raises Error if some members failed to restore or verify."""
+    if stats.errors or stats.mismatches:
+        raise Error("Restore incomplete: %d errors, %d checksum"
+                    " mismatches" % (stats.errors, stats.mismatches))
+
+
+class RestoreManager:
+    """Class which restores files from archives.
+
+    This is the counterpart of the BackupManager, driven by the
+    options of the restore command. The given archives (usually a
+    level 0 archive followed by level 1 ones) are merged into a single
+    plan, in which the newest version of each file wins, so that each
+    file is written only once. The file data is extracted by a pool of
+    workers, and the metadata (owner, permissions, modification time)
+    is applied at the end.
 
-        statres = os.stat(final_tar)
-        logging.info("Archive generated at '%s', size %i.",
-                     final_tar, statres.st_size)
+    """
+    def __init__(self, options: argparse.Namespace) -> None:
+        """Constructor for RestoreManager."""
+        self.options = options
+        self.lock = threading.Lock()
+        self.done: List[Tuple[str, tarfile.TarInfo]] = []
+        self.deferred: List[Tuple[str, tarfile.TarInfo]] = []
+        self.errors = 0
+        self.mismatches = 0
+        self.expected: Dict[str, str] = {}
 
-        # Now update the database with the files which have been stored
-        if fs_manager is not None:
-            for path in self.fs_donelist:
-                fs_manager.notifywritten(path)
-            # Close the db now
-            fs_manager.close()
-        return Stats(final_tar, f_stored, f_skipped, c_stored, c_skipped)
+    def _target(self, name: str) -> str:
+        """Returns the restore path of a member.
+
+        Members which would be restored outside the destination
+        directory (e.g. via '..' components), or through a symbolic
+        link in it, are refused (with Error).
+
+        """
+        destdir = os.path.abspath(self.options.destdir)
+        if not name.startswith(FS_PREFIX + "/"):
+            raise Error("Invalid member name '%s'" % name)
+        target = os.path.normpath(os.path.join(destdir,
+                                               name[len(FS_PREFIX) + 1:]))
+        if not isunder(target, destdir):
+            raise Error("Member '%s' is outside the destination directory" %
+                        name)
+        path = destdir
+        for part in os.path.relpath(target, destdir).split(os.sep)[:-1]:
+            path = os.path.join(path, part)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                break
+            if stat.S_ISLNK(st.st_mode):
+                raise Error("Refusing to restore '%s' through the symbolic"
+                            " link '%s'" % (name, path))
+        return target
+
+    def _selected(self, name: str) -> bool:
+        """Checks whether a member has been selected for restore."""
+        if not name.startswith(FS_PREFIX + "/"):
+            return False
+        if not self.options.paths:
+            return True
+        for path in self.options.paths:
+            prefix = fsmember(path)
+            if name == prefix or name.startswith(prefix + "/"):
+                return True
+        return False
+
+    def _plan(self, readers: List['ArchiveReader']) -> Dict[str, int]:
+        """Builds the restore plan, mapping members to archives.
+
+        Files recorded as deleted in an archive are not restored from
+        the older archives.
+
+        """
+        plan: Dict[str, int] = {}
+        for (idx, reader) in enumerate(readers):
+            for name in reader.names():
+                if self._selected(name):
+                    plan[name] = idx
+            for path in reader.deleted:
+                name = fsmember(path)
+                if plan.get(name, idx) < idx:
+                    logging.debug("Not restoring deleted file '%s'", path)
+                    del plan[name]
+        return plan
+
+    def _expectations(self, readers: List['ArchiveReader'],
+                      plan: Dict[str, int]) -> None:
+        """Computes the expected checksums of the restored files.
+
+        These come from the archive index if available, or from the
+        state database for the files restored from the first (level 0)
+        archive.
+
+        """
+        statedb: Optional[StateDB] = None
+        if self.options.statefile is not None:
+            statedb = StateDB(self.options.statefile, "r")
+            statedb.validate()
+        try:
+            for (name, idx) in plan.items():
+                index = readers[idx].index
+                if index is not None:
+                    if index[name].digest:
+                        self.expected[name] = index[name].digest
+                elif statedb is not None and idx == 0:
+                    data = statedb.get(StateDB.filekey(
+                        "/" + name[len(FS_PREFIX) + 1:]))
+                    if data is None:
+                        continue
+                    try:
+                        fstate = FileState(serialdata=data)
+                    except ValueError:
+                        continue
+                    if fstate.checksum:
+                        self.expected[name] = fstate.checksum
+        finally:
+            if statedb is not None:
+                statedb.close()
+
+    def _writefile(self, target: str, data: IO[bytes]) -> str:
+        """Writes a regular file, returning its checksum.
+
+        Like tar, an existing file is replaced rather than overwritten,
+        so that nothing is written through a hard link to a file
+        outside the destination.
+
+        """
+        if os.path.islink(target) or \
+           (os.path.lexists(target) and not os.path.isdir(target)):
+            os.unlink(target)
+        checksum = hashlib.sha512()
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     os.O_NOFOLLOW, 0o600)
+        with open(fd, "wb") as out:
+            while True:
+                chunk = data.read(COPY_BUFSIZE)
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                out.write(chunk)
+        return checksum.hexdigest()
+
+    def _restore(self, tinfo: tarfile.TarInfo,
+                 data: Optional[IO[bytes]]) -> None:
+        """Restores a single member, without its metadata."""
+        name = tinfo.name
+        target = name
+        try:
+            target = self._target(name)
+            if tinfo.islnk() or tinfo.issym():
+                # links are created at the end, so that no path is
+                # written through a restored symbolic link
+                with self.lock:
+                    self.deferred.append((target, tinfo))
+                return
+            parent = os.path.dirname(target)
+            if not os.path.isdir(parent):
+                os.makedirs(parent, exist_ok=True)
+            if tinfo.isdir():
+                if os.path.islink(target):
+                    raise Error("Refusing to restore '%s' through the"
+                                " symbolic link '%s'" % (name, target))
+                os.makedirs(target, exist_ok=True)
+            elif tinfo.isreg():
+                assert data is not None
+                checksum = self._writefile(target, data)
+                expected = self.expected.get(name, None)
+                if expected is not None and expected != checksum:
+                    logging.error("Checksum mismatch for '%s'", target)
+                    with self.lock:
+                        self.mismatches += 1
+            else:
+                if os.path.lexists(target):
+                    os.unlink(target)
+                if tinfo.isfifo():
+                    os.mkfifo(target)
+                elif tinfo.ischr() or tinfo.isblk():
+                    kind = stat.S_IFCHR if tinfo.ischr() else stat.S_IFBLK
+                    os.mknod(target, tinfo.mode | kind,
+                             os.makedev(tinfo.devmajor, tinfo.devminor))
+                else:  # pragma: no cover
+                    logging.warning("Unsupported type for '%s'", name)
+                    return
+        except (EnvironmentError, Error) as err:
+            logging.error("Cannot restore '%s': %s", target, err)
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.done.append((target, tinfo))
+
+    def _restoremember(self, reader: 'ArchiveReader', name: str) -> None:
+        """Worker function for restoring one member."""
+        with reader.member(name) as (tinfo, data):
+            self._restore(tinfo, data)
+
+    def _restoreall(self, reader: 'ArchiveReader', wanted: Set[str]) -> None:
+        """Worker function for sequentially restoring an archive."""
+        for (tinfo, data) in reader.iterate(wanted):
+            self._restore(tinfo, data)
+
+    def _restorelinks(self) -> None:
+        """Restores the hard and symbolic links.
+
+        The hard links are restored first, once their targets exist,
+        and the symbolic links last; the parents of each link are
+        checked again, as they could be links restored just before.
+
+        """
+        for (target, tinfo) in sorted(self.deferred,
+                                      key=lambda x: x[1].issym()):
+            try:
+                target = self._target(tinfo.name)
+                parent = os.path.dirname(target)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent, exist_ok=True)
+                if os.path.lexists(target):
+                    os.unlink(target)
+                if tinfo.issym():
+                    os.symlink(tinfo.linkname, target)
+                else:
+                    os.link(self._target(tinfo.linkname), target,
+                            follow_symlinks=False)
+            except (EnvironmentError, Error) as err:
+                logging.error("Cannot restore '%s': %s", target, err)
+                self.errors += 1
+            else:
+                self.done.append((target, tinfo))
+
+    @staticmethod
+    def _owner(tinfo: tarfile.TarInfo) -> Tuple[int, int]:
+        """Returns the uid/gid for a member, preferring the names."""
+        uid, gid = tinfo.uid, tinfo.gid
+        try:
+            if tinfo.uname:
+                uid = pwd.getpwnam(tinfo.uname).pw_uid
+        except KeyError:
+            pass
+        try:
+            if tinfo.gname:
+                gid = grp.getgrnam(tinfo.gname).gr_gid
+        except KeyError:
+            pass
+        return (uid, gid)
+
+    def _setmetadata(self) -> None:
+        """Applies the metadata of all restored members.
+
+        This is done deepest paths first, so that restoring a file
+        doesn't modify its (already restored) parent directory.
+
+        """
+        is_root = os.geteuid() == 0
+        nofollow = os.utime in os.supports_follow_symlinks
+        for (target, tinfo) in sorted(self.done, reverse=True,
+                                      key=lambda x: x[0].count("/")):
+            try:
+                if is_root:
+                    os.lchown(target, *self._owner(tinfo))
+                if tinfo.issym():
+                    if nofollow:
+                        os.utime(target, (tinfo.mtime, tinfo.mtime),
+                                 follow_symlinks=False)
+                    continue
+                os.chmod(target, tinfo.mode)
+                os.utime(target, (tinfo.mtime, tinfo.mtime))
+            except EnvironmentError as err:
+                logging.error("Cannot set metadata for '%s': %s",
+                              target, err)
+                self.errors += 1
+
+    def run(self) -> RestoreStats:
+        """Restores the selected files."""
+        opts = self.options
+        if not os.path.isdir(opts.destdir):
+            raise Error("Destination directory '%s' is not a directory" %
+                        opts.destdir)
+        try:
+            readers = [ArchiveReader(path) for path in opts.archives]
+            plan = self._plan(readers)
+            self._expectations(readers, plan)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, opts.jobs)) as pool:
+                futures = []
+                for (idx, reader) in enumerate(readers):
+                    wanted = set(n for (n, i) in plan.items() if i == idx)
+                    if not wanted:
+                        continue
+                    if reader.seekable:
+                        for name in sorted(wanted):
+                            futures.append(pool.submit(self._restoremember,
+                                                       reader, name))
+                    else:
+                        futures.append(pool.submit(self._restoreall,
+                                                   reader, wanted))
+                for future in futures:
+                    future.result()
+        except (EnvironmentError, tarfile.TarError) as err:
+            raise Error("Can't restore from archives: %s" % err) from err
+        self._restorelinks()
+        self._setmetadata()
+        logging.info("Restored %d members from %d archive(s), %d errors,"
+                     " %d checksum mismatches.", len(self.done),
+                     len(readers), self.errors, self.mismatches)
+        return RestoreStats(len(self.done), self.errors, self.mismatches)
+
+
+DIFF_ADDED = "added"
+DIFF_REMOVED = "removed"
+DIFF_MODIFIED = "modified"
+DIFF_METADATA = "metadata"
+
+DiffEntry = collections.namedtuple("DiffEntry", "change path fields")
+
+
+def statediff(old: bytes, new: bytes) -> Tuple[str, List[str]]:
+    """Classifies the change between two serialized file states.
+
+    Returns the kind of change (modified or metadata only) and the
+    list of changed fields.
+
+    """
+    try:
+        sa = FileState(serialdata=old.decode(ENCODING))
+        sb = FileState(serialdata=new.decode(ENCODING))
+    except ValueError:
+        return (DIFF_MODIFIED, ["unparseable"])
+    a = sa.statinfo
+    b = sb.statinfo
+    assert a is not None and b is not None
+    fields = []
+    if stat.S_IFMT(a.mode) != stat.S_IFMT(b.mode):
+        fields.append("type")
+    if a.size != b.size:
+        fields.append("size")
+    if a.lnkdest != b.lnkdest:
+        fields.append("lnkdest")
+    # pylint: disable=W0212
+    if sa._checksum != sb._checksum:
+        fields.append("checksum")
+    change = DIFF_MODIFIED if fields else DIFF_METADATA
+    if stat.S_IMODE(a.mode) != stat.S_IMODE(b.mode):
+        fields.append("mode")
+    # the chunk checksums only change on their own if they were added
+    # (or dropped) for an unchanged file
+    if sa._chunks != sb._chunks:
+        fields.append("chunks")
+    if a.user != b.user:
+        fields.append("user")
+    if a.group != b.group:
+        fields.append("group")
+    if a.mtime != b.mtime:
+        fields.append("mtime")
+    return (change, fields)
+
+
+def diffstates(dba: StateDB, dbb: StateDB) -> Iterator[DiffEntry]:
+    """Compares two state databases.
+
+    The file keys of both databases are sorted and then merge-joined,
+    so that the databases are read only once; entries whose serialized
+    state is identical are skipped without being parsed.
+
+    """
+    keysa = dba.filekeys()
+    keysb = dbb.filekeys()
+    plen = len(StateDB.filekey(""))
+    ia = ib = 0
+    while ia < len(keysa) or ib < len(keysb):
+        ka = keysa[ia] if ia < len(keysa) else None
+        kb = keysb[ib] if ib < len(keysb) else None
+        if kb is None or (ka is not None and ka < kb):
+            assert ka is not None
+            yield DiffEntry(DIFF_REMOVED, ka[plen:].decode(ENCODING), [])
+            ia += 1
+        elif ka is None or kb < ka:
+            yield DiffEntry(DIFF_ADDED, kb[plen:].decode(ENCODING), [])
+            ib += 1
+        else:
+            va = dba.getraw(ka)
+            vb = dbb.getraw(kb)
+            if va != vb:
+                (change, fields) = statediff(va, vb)
+                yield DiffEntry(change, ka[plen:].decode(ENCODING), fields)
+            ia += 1
+            ib += 1
+
+
+def writediff(entries: Iterable[DiffEntry], fmt: str,
+              out: TextIO) -> Dict[str, int]:
+    """Writes the differences in the given format.
+
+    Returns the number of changes of each kind.
+
+    """
+    counts = dict((k, 0) for k in (DIFF_ADDED, DIFF_REMOVED,
+                                   DIFF_MODIFIED, DIFF_METADATA))
+    for entry in entries:
+        counts[entry.change] += 1
+        if fmt == "json":
+            out.write(json.dumps({"change": entry.change,
+                                  "path": entry.path,
+                                  "fields": entry.fields}) + "\n")
+        else:
+            out.write("%-8s %s\n" % (entry.change, entry.path))
+    return counts
+
+
+def parse_size(value: str) -> int:
+    """Parses a size given on the command line, e.g. 100M."""
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    mult = units.get(value[-1:].lower(), 1)
+    try:
+        size = int(value[:-1] if mult > 1 else value) * mult
+    except ValueError:
+        size = 0
+    if size <= 0:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % value)
+    return size
+
+
+def parse_interval(value: str) -> float:
+    """Parses a (positive) interval given on the command line."""
+    try:
+        interval = float(value)
+    except ValueError:
+        interval = 0.0
+    if not 0 < interval < float("inf"):
+        raise argparse.ArgumentTypeError("invalid interval '%s'" % value)
+    return interval
 
 
 def build_options() -> argparse.ArgumentParser:
@@ -1007,12 +4794,36 @@ See the manpage for more information. Defaults are:
     gen.add_argument("-S", "--statefile", dest="statefile",
                      help="location of the state file (overrides config file)",
                      metavar="FILE", default=None)
+    gen.add_argument("--read-order", dest="read_order",
+                     choices=READ_ORDERS,
+                     help="order in which the file contents are read: as"
+                     " found by the directory walk, or sorted by inode"
+                     " number or physical location, per device; the"
+                     " latter help with rotating disks"
+                     " (default: %(default)s)",
+                     default=READ_ORDER_WALK)
+    gen.add_argument("--preserve-cache", dest="preserve_cache",
+                     action="store_true",
+                     help="read the files without updating their access"
+                     " time and without evicting other data from the page"
+                     " cache", default=False)
+    gen.add_argument("--only", dest="only", nargs="+",
+                     help="only back up the given paths (which must be"
+                     " included by the configuration), and update only"
+                     " their entries in the state file; this is a level 0"
+                     " backup of just these paths", metavar="PATH",
+                     default=None)
 
     out = op.add_argument_group(title="Archive creation/output")
     out.add_argument("-f", "--file", dest="file",
                      help="name of the archive file to be generated "
-                     "(default: '{}-L$level.tar')".format(archive_id),
+                     "(default: '{}-L$level.tar'); use '-' for the"
+                     " standard output".format(archive_id),
                      metavar="ARCHIVE", default=None)
+    out.add_argument("--stdout", dest="stdout",
+                     help="write the archive to the standard output, "
+                     "same as '-f -'",
+                     action="store_true", default=False)
     out.add_argument("-d", "--dir", dest="destdir",
                      help="the directory where to store the archive "
                      "(default: %(default)s)",
@@ -1024,11 +4835,24 @@ See the manpage for more information. Defaults are:
     out.add_argument("-F", "--format", dest="format",
                      help="specify the archive format (default: gnu)",
                      choices=FORMATS.keys())
+    out.add_argument("--index", dest="index",
+                     help="write an index of the archive members next to "
+                     "the archive (as ARCHIVE%s), for fast restores of "
+                     "single files; compressed archives are then written "
+                     "in independent blocks" % INDEX_SUFFIX,
+                     action="store_true", default=False)
     out.add_argument("--archive-id", dest="archive_id",
                      help="informational identifier to store in "
                      "the generated archive (default: '%(default)s')",
                      default=archive_id)
 
+    out.add_argument("--volume-size", dest="volume_size",
+                     help="split the archive into volumes of about this "
+                     "size before compression (with an optional k, M or "
+                     "G suffix), each a complete archive, which are "
+                     "compressed in parallel",
+                     metavar="SIZE", type=parse_size, default=None)
+
     comp = op.add_argument_group(title="Compression options").\
         add_mutually_exclusive_group()
     comp.add_argument("-g", "--gzip", dest="compression",
@@ -1040,6 +4864,11 @@ See the manpage for more information. Defaults are:
     comp.add_argument("-x", "--xz", dest="compression",
                       help="enable compression with xz (lzma)",
                       action="store_const", const=COMP_XZ)
+    comp.add_argument("-a", "--auto-compress", dest="compression",
+                      help="choose the compression codec and level "
+                      "automatically, based on measurements and the "
+                      "configured compression_budget",
+                      action="store_const", const=COMP_AUTO)
 
     noact = op.add_argument_group(title="Skipping actions")
     noact.add_argument("--no-filesystem", dest="do_files",
@@ -1049,23 +4878,187 @@ See the manpage for more information. Defaults are:
                        help="skip command execution and the storing "
                        "of their results",
                        action="store_false", default=True)
+
+    status = op.add_argument_group(title="Progress reporting")
+    dest = status.add_mutually_exclusive_group()
+    dest.add_argument("--status-fd", dest="status_fd", type=int,
+                      help="write progress records (JSON, one per line)"
+                      " to the file descriptor N",
+                      metavar="N", default=None)
+    dest.add_argument("--status-socket", dest="status_socket",
+                      help="send the progress records to the Unix socket"
+                      " at PATH", metavar="PATH", default=None)
+    status.add_argument("--status-interval", dest="status_interval",
+                        type=parse_interval,
+                        help="seconds between the progress records"
+                        " (default: %(default)s)",
+                        metavar="SECONDS", default=STATUS_INTERVAL)
+
+    ckpt = op.add_argument_group(title="Checkpoints")
+    ckpt.add_argument("--checkpoint-interval", dest="checkpoint_interval",
+                      type=float,
+                      help="seconds between the checkpoints of level 0"
+                      " backups, 0 to disable (default: %d, for"
+                      " compressed archives only with --index or -a)" %
+                      CHECKPOINT_INTERVAL,
+                      metavar="SECONDS", default=None)
+    ckpt.add_argument("--resume", dest="resume", action="store_true",
+                      help="resume an interrupted level 0 backup from"
+                      " its last checkpoint, writing the remaining files"
+                      " to a continuation archive", default=False)
+
+    prof = op.add_argument_group(title="Profiling")
+    prof.add_argument("--profile", dest="profile",
+                      help="record the time spent on each path and"
+                      " command, and report the slowest ones on the"
+                      " standard error at the end",
+                      action="store_true", default=False)
+    prof.add_argument("--profile-top", dest="profile_top", type=int,
+                      help="how many paths, directories and commands to"
+                      " report (default: %(default)s)",
+                      metavar="N", default=PROFILE_TOP)
+    prof.add_argument("--profile-dump", dest="profile_dump",
+                      help="write the cProfile statistics of the run to"
+                      " FILE, for analysis with pstats",
+                      metavar="FILE", default=None)
     return op
 
 
-def real_main() -> None:  # pragma: no cover
-    """Main function"""
+def build_restore_options() -> argparse.ArgumentParser:
+    """Builds the options structure for the restore command"""
 
-    os.umask(0o077)
-    op = build_options()
-    options = op.parse_args()
-    if options.verbose >= 2:
+    usage = """\
+Restores files from bakonf archives.
+
+Multiple archives can be given (e.g. a level 0 and its level 1
+archives), in which case the newest version of each file is restored.
+If an index file (as generated by the --index option) is found next to
+an archive, the selected files are read directly from their location
+in the archive, without decompressing the entire archive.
+"""
+    op = argparse.ArgumentParser(
+        prog="bakonf restore",
+        description=usage,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    op.set_defaults(verbose=1)
+    op.add_argument("-v", "--verbose", dest="verbose", action="count",
+                    help="be verbose in operation")
+    op.add_argument("-q", "--quiet", dest="verbose", action="store_const",
+                    help="set verbosity to zero", const=0)
+    op.add_argument("-C", "--directory", dest="destdir",
+                    help="the directory under which to restore the files "
+                    "(default: the current directory)",
+                    metavar="DIRECTORY", default=".")
+    op.add_argument("-p", "--path", dest="paths", action="append",
+                    help="restore only the given path (can be given "
+                    "multiple times; default: restore all files)",
+                    metavar="PATH", default=[])
+    op.add_argument("-j", "--jobs", dest="jobs", type=int,
+                    help="number of parallel extraction workers "
+                    "(default: %(default)s)",
+                    metavar="N", default=RESTORE_JOBS)
+    op.add_argument("-S", "--statefile", dest="statefile",
+                    help="verify the restored files against the "
+                    "checksums in this state file (that of the first, "
+                    "level 0 archive)",
+                    metavar="FILE", default=None)
+    op.add_argument("archives", metavar="ARCHIVE", nargs="+",
+                    help="the archives to restore from, oldest first "
+                    "(e.g. a level 0 archive and its level 1 ones)")
+    return op
+
+
+def build_diff_options() -> argparse.ArgumentParser:
+    """Builds the options structure for the diff command"""
+
+    usage = """\
+Shows the differences between two state files.
+
+Only the state files are read (not the file system), so this can be
+used for example to compare the state files of different systems, or
+archived state files of the same system.
+"""
+    op = argparse.ArgumentParser(
+        prog="bakonf diff",
+        description=usage,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    op.set_defaults(verbose=1)
+    op.add_argument("-v", "--verbose", dest="verbose", action="count",
+                    help="be verbose in operation")
+    op.add_argument("-q", "--quiet", dest="verbose", action="store_const",
+                    help="set verbosity to zero", const=0)
+    op.add_argument("-F", "--format", dest="format",
+                    choices=["text", "json"],
+                    help="output format: text, or json (one object per"
+                    " line) (default: %(default)s)",
+                    default="text")
+    op.add_argument("old", metavar="OLD_STATEFILE",
+                    help="the old state file")
+    op.add_argument("new", metavar="NEW_STATEFILE",
+                    help="the new state file")
+    return op
+
+
+def setup_logging(verbose: int) -> None:  # pragma: no cover
+    """Configures logging based on the verbosity level."""
+    if verbose >= 2:
         lvl = logging.DEBUG
-    elif options.verbose == 1:
+    elif verbose == 1:
         lvl = logging.INFO
     else:
         lvl = logging.WARNING
     logging.basicConfig(level=lvl, format="%(levelname)s: %(message)s")
 
+
+def restore_main(args: List[str]) -> None:  # pragma: no cover
+    """Main function for the restore command"""
+
+    os.umask(0o077)
+    options = build_restore_options().parse_args(args)
+    setup_logging(options.verbose)
+    checkrestore(RestoreManager(options).run())
+
+
+def diff_main(args: List[str]) -> None:  # pragma: no cover
+    """Main function for the diff command"""
+
+    options = build_diff_options().parse_args(args)
+    setup_logging(options.verbose)
+    dbs = []
+    try:
+        for path in (options.old, options.new):
+            try:
+                statedb = StateDB(path, "r")
+            except bsddb3.db.DBError as err:
+                raise ConfigurationError(path, "Can't open the database: %s"
+                                         % err) from err
+            dbs.append(statedb)
+            statedb.validate()
+        counts = writediff(diffstates(dbs[0], dbs[1]), options.format,
+                           sys.stdout)
+    finally:
+        for statedb in dbs:
+            statedb.close()
+    logging.info("%d added, %d removed, %d modified, %d metadata only.",
+                 counts[DIFF_ADDED], counts[DIFF_REMOVED],
+                 counts[DIFF_MODIFIED], counts[DIFF_METADATA])
+
+
+def real_main() -> None:  # pragma: no cover
+    """Main function"""
+
+    if sys.argv[1:2] == ["restore"]:
+        restore_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["diff"]:
+        diff_main(sys.argv[2:])
+        return
+
+    os.umask(0o077)
+    op = build_options()
+    options = op.parse_args()
+    setup_logging(options.verbose)
+
     if not options.do_files and not options.do_commands:
         raise Error("Nothing to backup!")
 
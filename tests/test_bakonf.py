@@ -1,10 +1,21 @@
 """Tests for bakonf"""
 
+import argparse
+import errno
+import hashlib
+import io
+import json
 import os
 import os.path
+import socket
+import pstats
+import stat
+import sys
 import collections
 import tarfile
+import threading
 import time
+import types
 import pytest
 
 import bakonf
@@ -188,6 +199,9 @@ def test_opts_comp_xz_fail(env, monkeypatch):
     opts.compression = bakonf.COMP_XZ
     with pytest.raises(bakonf.Error, match="doesn't support LZMA"):
         bakonf.BackupManager(opts).run()
+    # the compressors are guarded as well
+    with pytest.raises(bakonf.Error, match="doesn't support LZMA"):
+        bakonf.BlockCompressor.newcompressor(bakonf.COMP_XZ)
 
 
 def test_opts_comp_unsupported(env, monkeypatch):
@@ -198,6 +212,92 @@ def test_opts_comp_unsupported(env, monkeypatch):
         bakonf.BackupManager(opts).run()
 
 
+def test_choosecompression():
+    codecs = [bakonf.COMP_GZ, bakonf.COMP_BZ2]
+    assert bakonf.choosecompression({}, None, None, codecs) == \
+        (bakonf.COMP_GZ, 6)
+    rates = {"gz:1": [100.0, 0.5], "gz:9": [10.0, 0.3],
+             "bz2:9": [5.0, 0.2], "xz:6": [1.0, 0.1]}
+    # the best ratio, unless too slow for the budget
+    assert bakonf.choosecompression(rates, None, None, codecs) == \
+        (bakonf.COMP_BZ2, 9)
+    assert bakonf.choosecompression(rates, 10, 80, codecs) == \
+        (bakonf.COMP_GZ, 9)
+    assert bakonf.choosecompression(rates, 1, 1000, codecs) == \
+        (bakonf.COMP_GZ, 1)
+
+
+def test_adaptive_levels(env):
+    blockc = bakonf.AdaptiveCompressor(str(env.tmpdir.join("a")),
+                                       bakonf.COMP_GZ, 6, 10.0, 10000000,
+                                       {"gz:6": [100.0, 0.3]})
+    blockc.write(b"x" * 100)
+    blockc.endblock()
+    # far too slow for the budget
+    assert blockc.level == 1
+    blockc.rates["gz:1"] = [1e9, 0.5]
+    blockc._adjust()
+    assert blockc.level == 1
+    blockc.rates["gz:6"] = [1e8, 0.3]
+    blockc._adjust()
+    assert blockc.level == 6
+    # already compressed data goes in separate, unmeasured blocks
+    blockc.bypass(True)
+    blockc.write(os.urandom(bakonf.AUTO_MIN_SAMPLE))
+    blockc.bypass(False)
+    assert set(blockc.rates) == {"gz:1", "gz:6"}
+    blockc.close()
+
+
+def test_auto_compress(env):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    env.fs.join("text").write("%s\n" % FOO * bakonf.AUTO_SAMPLE)
+    env.fs.join("data.gz").write_binary(os.urandom(bakonf.AUTO_MIN_SAMPLE))
+    stats = bakonf.BackupManager(buildopts(env, ["-a"])).run()
+    assert stats.filename.endswith(".tar.gz")
+    a = Archive(stats)
+    assert a.has_file(env.fs.join("data.gz"))
+    assert a.file_data(env.fs.join("text")).startswith(FOO)
+    statedb = bakonf.StateDB(str(env.tmpdir.join("db")), "r")
+    history = json.loads(statedb.get(bakonf.DBKEY_COMPRESSION))
+    statedb.close()
+    assert history["payload"] > bakonf.AUTO_SAMPLE * 4
+    assert "bz2:9" in history["rates"]
+    # the next run chooses based on the measurements
+    env.fs.join("text").write(BAR)
+    stats = bakonf.BackupManager(buildopts(env, ["-a", "-L", "1"])).run()
+    assert Archive(stats).file_data(env.fs.join("text")) == BAR
+    opts = buildopts(env, ["-a", "--stdout"])
+    with pytest.raises(bakonf.Error, match="standard output"):
+        bakonf.BackupManager(opts).run()
+
+
+def test_auto_compress_adapts(env, monkeypatch):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\ncompression_budget: 0.001\n" % env.fs)
+    for i in range(3):
+        env.fs.join("f%d" % i).write(("%d %s\n" % (i, FOO)) * 200000)
+    bakonf.BackupManager(buildopts(env)).run()
+    # pretend that the best level is fast enough for the budget
+    statedb = bakonf.StateDB(str(env.tmpdir.join("db")), "w")
+    statedb.put(bakonf.DBKEY_COMPRESSION, json.dumps(
+        {"rates": {"gz:9": [1e15, 0.1]}, "payload": 3000000}))
+    statedb.close()
+    levels = []
+    newblock = bakonf.AdaptiveCompressor._newblock
+
+    def recording(self):
+        levels.append(self.level)
+        return newblock(self)
+    monkeypatch.setattr(bakonf.AdaptiveCompressor, "_newblock", recording)
+    opts = buildopts(env, ["-a", "--checkpoint-interval", "0"])
+    stats = bakonf.BackupManager(opts).run()
+    assert stats.filename.endswith(".tar.gz")
+    # blocks are ended by size, and the level lowered for the next ones
+    assert levels[0] == 9 and levels[-1] == 1
+
+
 @pytest.mark.parametrize("key", ["DBKEY_VERSION",
                                  "DBKEY_DATE"])
 def test_bad_db_missing_key(env, monkeypatch, key):
@@ -270,6 +370,18 @@ def test_extra_cfg(env):
     ("include:\n- null\n", "Invalid include entry"),
     ("exclude:\n- null\n", "Invalid exclude entry"),
     ("maxsize: abc\n", "Invalid maxsize"),
+    ("max_read_bytes_per_sec: abc\n", "Invalid max_read_bytes_per_sec"),
+    ("max_files_per_sec: 0\n", "must be positive"),
+    ("compression_budget: -5\n", "must be positive"),
+    ("nice: [1]\n", "Invalid nice"),
+    ("ionice_class: low\n", "Invalid ionice_class"),
+    ("ionice_level: 8\n", "Invalid ionice_level"),
+    ("scan_workers: -1\n", "Invalid scan_workers"),
+    ("roots: [relative]\n", "Invalid roots entry"),
+    ("roots: [/a, {path: /b, name: a}]\n", "duplicate root name"),
+    ("root_jobs: 0\n", "Invalid root_jobs"),
+    ("commands:\n- cmd: []\n", "Invalid 'cmd' key"),
+    ("commands:\n- cmd: [ls, null]\n", "Invalid 'cmd' key"),
     ])
 def test_bad_cfg(env, line, msg):
     opts = buildopts(env)
@@ -303,6 +415,70 @@ def test_cmd_slash(env):
     assert a.cmd_data("echo") == "test\n"
 
 
+def test_cmd_incremental(env):
+    opts = buildopts(env)
+    counter = env.tmpdir.join("counter")
+    counter.write("0")
+    with env.config.open("a") as f:
+        f.write("commands:\n")
+        f.write("- cmd: echo same\n  dest: same\n")
+        f.write("- cmd: echo x >> %s; cat %s\n  dest: changing\n" %
+                (counter, counter))
+        f.write("- cmd: echo failing; exit 1\n  dest: failing\n")
+    stats = bakonf.BackupManager(opts).run()
+    a = Archive(stats)
+    assert a.has_cmd("same") and a.has_cmd("changing")
+    assert not a.has_member(bakonf.UNCHANGED_CMDS_LIST)
+    opts.level = 1
+    stats = bakonf.BackupManager(opts).run()
+    assert stats_cnt(stats) == (0, 0, 3, 1)
+    a = Archive(stats)
+    assert not a.has_cmd("same")
+    assert a.has_cmd("changing")
+    # failed commands are always stored
+    assert a.has_cmd("failing")
+    assert a.contents(bakonf.UNCHANGED_CMDS_LIST) == "same"
+    # without the file system backup, there's no state database
+    opts.do_files = False
+    a = Archive(bakonf.BackupManager(opts).run())
+    assert a.has_cmd("same")
+    assert not a.has_member(bakonf.UNCHANGED_CMDS_LIST)
+
+
+def test_pseudofiles(env):
+    opts = buildopts(env)
+    d = env.tmpdir.mkdir("pseudo")
+    for name in ["a", "b"]:
+        d.join(name).write(name * 3)
+    d.mkdir("subdir")
+    with env.config.open("a") as f:
+        f.write("pseudofiles:\n")
+        f.write("- /proc/version\n")
+        f.write("- path: %s/*\n  dest: glob\n" % d)
+        f.write("- path: %s\n  dest: single\n" % d.join("a"))
+        f.write("- %s\n" % d.join("missing"))
+    stats = bakonf.BackupManager(opts).run()
+    assert stats_cnt(stats) == (0, 0, 5, 1)
+    a = Archive(stats)
+    # zero-sized pseudo-files are read completely
+    with open("/proc/version") as fh:
+        assert a.cmd_data("proc/version") == fh.read()
+    assert a.cmd_data("glob/a") == "aaa"
+    assert a.cmd_data("glob/b") == "bbb"
+    assert not a.has_cmd("glob/subdir")
+    assert a.cmd_data("single") == "aaa"
+    assert a.has_cmd(d.join("missing"))
+    assert "cannot be read" in a.contents("commands_with_errors.lst")
+
+
+@pytest.mark.parametrize("line", ["pseudofiles: [null]\n",
+                                  "pseudofiles:\n- dest: x\n"])
+def test_pseudofiles_bad(env, line):
+    env.config.write(line)
+    with pytest.raises(bakonf.Error, match="Invalid pseudofiles entry"):
+        bakonf.BackupManager(buildopts(env))
+
+
 def test_cmd_no_commands(env):
     opts = buildopts(env)
     with env.config.open("a") as f:
@@ -331,6 +507,69 @@ def test_cmd_signal(env):
     assert stats_cnt(bm.run()) == (0, 0, 1, 1)
 
 
+@pytest.mark.parametrize("posix_spawn", [True, False])
+def test_cmd_argv(env, monkeypatch, posix_spawn):
+    monkeypatch.setattr(bakonf, "HAVE_POSIX_SPAWN", posix_spawn)
+    # the commands run from the root directory, without changing ours
+    # (which might not even exist anymore)
+    gone = env.tmpdir.mkdir("gone")
+    monkeypatch.chdir(gone)
+    gone.remove()
+
+    def nochdir(path):
+        raise AssertionError("chdir(%r)" % (path,))
+    monkeypatch.setattr(os, "chdir", nochdir)
+    monkeypatch.setattr(os, "fchdir", nochdir)
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("commands:\n")
+        f.write("- cmd: [printf, '%s|', 'a b', '$HOME', 3]\n  dest: args\n")
+        f.write("- cmd: [pwd]\n")
+        f.write("- cmd: [sh, -c, 'kill $$']\n  dest: killed\n")
+    bm = bakonf.BackupManager(opts)
+    stats = bm.run()
+    assert stats_cnt(stats) == (0, 0, 3, 1)
+    a = Archive(stats)
+    # arguments are passed verbatim, without shell expansion
+    assert a.cmd_data("args") == "a b|$HOME|3|"
+    assert a.cmd_data("pwd") == "/\n"
+    assert "signal" in a.contents("commands_with_errors.lst")
+    assert [cmd.command for cmd in bm.cmd_outputs] == \
+        ["printf '%s|' 'a b' '$HOME' 3", "pwd", "sh -c 'kill $$'"]
+    assert all(cmd.latency >= 0 for cmd in bm.cmd_outputs)
+
+
+def test_spawn_reaps(monkeypatch):
+    if not bakonf.HAVE_POSIX_SPAWN:
+        pytest.skip("posix_spawn not available")
+    reaped = []
+    waitpid = os.waitpid
+
+    def failing_read(fd, size):
+        raise OSError(errno.EIO, "Input/output error")
+
+    def recording_waitpid(pid, options):
+        reaped.append(pid)
+        return waitpid(pid, options)
+    monkeypatch.setattr(os, "read", failing_read)
+    monkeypatch.setattr(os, "waitpid", recording_waitpid)
+    with pytest.raises(OSError):
+        bakonf.spawn(["true"])
+    assert len(reaped) == 1
+
+
+def test_cmd_not_found(env):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("commands:\n")
+        f.write("- cmd: [/nonexistent/command]\n  dest: missing\n")
+    stats = bakonf.BackupManager(opts).run()
+    assert stats_cnt(stats) == (0, 0, 1, 1)
+    a = Archive(stats)
+    assert a.cmd_data("missing") == ""
+    assert "could not be executed" in a.contents("commands_with_errors.lst")
+
+
 def test_fs_empty(env):
     opts = buildopts(env)
     with env.config.open("a") as f:
@@ -493,10 +732,12 @@ def test_fs_incremental_changed_type(env, from_symlink):
     assert Archive(stats).fl_data(not from_symlink, fa) == BAR
 
 
-def test_fs_lstat_error(env, monkeypatch):
+@pytest.mark.parametrize("workers", [0, 4])
+def test_fs_lstat_error(env, monkeypatch, workers):
     opts = buildopts(env)
     with env.config.open("a") as f:
         f.write("include:\n- %s\n" % env.fs)
+        f.write("scan_workers: %d\n" % workers)
     fa = env.fs.join("a")
     fa.write(FOO)
 
@@ -677,3 +918,1184 @@ def test_subjectfile_str(env):
     fa.write(FOO)
     sf = bakonf.SubjectFile(fa)
     assert "checksum" in str(sf)
+
+
+def test_fs_hardlinks(env):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    fb = env.fs.join("b")
+    os.link(str(fa), str(fb))
+    stats = bakonf.BackupManager(opts).run()
+    a = Archive(stats)
+    members = [a.tar.getmember(a.filepath(f)) for f in (fa, fb)]
+    assert sorted(m.islnk() for m in members) == [False, True]
+    assert a.file_data(fa) == FOO
+    assert a.file_data(fb) == FOO
+
+
+@pytest.mark.parametrize("order", bakonf.READ_ORDERS)
+def test_fs_hardlinks_read_once(env, monkeypatch, order):
+    opts = buildopts(env, ["--read-order", order])
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    links = [env.fs.join("d%d" % i, "b") for i in range(3)]
+    for fb in links:
+        fb.dirpath().ensure(dir=True)
+        os.link(str(fa), str(fb))
+    read = []
+    orig = bakonf.FileReader.checksum
+
+    def record(self, path, size):
+        read.append(path)
+        return orig(self, path, size)
+    monkeypatch.setattr(bakonf.FileReader, "checksum", record)
+    stats = bakonf.BackupManager(opts).run()
+    assert len(read) == 1
+    a = Archive(stats)
+    members = [a.tar.getmember(a.filepath(f)) for f in [fa] + links]
+    assert sorted(m.islnk() for m in members) == [False, True, True, True]
+    # the state of all links is recorded, and they are all unchanged
+    opts.level = 1
+    read[:] = []
+    stats = bakonf.BackupManager(opts).run()
+    assert len(read) == 1
+    assert stats.file_count == 0
+
+
+def test_fs_large_file(env):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    data = "".join(chr(ord("a") + i % 26) for i in range(3 * 1024 * 1024 + 7))
+    fa.write(data)
+    stats = bakonf.BackupManager(opts).run()
+    assert Archive(stats).file_data(fa) == data
+
+
+def test_fs_owner_names_cached(env, monkeypatch):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    for name in "abcd":
+        env.fs.join(name).write(name)
+    calls = []
+
+    def getpwuid(uid, up=bakonf.pwd.getpwuid):
+        calls.append(uid)
+        return up(uid)
+    monkeypatch.setattr(bakonf.pwd, "getpwuid", getpwuid)
+    stats = bakonf.BackupManager(opts).run()
+    assert stats.file_count > 4
+    assert len(calls) == len(set(calls))
+    tar = Archive(stats).tar
+    assert tar.getmember(Archive.filepath(env.fs.join("a"))).uname
+
+
+@pytest.mark.parametrize("broken", [
+    ["copy_file_range"],
+    ["copy_file_range", "sendfile"],
+    ])
+def test_fs_zerocopy_fallback(env, monkeypatch, broken):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    files = {"a": "abc" * 1000, "b": "", "c": "x" * 511}
+
+    def fail(*_args, **_kwargs):
+        raise OSError(errno.EXDEV, "Mock raise")
+    for name in broken:
+        monkeypatch.setattr(os, name, fail, raising=False)
+    for (name, data) in files.items():
+        env.fs.join(name).write(data)
+    stats = bakonf.BackupManager(opts).run()
+    a = Archive(stats)
+    for (name, data) in files.items():
+        assert a.file_data(env.fs.join(name)) == data
+
+
+def test_fs_compressed_contents(env, valid_compression_format):
+    opts = buildopts(env)
+    opts.compression = valid_compression_format
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO * 1000)
+    stats = bakonf.BackupManager(opts).run()
+    assert Archive(stats).file_data(fa) == FOO * 1000
+
+
+def test_prefetch_order():
+    assert list(bakonf.prefetch(range(5000), 7)) == list(range(5000))
+
+
+def test_prefetch_error():
+    def gen():
+        yield 1
+        raise ValueError("mock!")
+    it = bakonf.prefetch(gen(), 1)
+    assert next(it) == 1
+    with pytest.raises(ValueError, match="mock!"):
+        next(it)
+
+
+def test_prefetch_early_stop():
+    produced = []
+
+    def gen():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+    it = bakonf.prefetch(gen(), 2)
+    assert next(it) == 0
+    it.close()
+    assert len(produced) < 1000
+
+
+def test_fs_pipeline_order(env):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    for path in ["a/b/c", "a/d", "e/f/g/h", "i"]:
+        env.fs.join(path).ensure().write(path)
+    stats = bakonf.BackupManager(opts).run()
+    names = Archive(stats).names
+    for (idx, name) in enumerate(names):
+        parent = os.path.dirname(name)
+        if parent.startswith("filesystem/"):
+            assert parent in names[:idx]
+
+
+def test_l0_failure_keeps_db(env, monkeypatch):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    env.fs.join("a").write(FOO)
+    bakonf.BackupManager(buildopts(env)).run()
+
+    def fail(*args):
+        raise RuntimeError("killed")
+    monkeypatch.setattr(bakonf.BackupManager, "_addcommands", fail)
+    with pytest.raises(RuntimeError):
+        bakonf.BackupManager(buildopts(env)).run()
+    monkeypatch.undo()
+    # the previous database is still there
+    opts = buildopts(env, ["-L", "1"])
+    assert bakonf.BackupManager(opts).run().file_count == 0
+
+
+def test_partname():
+    assert bakonf.partname("/a/b-L0.tar.gz", 2) == "/a/b-L0.part2.tar.gz"
+    assert bakonf.partname("/a/archive", 1) == "/a/archive.part1"
+
+
+def test_checkpoint_compressed(env, monkeypatch):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    files = [env.fs.join("f%d" % i) for i in range(10)]
+    for fa in files:
+        fa.write(str(fa) * 100)
+    ended = []
+    endblock = bakonf.BlockCompressor.endblock
+
+    def recording(self):
+        ended.append(self.pos)
+        endblock(self)
+    monkeypatch.setattr(bakonf.BlockCompressor, "endblock", recording)
+    # compressed archives aren't checkpointed by default, so that they
+    # stay a single stream
+    stats = bakonf.BackupManager(buildopts(env, ["-g"])).run()
+    assert not ended
+    with tarfile.open(stats.filename, "r|gz") as tar:
+        names = [m.name for m in tar]
+    for fa in files:
+        assert Archive.filepath(fa) in names
+    # if requested, the blocks are only ended by the checkpoints
+    monkeypatch.setattr(bakonf, "INDEX_BLOCKSIZE", 1)
+    opts = buildopts(env, ["-g", "--checkpoint-interval", "3600"])
+    assert bakonf.BackupManager(opts).run().file_count == stats.file_count
+    # the final block is ended when closing the archive
+    assert len(ended) == 1
+
+
+@pytest.mark.parametrize("compression", [[], ["-g"], ["-x", "--index"]])
+def test_checkpoint_resume(env, monkeypatch, compression):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("commands:\n- cmd: echo test\n  dest: echo\n")
+    files = [env.fs.join("f%d" % i) for i in range(10)]
+    for fa in files:
+        fa.write(str(fa) * 100)
+    args = ["--checkpoint-interval", "1e-9"] + compression
+    orig = bakonf.TarArchive.addpath
+    names = [str(fa) for fa in files]
+    added = []
+
+    def addpath(self, path, *args):
+        if len(added) == 4 and path in names:
+            raise RuntimeError("killed")
+        orig(self, path, *args)
+        if path in names:
+            added.append(path)
+    monkeypatch.setattr(bakonf.TarArchive, "addpath", addpath)
+    with pytest.raises(RuntimeError):
+        bakonf.BackupManager(buildopts(env, args)).run()
+    monkeypatch.undo()
+    assert not env.tmpdir.join("db").exists()
+    # a file changed after it was archived is archived again
+    files[0].write("changed")
+    stats = bakonf.BackupManager(buildopts(env, args +
+                                           ["--resume"])).run()
+    partial = Archive(bakonf.Stats(stats.filename.replace(".part1", ""),
+                                   0, 0, 0, 0))
+    cont = Archive(stats)
+    assert ".part1.tar" in stats.filename
+    archived = [str(fa) for fa in files if partial.has_file(fa)]
+    assert sorted(archived) == sorted(added)
+    assert not partial.has_cmd("echo")
+    for fa in files:
+        assert cont.has_file(fa) == (fa == files[0] or
+                                     str(fa) not in archived)
+    assert cont.file_data(files[0]) == "changed"
+    assert cont.cmd_data("echo") == "test\n"
+    # the complete database has been committed
+    assert env.tmpdir.join("db").exists()
+    assert not env.tmpdir.join("db" + bakonf.STATE_NEW_SUFFIX).exists()
+    opts = buildopts(env, ["-L", "1"])
+    assert bakonf.BackupManager(opts).run().file_count == 0
+    with pytest.raises(bakonf.Error, match="No interrupted"):
+        bakonf.BackupManager(buildopts(env, ["--resume"])).run()
+
+
+def test_only(env):
+    counter = env.tmpdir.join("counter")
+    counter.write("0")
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("commands:\n- cmd: cat %s\n  dest: counter\n" % counter)
+    da = env.fs.mkdir("a")
+    (fa1, fa2, fa3) = (da.join("a1"), da.join("a2"), da.join("a3"))
+    fb = env.fs.mkdir("b").join("b1")
+    for fx in (fa1, fa2, fb):
+        fx.write(FOO)
+    bakonf.BackupManager(buildopts(env)).run()
+    fa1.write(BAR)
+    fa2.remove()
+    fa3.write(BAR)
+    fb.write(BAR)
+    counter.write("1")
+    stats = bakonf.BackupManager(buildopts(env, ["--only", str(da)])).run()
+    assert ".only-" in stats.filename
+    a = Archive(stats)
+    assert a.has_file(fa1) and a.has_file(fa3)
+    assert not a.has_file(fb)
+    assert a.contents(bakonf.DELETED_LIST) == str(fa2)
+    # the rest of the baseline is kept
+    stats = bakonf.BackupManager(buildopts(env, ["-L", "1"])).run()
+    a = Archive(stats)
+    assert a.has_file(fb)
+    assert not a.has_file(fa1) and not a.has_file(fa3)
+    assert a.contents(bakonf.DELETED_LIST) == ""
+    # the command checksums are still those of the level 0 backup
+    assert a.cmd_data("counter") == "1"
+
+
+def test_only_roots(env):
+    env.fs.mkdir("a")
+    env.fs.mkdir("b")
+    with env.config.open("a") as f:
+        f.write("include: [%s, %s]\n" % (env.fs.join("a"), env.fs.join("b")))
+    bm = bakonf.BackupManager(buildopts(env))
+    assert bm._onlyroots([str(env.fs), "/nonexistent"]) == \
+        [str(env.fs.join("a")), str(env.fs.join("b"))]
+    assert bm._onlyroots([str(env.fs.join("b", "c"))]) == \
+        [str(env.fs.join("b", "c"))]
+    with pytest.raises(bakonf.Error, match="None of the paths"):
+        bm._onlyroots(["/nonexistent"])
+    opts = buildopts(env, ["-L", "1", "--only", str(env.fs)])
+    with pytest.raises(bakonf.Error, match="Partial backups"):
+        bakonf.BackupManager(opts).run()
+
+
+def test_roots(env, monkeypatch):
+    (r1, r2) = (env.tmpdir.mkdir("c1"), env.tmpdir.mkdir("c2"))
+    for root in (r1, r2):
+        root.mkdir("data").join("f").write(str(root))
+        root.join("data", "skip").write(FOO)
+    r1.join("data", "shared").write(BAR)
+    os.link(str(r1.join("data", "shared")), str(r2.join("data", "shared")))
+    with env.config.open("a") as f:
+        f.write("include: [/data]\nexclude: ['^/data/skip$']\n")
+        f.write("root_jobs: 2\nscan_workers: 2\n")
+        f.write("roots:\n- %s\n- {path: %s, name: c2}\n" % (r1, r2))
+    read = []
+    checksum = bakonf.FileReader.checksum
+
+    def counting(reader, path, size):
+        read.append(path)
+        return checksum(reader, path, size)
+    monkeypatch.setattr(bakonf.FileReader, "checksum", counting)
+    bm = bakonf.BackupManager(buildopts(env))
+    assert_empty(bm.run())
+    n1 = bakonf.sanitize_name(str(r1).strip("/"))
+    assert sorted(bm.root_stats) == sorted([n1, "c2"])
+    for (name, root) in ((n1, r1), ("c2", r2)):
+        stats = bm.root_stats[name]
+        assert "-%s-L0" % name in stats.filename
+        a = Archive(stats)
+        assert a.file_data(root.join("data", "f")) == str(root)
+        assert a.has_file(root.join("data", "shared"))
+        assert not a.has_file(root.join("data", "skip"))
+        assert os.path.exists(str(env.tmpdir.join("db.%s" % name)))
+    # the hard-linked file is only read once, for both roots
+    assert len([p for p in read if p.endswith("shared")]) == 1
+    # a new root has no state database for a level 1 backup, which
+    # only fails that root, without leaving a partial archive behind
+    r3 = env.tmpdir.mkdir("c3")
+    r3.mkdir("data").join("f").write("new")
+    env.config.write(env.config.read() + "- {path: %s, name: c3}\n" % r3)
+    bm = bakonf.BackupManager(buildopts(env, ["-L", "1"]))
+    with pytest.raises(bakonf.Error, match="1 root.*: c3$"):
+        bm.run()
+    assert sorted(bm.root_stats) == sorted([n1, "c2"])
+    assert not [f for f in env.destdir.listdir() if "-c3-" in f.basename]
+    r2.remove()
+    with pytest.raises(bakonf.Error, match="2 root.*: c2, c3$"):
+        bakonf.BackupManager(buildopts(env, ["-L", "1"])).run()
+
+
+def test_progress_record():
+    sent = []
+    progress = bakonf.Progress(sent.append, 1, bakonf.Throttle(), 100)
+    progress.start -= 10
+    rec = progress.record()
+    assert (rec["scanned"], rec["eta"], rec["path"]) == (0, None, None)
+    progress.fm = types.SimpleNamespace(scanned=set(range(25)),
+                                        subjects={"a": None},
+                                        current="/a")
+    rec = progress.record()
+    assert (rec["scanned"], rec["selected"], rec["path"]) == (25, 1, "/a")
+    assert 29 < rec["eta"] < 32
+    progress.end()
+    assert json.loads(sent[-1].decode())["phase"] == bakonf.PHASE_DONE
+
+    # records which would block are dropped, the reporting goes on
+    def full(data):
+        raise BlockingIOError(errno.EAGAIN, "Resource temporarily unavailable")
+    progress.send = full
+    assert progress._write()
+
+    def broken(data):
+        raise BrokenPipeError(32, "Broken pipe")
+    progress.send = broken
+    progress.interval = 0
+    # a failing reader stops the reporting thread
+    progress._loop()
+
+
+def test_progress_fd(env):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("commands:\n- cmd: sleep 0.1\n")
+    for i in range(10):
+        env.fs.join("f%d" % i).write(str(i))
+    (rfd, wfd) = os.pipe()
+    # the pipe is drained while the backup runs, as a real reader would
+    lines = []
+    with os.fdopen(rfd) as fh:
+        reader = threading.Thread(target=lambda: lines.extend(fh))
+        reader.start()
+        opts = buildopts(env, ["--status-fd", str(wfd),
+                               "--status-interval", "0.02"])
+        stats = bakonf.BackupManager(opts).run()
+        # the descriptor is given back as it was
+        assert os.get_blocking(wfd)
+        os.close(wfd)
+        reader.join()
+    records = [json.loads(line) for line in lines]
+    assert len(records) > 1
+    assert records[-1]["phase"] == bakonf.PHASE_DONE
+    assert records[-1]["archived"] == stats.file_count
+    assert records[-1]["bytes"] >= 10
+    assert records[-1]["eta"] == 0
+    assert bakonf.PHASE_COMMANDS in [r["phase"] for r in records]
+    # the next run knows how many paths to expect
+    assert bakonf.BackupManager(opts)._lastscanned() == \
+        records[-1]["scanned"]
+
+
+def test_progress_interval():
+    assert bakonf.parse_interval("0.5") == 0.5
+    for value in ("0", "-1", "abc", "nan", "inf"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            bakonf.parse_interval(value)
+
+
+def test_progress_socket(env):
+    path = str(env.tmpdir.join("status"))
+    opts = buildopts(env, ["--status-socket", path])
+    with pytest.raises(bakonf.Error, match="Cannot connect"):
+        bakonf.BackupManager(opts).run()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    bakonf.BackupManager(opts).run()
+    (conn, _) = server.accept()
+    with conn, server, conn.makefile() as fh:
+        records = [json.loads(line) for line in fh]
+    assert [r["phase"] for r in records] == [bakonf.PHASE_DONE]
+
+
+def test_profiler():
+    prof = bakonf.Profiler()
+    start = time.monotonic()
+    prof.add(bakonf.PROF_STAT, "/a/slow", start - 5)
+    prof.add(bakonf.PROF_CHECKSUM, "/a/slow", start - 2)
+    for name in ["b", "c", "d"]:
+        prof.add(bakonf.PROF_ARCHIVE, "/b/" + name, start - 3)
+    prof.command("slow command", start - 4)
+    prof.command("fast command", start)
+    out = io.StringIO()
+    prof.report(out, 1)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 6
+    assert lines[1].split()[1:] == ["/a/slow", "(stat", "5.000s,",
+                                    "checksum", "2.000s)"]
+    assert lines[3].split()[1] == "/b"
+    assert lines[5].split()[1:] == ["slow", "command"]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_profile(env, capsys, workers):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("scan_workers: %d\n" % workers)
+        f.write("commands:\n- cmd: echo test\n")
+    env.fs.join("a").write(FOO)
+    dump = env.tmpdir.join("profile")
+    opts = buildopts(env, ["--profile", "--profile-dump", str(dump)])
+    bakonf.BackupManager(opts).run()
+    report = capsys.readouterr().err
+    assert "Slowest paths:\n" in report
+    assert "%s (stat" % env.fs.join("a") in report
+    # the directory listing is timed with or without the scan workers
+    assert any(line.split()[1] == str(env.fs) and " list " in line
+               for line in report.splitlines()[1:])
+    assert "s  echo test\n" in report
+    assert pstats.Stats(str(dump)).total_calls > 0
+
+
+def test_library_selections(env):
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("d", "a")
+    fa.ensure().write(FOO)
+    env.fs.join("b").mksymlinkto("d/a")
+    bm = bakonf.BackupManager.FromConfig(str(env.config))
+    fm = bm.filemanager()
+    try:
+        sels = {sel.path: sel for sel in fm.selections()}
+        for sel in sels.values():
+            fm.notifywritten(sel.path)
+        fm.commit()
+    finally:
+        fm.close()
+    assert sels[str(fa)].reason == bakonf.SELECT_NEW
+    assert sels[str(fa)].digest == \
+        hashlib.sha512(FOO.encode()).hexdigest()
+    assert sels[str(fa)].statinfo.size == len(FOO)
+    assert sels[str(env.fs.join("b"))].digest is None
+    assert sels[str(env.fs.join("d"))].reason == bakonf.SELECT_PARENT
+    assert stat.S_ISDIR(sels[str(env.fs.join("d"))].statinfo.mode)
+    fa.write(BAR)
+    bm = bakonf.BackupManager.FromConfig(str(env.config), level=1)
+    fm = bm.filemanager()
+    try:
+        sels = list(fm.selections())
+    finally:
+        fm.close()
+    assert [(sel.path, sel.reason) for sel in sels][-1] == \
+        (str(fa), bakonf.SELECT_CHANGED)
+    assert all(sel.reason == bakonf.SELECT_PARENT for sel in sels[:-1])
+    with pytest.raises(bakonf.Error, match="Unknown option 'levle'"):
+        bakonf.BackupManager.FromConfig(str(env.config), levle=1)
+    # an aborted level 0 run keeps the previous state
+    fm = bakonf.BackupManager.FromConfig(str(env.config)).filemanager()
+    with pytest.raises(KeyError):
+        try:
+            for sel in fm.selections():
+                raise KeyError(sel.path)
+        finally:
+            fm.close()
+    assert not env.tmpdir.join("db" + bakonf.STATE_NEW_SUFFIX).check()
+    fm = bakonf.BackupManager.FromConfig(str(env.config),
+                                         level=1).filemanager()
+    try:
+        assert [sel.path for sel in fm.selections()][-1] == str(fa)
+    finally:
+        fm.close()
+
+
+@pytest.mark.parametrize("window", [1, 256])
+def test_walker(tmpdir, monkeypatch, window):
+    monkeypatch.setattr(bakonf, "SCAN_WINDOW", window)
+    for path in ["a/b/c", "a/d", "e/f/g/h", "i", "x/y/z", "a/x/q"]:
+        tmpdir.join(path).ensure()
+    tmpdir.join("a/link").mksymlinkto(tmpdir.join("e"))
+    tmpdir.join("e/f/empty").ensure(dir=True)
+
+    def excluded(path):
+        return os.path.basename(path) == "x"
+    expected = []
+    for (dpath, dnames, fnames) in os.walk(str(tmpdir)):
+        dnames[:] = [d for d in dnames
+                     if not excluded(os.path.join(dpath, d))]
+        expected.append((dpath, dnames[:], fnames))
+    with bakonf.ParallelWalker(4, excluded) as walker:
+        walker.prefetch(str(tmpdir))
+        result = []
+        for (dpath, dnames, fnames, stats) in walker.walk(str(tmpdir)):
+            dnames[:] = [d for d in dnames
+                         if not excluded(os.path.join(dpath, d))]
+            result.append((dpath, dnames[:], fnames))
+            for name in fnames:
+                assert stats[name].mode == \
+                    os.lstat(os.path.join(dpath, name)).st_mode
+        assert result == expected
+        errors = []
+        assert not list(walker.walk(str(tmpdir.join("missing")),
+                                    onerror=errors.append))
+        assert len(errors) == 1
+        assert errors[0].filename == str(tmpdir.join("missing"))
+
+
+def test_fs_scan_workers(env, monkeypatch):
+    monkeypatch.setattr(bakonf, "SCAN_WINDOW", 2)
+    sub = env.fs.join("sub")
+    with env.config.open("a") as f:
+        f.write("include: [%s, %s]\n" % (env.fs, sub))
+        f.write("exclude: ['.*/skipped$']\n")
+    for i in range(20):
+        env.fs.join("d%d" % (i % 3), "s%d" % (i % 2), "f%d" % i) \
+            .ensure().write(str(i))
+    sub.join("skipped", "f").ensure()
+    sub.join("g").ensure()
+    expected = Archive(bakonf.BackupManager(buildopts(env)).run()).names
+    with env.config.open("a") as f:
+        f.write("scan_workers: 4\n")
+    bm = bakonf.BackupManager(buildopts(env))
+    assert bm.scan.workers == 4
+    names = Archive(bm.run()).names
+    assert names == expected
+    assert "filesystem%s/g" % sub in names
+    assert not [n for n in names if "skipped" in n]
+
+
+@pytest.mark.parametrize("order", [bakonf.READ_ORDER_INODE,
+                                   bakonf.READ_ORDER_EXTENT])
+def test_fs_read_order(env, monkeypatch, order):
+    monkeypatch.setattr(bakonf, "IOSCHED_WINDOW", 3)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    for i in range(10):
+        env.fs.join("d%d" % (i % 2), "f%d" % i).ensure().write(str(i))
+    stats = bakonf.BackupManager(buildopts(env)).run()
+    expected = Archive(stats).names
+    read = []
+    orig = bakonf.FileState._readchecksum
+
+    def record(self):
+        read.append(self.name)
+        orig(self)
+    monkeypatch.setattr(bakonf.FileState, "_readchecksum", record)
+    opts = buildopts(env, ["--read-order", order])
+    stats = bakonf.BackupManager(opts).run()
+    # the archive member order doesn't change
+    assert Archive(stats).names == expected
+    assert sorted(read) == sorted(str(p) for p in env.fs.visit("f*"))
+    if order == bakonf.READ_ORDER_INODE:
+        for i in range(0, len(read), 3):
+            window = read[i:i + 3]
+            inodes = [os.lstat(p).st_ino for p in window]
+            assert inodes == sorted(inodes)
+
+
+def test_extent(tmpdir):
+    fa = tmpdir.join("a")
+    fa.write(FOO)
+    physical = bakonf.IOScheduler.extent(str(fa))
+    # not all file systems support FIEMAP
+    assert physical is None or physical >= 0
+    assert bakonf.IOScheduler.extent(str(tmpdir.join("missing"))) is None
+
+
+@pytest.mark.parametrize("preserve", [True, False])
+def test_reader_checksum(tmpdir, monkeypatch, preserve):
+    monkeypatch.setattr(bakonf, "MMAP_THRESHOLD", 1000)
+    monkeypatch.setattr(bakonf, "HASH_BUFSIZE", 100)
+    reader = bakonf.FileReader(preserve)
+    for size in [0, 10, 999, 1000, 5000]:
+        fa = tmpdir.join("f%d" % size)
+        data = os.urandom(size)
+        fa.write_binary(data)
+        expected = hashlib.sha512(data).hexdigest()
+        assert reader.checksum(str(fa), size) == expected
+    # a file which was truncated after being examined
+    assert reader.checksum(str(tmpdir.join("f0")), 5000) == \
+        hashlib.sha512().hexdigest()
+
+
+def test_reader_cached(tmpdir):
+    fa = tmpdir.join("a")
+    fa.write(FOO)
+    with bakonf.FileReader(True).open(str(fa)) as fh:
+        assert isinstance(bakonf.FileReader.cached(fh.fileno(), 3), bool)
+        assert fh.read() == FOO.encode()
+
+
+def test_reader_deferred_drop(tmpdir, monkeypatch):
+    dropped = []
+
+    def fadvise(fd, offset, length, advice):
+        if advice == os.POSIX_FADV_DONTNEED:
+            dropped.append(os.readlink("/proc/self/fd/%d" % fd))
+    monkeypatch.setattr(os, "posix_fadvise", fadvise)
+    monkeypatch.setattr(bakonf, "HAVE_FADVISE", True)
+    monkeypatch.setattr(bakonf, "DEFERRED_DROPS", 2)
+    monkeypatch.setattr(bakonf.FileReader, "cached",
+                        classmethod(lambda cls, fd, size: False))
+    (fa, fb, fc, fd) = [str(tmpdir.join(n).ensure()) for n in "abcd"]
+    reader = bakonf.FileReader(True)
+    # checksummed files stay cached until archived...
+    reader.checksum(fa, 0)
+    reader.chunked(fb, 100)
+    assert dropped == []
+    with reader.open(fa):
+        pass
+    assert dropped == [fa]
+    # ...or released, if not selected
+    reader.release(fb)
+    reader.release(fb)
+    assert dropped == [fa, fb]
+    # only a limited number of them are kept
+    for path in (fa, fb, fc):
+        reader.checksum(path, 0)
+    assert dropped == [fa, fb, fa]
+    assert list(reader.deferred) == [fb, fc]
+    reader.release(fd)
+    assert len(dropped) == 3
+
+
+def test_fs_preserve_cache(env):
+    opts = buildopts(env, ["--preserve-cache"])
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    stats = bakonf.BackupManager(opts).run()
+    assert Archive(stats).file_data(fa) == FOO
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    slept = []
+
+    def sleep(secs):
+        slept.append(secs)
+        now[0] += secs
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(time, "sleep", sleep)
+    bucket = bakonf.TokenBucket(10)
+    bucket.consume(10)
+    assert slept == []
+    bucket.consume(5)
+    assert slept == [0.5]
+    now[0] += 10
+    # no more than one second's worth is accumulated
+    bucket.consume(15)
+    assert slept == [0.5, 0.5]
+    assert bucket.stalled == 1.0
+
+
+def test_fs_budget(env, monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, "nice", lambda n: calls.append(("nice", n)))
+    monkeypatch.setattr(bakonf, "_NICE_APPLIED", threading.Event())
+    monkeypatch.setattr(bakonf, "set_ioprio",
+                        lambda c, lvl: calls.append(("ionice", c, lvl)))
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("max_read_bytes_per_sec: 100000000\n")
+        f.write("max_files_per_sec: 100000\n")
+        f.write("nice: 10\n")
+        f.write("ionice_class: idle\n")
+        f.write("commands:\n- cmd: echo test\n")
+    fa = env.fs.join("a")
+    fa.write(FOO * 1000)
+    bm = bakonf.BackupManager(buildopts(env))
+    stats = bm.run()
+    assert Archive(stats).file_data(fa) == FOO * 1000
+    assert calls == [("nice", 10), ("ionice", "idle", 4)]
+    # checksummed and archived
+    assert bm.throttle.nbytes >= 2 * len(FOO * 1000)
+    assert bm.throttle.nfiles >= 3
+    assert "throttled for" in bm.throttle.summary()
+    # the niceness is only incremented once, and the command outputs
+    # are accounted against the budget
+    opts = buildopts(env)
+    opts.do_files = False
+    bm = bakonf.BackupManager(opts)
+    bm.run()
+    assert calls[2:] == [("ionice", "idle", 4)]
+    assert bm.throttle.nbytes == len("test\n")
+
+
+def test_digest_cache(tmpdir):
+    fa = tmpdir.join("a")
+    fa.write(FOO)
+    fb = tmpdir.join("b")
+    os.link(str(fa), str(fb))
+    throttle = bakonf.Throttle()
+    reader = bakonf.FileReader(throttle=throttle, digests={})
+    states = [bakonf.FileState(filename=str(path), reader=reader)
+              for path in (fa, fb) * 4]
+    threads = [threading.Thread(target=lambda st=st: st.checksum)
+               for st in states]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(st.checksum for st in states) == \
+        {hashlib.sha512(FOO.encode()).hexdigest()}
+    # the hard-linked file was read once, and no lock is kept
+    assert throttle.nbytes == len(FOO)
+    assert len(reader.digests) == 1
+    assert reader.inodelocks == {}
+
+
+def test_chunked_state(tmpdir, monkeypatch):
+    monkeypatch.setattr(bakonf, "CHUNK_SIZE", 100)
+    fa = tmpdir.join("a")
+    data = b"x" * 450
+    fa.write_binary(data)
+    reader = bakonf.FileReader(chunk_threshold=200)
+    phys = bakonf.FileState(filename=str(fa), reader=reader)
+    assert phys.checksum == hashlib.sha512(data).hexdigest()
+    virt = bakonf.FileState(serialdata=phys.serialize())
+    assert virt.checksum == phys.checksum
+    assert len(virt._chunks[1]) == 5
+    assert virt._chunks == phys._chunks
+    # old-style records, without chunks, are still read
+    old = bakonf.FileState(serialdata=phys.serialize().rsplit("\0", 1)[0])
+    assert old._chunks is None
+    assert old.checksum == phys.checksum
+    # unchanged file
+    throttle = bakonf.Throttle()
+    reader = bakonf.FileReader(throttle=throttle)
+    assert bakonf.FileState(filename=str(fa), reader=reader) == virt
+    assert throttle.nbytes == len(data)
+    # a change in the first chunk is found after reading it
+    fa.write_binary(b"y" + data[1:])
+    throttle = bakonf.Throttle()
+    reader = bakonf.FileReader(throttle=throttle)
+    changed = bakonf.FileState(filename=str(fa), reader=reader)
+    assert changed != virt
+    assert throttle.nbytes == 100
+    # and the checksum is still available afterwards
+    assert changed.checksum == hashlib.sha512(b"y" + data[1:]).hexdigest()
+
+
+def test_fs_chunked_l1(env, monkeypatch):
+    monkeypatch.setattr(bakonf, "CHUNK_SIZE", 100)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("chunk_threshold: 200\n")
+    fa = env.fs.join("a")
+    fb = env.fs.join("b")
+    fa.write("a" * 1000)
+    fb.write("b" * 1000)
+    opts = buildopts(env)
+    bakonf.BackupManager(opts).run()
+    fa.write("c" * 1000)
+    opts.level = 1
+    stats = bakonf.BackupManager(opts).run()
+    ar = Archive(stats)
+    assert ar.has_file(fa)
+    assert not ar.has_file(fb)
+
+
+class FakeStdout():
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+
+class BrokenPipe(io.BytesIO):
+    def write(self, _data):
+        raise BrokenPipeError(32, "Mock broken pipe")
+
+
+@pytest.mark.parametrize("use_dash", [True, False])
+def test_stdout(env, monkeypatch, valid_compression_format, use_dash):
+    opts = buildopts(env)
+    if use_dash:
+        opts.file = "-"
+    else:
+        opts.stdout = True
+    opts.compression = valid_compression_format
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    out = io.BytesIO()
+    monkeypatch.setattr(sys, "stdout", FakeStdout(out))
+    stats = bakonf.BackupManager(opts).run()
+    assert stats.filename == "-"
+    assert not env.destdir.listdir()
+    tar = tarfile.open(fileobj=io.BytesIO(out.getvalue()), mode="r")
+    c = tar.extractfile(Archive.filepath(fa))
+    assert c is not None
+    assert bakonf.ensure_text(c.read()) == FOO
+    # and the database has been updated
+    opts.level = 1
+    opts.stdout = False
+    opts.file = None
+    assert_empty(bakonf.BackupManager(opts).run())
+
+
+def test_stdout_broken(env, monkeypatch):
+    opts = buildopts(env)
+    opts.stdout = True
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    monkeypatch.setattr(sys, "stdout", FakeStdout(BrokenPipe()))
+    with pytest.raises(bakonf.ArchiveWriteError, match="broken pipe"):
+        bakonf.BackupManager(opts).run()
+
+
+def restoreopts(archives, destdir, paths=None, extra=None):
+    if not isinstance(archives, list):
+        archives = [archives]
+    op = bakonf.build_restore_options()
+    args = ["-C", str(destdir)] + (extra or [])
+    for path in paths or []:
+        args += ["-p", str(path)]
+    return op.parse_args(args + [str(a) for a in archives])
+
+
+@pytest.mark.parametrize("index", [True, False])
+def test_restore_single(env, monkeypatch, valid_compression_format, index):
+    monkeypatch.setattr(bakonf, "INDEX_BLOCKSIZE", 1000)
+    opts = buildopts(env)
+    opts.compression = valid_compression_format
+    opts.index = index
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    for i in range(20):
+        env.fs.join("d%d" % (i % 3), "f%d" % i).ensure().write(str(i) * 300)
+    stats = bakonf.BackupManager(opts).run()
+    assert os.path.exists(stats.filename + bakonf.INDEX_SUFFIX) == index
+    # the archive is still readable as a whole
+    assert Archive(stats).file_data(env.fs.join("d2", "f5")) == "5" * 300
+    rdir = env.tmpdir.mkdir("restore")
+    want = [env.fs.join("d1", "f7"), env.fs.join("d2", "f14")]
+    rstats = bakonf.RestoreManager(restoreopts(stats.filename, rdir,
+                                               want)).run()
+    assert rstats == (2, 0, 0)
+    for path in want:
+        assert rdir.join(str(path)).read() == path.read()
+    assert not rdir.join(str(env.fs.join("d0", "f0"))).check()
+
+
+def test_restore_all(env):
+    opts = buildopts(env)
+    opts.index = True
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a", "b")
+    fa.ensure().write(FOO)
+    stats = bakonf.BackupManager(opts).run()
+    rdir = env.tmpdir.mkdir("restore")
+    rstats = bakonf.RestoreManager(restoreopts(stats.filename, rdir)).run()
+    assert rstats.restored > 1
+    assert rstats.errors == 0
+    assert rdir.join(str(fa)).read() == FOO
+    assert rdir.join(str(fa)).stat().mtime == fa.stat().mtime
+    assert rdir.join(str(fa)).stat().mode == fa.stat().mode
+
+
+@pytest.mark.parametrize("index", [True, False])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_restore_levels(env, index, jobs):
+    """Restoring from a level 0 and a level 1 archive."""
+    opts = buildopts(env)
+    opts.index = index
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fb = env.fs.join("sub", "b")
+    fa.write(FOO)
+    fb.ensure().write(FOO)
+    os.link(str(fb), str(env.fs.join("sub", "c")))
+    stats0 = bakonf.BackupManager(opts).run()
+    fb.write(BAR)
+    opts.level = 1
+    stats1 = bakonf.BackupManager(opts).run()
+    rdir = env.tmpdir.mkdir("restore")
+    extra = ["-j", str(jobs), "-S", str(env.tmpdir.join("db"))]
+    rstats = bakonf.RestoreManager(
+        restoreopts([stats0.filename, stats1.filename], rdir,
+                    [env.fs], extra)).run()
+    assert rstats.errors == 0
+    assert rstats.mismatches == 0
+    assert rdir.join(str(fa)).read() == FOO
+    assert rdir.join(str(fb)).read() == BAR
+    # the hard link was only in the level 0 archive, but still points
+    # to the newest version of the file
+    rc = rdir.join(str(env.fs), "sub", "c")
+    assert rc.stat().ino == rdir.join(str(fb)).stat().ino
+
+
+def test_fs_deleted_in_l1(env, valid_compression_format):
+    opts = buildopts(env)
+    opts.compression = valid_compression_format
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+        f.write("exclude: [%s]\n" % env.fs.join("excl"))
+    fa = env.fs.join("a")
+    fb = env.fs.join("sub", "b")
+    fc = env.fs.join("excl", "c")
+    fk = env.fs.join("keep")
+    for f in (fa, fb, fk):
+        f.ensure().write(FOO)
+    stats0 = bakonf.BackupManager(opts).run()
+    # only created after the level 0 backup, in a directory excluded by
+    # the configuration, so neither archived nor listed as deleted
+    fc.ensure().write(FOO)
+    env.fs.join("sub").remove()
+    fa.remove()
+    opts.level = 1
+    stats1 = bakonf.BackupManager(opts).run()
+    ar = Archive(stats1)
+    deleted = ar.contents(bakonf.DELETED_LIST).split("\n")
+    assert sorted(deleted) == sorted([str(fa), str(fb)])
+    rdir = env.tmpdir.mkdir("restore")
+    rstats = bakonf.RestoreManager(
+        restoreopts([stats0.filename, stats1.filename], rdir)).run()
+    assert rstats.errors == 0
+    assert not rdir.join(str(fa)).check()
+    assert not rdir.join(str(fb)).check()
+    assert rdir.join(str(fk)).read() == FOO
+
+
+def test_restore_mismatch(env):
+    """Checksum mismatches against the state database are reported."""
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    stats = bakonf.BackupManager(opts).run()
+    # update the database with a newer version of the file
+    fa.write(BAR)
+    opts.archive_id = "newer"
+    bakonf.BackupManager(opts).run()
+    rdir = env.tmpdir.mkdir("restore")
+    rstats = bakonf.RestoreManager(
+        restoreopts(stats.filename, rdir, [fa],
+                    ["-S", str(env.tmpdir.join("db"))])).run()
+    assert rstats == (1, 0, 1)
+    # which makes the restore command fail
+    with pytest.raises(bakonf.Error, match="0 errors, 1 checksum"):
+        bakonf.checkrestore(rstats)
+
+
+def test_restore_unsafe(env):
+    """Members can't be written outside the destination directory."""
+    outside = env.tmpdir.mkdir("outside")
+    rdir = env.tmpdir.mkdir("restore")
+    rdir.join("link").mksymlinkto(outside)
+    path = str(env.tmpdir.join("crafted.tar"))
+
+    def add(tar, name, data=None, linkname=None):
+        ti = tarfile.TarInfo(name)
+        if linkname is not None:
+            ti.type = tarfile.SYMTYPE
+            ti.linkname = linkname
+        else:
+            ti.size = len(data)
+        tar.addfile(ti, io.BytesIO(data) if data is not None else None)
+    with tarfile.open(path, "w") as tar:
+        add(tar, "filesystem/../../pwned", b"x")
+        add(tar, "filesystem/link/pwned", b"x")
+        add(tar, "filesystem/sym", linkname=str(outside))
+        add(tar, "filesystem/sym/pwned", b"x")
+        add(tar, "filesystem/sym2/../good", b"x")
+    rstats = bakonf.RestoreManager(restoreopts(path, rdir)).run()
+    assert rstats.errors == 3
+    with pytest.raises(bakonf.Error, match="3 errors"):
+        bakonf.checkrestore(rstats)
+    assert not env.tmpdir.join("pwned").check()
+    assert outside.listdir() == []
+    assert rdir.join("good").read() == "x"
+    # the symbolic link is only created at the end, so its "contents"
+    # went into a normal directory, which then can't be replaced
+    assert rdir.join("sym", "pwned").read() == "x"
+    assert not rdir.join("sym").islink()
+
+
+def test_restore_hardlinked_target(env):
+    """Existing files are replaced, not written through hard links."""
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    stats = bakonf.BackupManager(buildopts(env)).run()
+    outside = env.tmpdir.join("outside")
+    outside.write(BAR)
+    outside.chmod(0o644)
+    mtime = outside.mtime()
+    rdir = env.tmpdir.mkdir("restore")
+    target = rdir.join(str(fa))
+    target.dirpath().ensure(dir=True)
+    os.link(str(outside), str(target))
+    rstats = bakonf.RestoreManager(restoreopts(stats.filename, rdir)).run()
+    bakonf.checkrestore(rstats)
+    assert target.read() == FOO
+    assert outside.read() == BAR
+    assert stat.S_IMODE(outside.stat().mode) == 0o644
+    assert outside.mtime() == mtime
+
+
+def test_volumes(env, valid_compression_format):
+    if valid_compression_format == bakonf.COMP_XZ and not bakonf.HAVE_LZMA:
+        pytest.skip("LZMA not supported by current python")
+    opts = buildopts(env, ["--volume-size", "4k"])
+    opts.compression = valid_compression_format
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    files = [env.fs.join("f%d" % i) for i in range(5)]
+    for fx in files:
+        fx.write(str(fx) * 100)
+    links = [env.fs.join("l%d" % i) for i in range(5)]
+    for (fx, lx) in zip(files, links):
+        os.link(str(fx), str(lx))
+    stats = bakonf.BackupManager(opts).run()
+    assert stats.filename.endswith(bakonf.MANIFEST_SUFFIX)
+    with open(stats.filename) as fh:
+        header = json.loads(fh.readline())
+        manifest = dict(json.loads(line) for line in fh)
+    assert len(header["volumes"]) > 2
+    assert not [n for n in env.destdir.listdir()
+                if n.basename.endswith(bakonf.VOLUME_TMP_SUFFIX)]
+    volumes = [str(env.destdir.join(v)) for v in header["volumes"]]
+    for (idx, vol) in enumerate(volumes):
+        with tarfile.open(vol, "r") as tar:
+            names = tar.getnames()
+            for ti in tar.getmembers():
+                assert manifest[ti.name.rstrip("/")] == idx
+                # each volume is complete on its own
+                if ti.islnk():
+                    assert ti.linkname in names
+    rdir = env.tmpdir.mkdir("restore")
+    bakonf.RestoreManager(restoreopts(volumes, rdir)).run()
+    for fx in files + links:
+        assert rdir.join(str(fx)).read() == fx.read()
+
+
+def test_volumes_bad(env):
+    assert bakonf.parse_size("3k") == 3072
+    assert bakonf.parse_size("2G") == 2 * 1024 ** 3
+    for value in ("0", "abc", "-1M"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            bakonf.parse_size(value)
+    opts = buildopts(env, ["--volume-size", "1M", "--index"])
+    with pytest.raises(bakonf.Error, match="split into volumes"):
+        bakonf.BackupManager(opts).run()
+
+
+def test_index_contents(env, valid_compression_format):
+    opts = buildopts(env)
+    opts.compression = valid_compression_format
+    opts.index = True
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fa.write(FOO)
+    stats = bakonf.BackupManager(opts).run()
+    (compr, entries) = bakonf.read_index(stats.filename +
+                                         bakonf.INDEX_SUFFIX)
+    assert compr == valid_compression_format
+    by_name = dict((e.name, e) for e in entries)
+    entry = by_name[Archive.filepath(fa)]
+    assert entry.size == len(FOO)
+    assert entry.digest == bakonf.FileState(filename=str(fa)).checksum
+
+
+def test_index_stdout(env):
+    opts = buildopts(env)
+    opts.index = True
+    opts.stdout = True
+    with pytest.raises(bakonf.Error, match="index can't be generated"):
+        bakonf.BackupManager(opts).run()
+
+
+def test_index_invalid(env):
+    idx = env.tmpdir.join("a.tar" + bakonf.INDEX_SUFFIX)
+    idx.write("{\"version\": 1, \"compression\": \"\"}\n[1, 2]\n")
+    with pytest.raises(bakonf.ConfigurationError, match="Invalid index"):
+        bakonf.read_index(str(idx))
+    idx.write("{\"version\": 0}\n")
+    with pytest.raises(bakonf.ConfigurationError, match="Unknown index"):
+        bakonf.read_index(str(idx))
+
+
+def test_diff(env):
+    opts = buildopts(env)
+    with env.config.open("a") as f:
+        f.write("include: [%s]\n" % env.fs)
+    fa = env.fs.join("a")
+    fb = env.fs.join("b")
+    fc = env.fs.join("c")
+    fd = env.fs.join("d")
+    for f in (fa, fb, fc):
+        f.write(FOO)
+    bakonf.BackupManager(opts).run()
+    old = env.tmpdir.join("db.old")
+    env.tmpdir.join("db").copy(old)
+    fa.remove()
+    fb.write(BAR)
+    fc.chmod(0o604)
+    fd.write(FOO)
+    bakonf.BackupManager(opts).run()
+    dba = bakonf.StateDB(str(old), "r")
+    dbb = bakonf.StateDB(str(env.tmpdir.join("db")), "r")
+    changes = dict((e.path, e) for e in bakonf.diffstates(dba, dbb))
+    assert changes[str(fa)].change == bakonf.DIFF_REMOVED
+    assert changes[str(fb)].change == bakonf.DIFF_MODIFIED
+    assert "checksum" in changes[str(fb)].fields
+    assert changes[str(fc)].change == bakonf.DIFF_METADATA
+    assert changes[str(fc)].fields == ["mode"]
+    assert changes[str(fd)].change == bakonf.DIFF_ADDED
+    # no differences with itself
+    assert list(bakonf.diffstates(dbb, dbb)) == []
+    # chunk checksums recorded for an unchanged file
+    rec = dbb.getraw(bakonf.StateDB.filekey(str(fc)).encode())
+    assert bakonf.statediff(rec, rec + b"\x008388608:" + b"0" * 128) == \
+        (bakonf.DIFF_METADATA, ["chunks"])
+    out = io.StringIO()
+    counts = bakonf.writediff(bakonf.diffstates(dba, dbb), "json", out)
+    assert counts[bakonf.DIFF_ADDED] == 1
+    assert counts[bakonf.DIFF_REMOVED] == 1
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert {"change": "added", "path": str(fd), "fields": []} in lines
+    out = io.StringIO()
+    bakonf.writediff(bakonf.diffstates(dba, dbb), "text", out)
+    assert "removed  %s\n" % fa in out.getvalue()
+    dba.close()
+    dbb.close()